@@ -0,0 +1,160 @@
+import math
+import time
+
+from route_planner import COMMAND_SHIP_SPEED, DRIFT_MULTIPLIER, drift_seconds, path_drift_seconds, plan_tour
+from spatial import SpatialIndex
+
+
+WEEK_SECONDS = 7 * 24 * 60 * 60
+SAFETY_MARGIN = 12 * 60 * 60  # restarts, verification and time spent waiting on the request queue
+CHART_SECONDS = 20  # chart and nav requests at each waypoint, while the queue is busy
+UNLOCATED_LEG_SECONDS = drift_seconds(100)  # drift between waypoints that have no coordinates
+JUMP_GATE_RANGE = 2000
+JUMP_SECONDS = 60
+CANDIDATES = 8
+
+
+def warp_seconds(distance):
+    # Warping in drift mode is timed the same way as drifting between waypoints.
+    return drift_seconds(distance)
+
+
+def tour_seconds(waypoints):
+    # Time to chart every uncharted waypoint in a system, starting from the best waypoint to warp in to.
+    uncharted = [wp for wp in waypoints if not wp[2]]
+    if not uncharted:
+        return 0
+    located = [(wp[6], wp[7]) for wp in uncharted if wp[6] is not None]
+    seconds = len(uncharted) * CHART_SECONDS + (len(uncharted) - len(located)) * UNLOCATED_LEG_SECONDS
+    if len(located) > 1:
+        seconds += path_drift_seconds(located, plan_tour(located))
+    return seconds
+
+
+def plan_accounts(positions, headquarters, tours, gates=(), window=WEEK_SECONDS - SAFETY_MARGIN):
+    # Chains systems together so one account charts several of them inside the window.
+    # positions maps system -> (x, y), headquarters maps faction -> (x, y), tours maps system -> seconds to chart it,
+    # and gates is the set of systems with a jump gate.
+    # Returns [(faction, [(system, via), ...]), ...] with via "warp" or "jump", furthest first chain first.
+    gates = set(gates)
+    grid = SpatialIndex.from_positions(positions)
+    gate_grid = SpatialIndex.from_positions({s: p for s, p in positions.items() if s in gates})
+    closest_faction = dict(zip(positions, SpatialIndex.from_positions(headquarters).nearest(list(positions.values()))))
+
+    seeds = sorted(positions, key=lambda s: closest_faction[s][0], reverse=True)
+    chains = []
+    for seed in seeds:
+        if seed not in grid:
+            continue
+        grid.remove(seed)
+        gate_grid.remove(seed)
+        start_distance, faction = closest_faction[seed]
+        elapsed = warp_seconds(start_distance) + tours[seed]
+        legs = [(seed, "warp")]
+        last = seed
+        while True:
+            remaining = window - elapsed
+            if remaining <= 0:
+                break
+            best = None
+            max_distance = remaining * COMMAND_SHIP_SPEED / DRIFT_MULTIPLIER
+            for distance, candidate in grid.k_nearest(positions[last], CANDIDATES, max_distance):
+                cost = warp_seconds(distance)
+                if best is None or cost < best[0]:
+                    if cost + tours[candidate] <= remaining:
+                        best = (cost, candidate, "warp")
+            if last in gates:
+                for distance, candidate in gate_grid.k_nearest(positions[last], CANDIDATES, JUMP_GATE_RANGE):
+                    cost = JUMP_SECONDS + UNLOCATED_LEG_SECONDS
+                    if (best is None or cost < best[0]) and cost + tours[candidate] <= remaining:
+                        best = (cost, candidate, "jump")
+            if best is None:
+                break
+            cost, last, via = best
+            grid.remove(last)
+            gate_grid.remove(last)
+            elapsed += cost + tours[last]
+            legs.append((last, via))
+        chains.append((faction, legs))
+    return chains
+
+
+def chain_seconds(chain, positions, headquarters, tours):
+    # How long one account takes to chart its chain, timed the same way plan_accounts times it
+    faction, legs = chain
+    last = headquarters[faction]
+    seconds = 0
+    for system, via in legs:
+        if via == "jump":
+            seconds += JUMP_SECONDS + UNLOCATED_LEG_SECONDS
+        else:
+            seconds += warp_seconds(math.dist(last, positions[system]))
+        seconds += tours[system]
+        last = positions[system]
+    return seconds
+
+
+def estimate_requests(chains, waypoint_counts, uncharted_counts):
+    # Roughly how many API calls the plan makes: register, orbit and drift once per account,
+    # then per system a warp or jump, a chart and nav per uncharted waypoint, and the waypoint pages to verify it.
+    calls = 0
+    for faction, legs in chains:
+        calls += 3
+        for system, via in legs:
+            calls += 1 + 2 * uncharted_counts[system] + math.ceil(waypoint_counts[system] / 20)
+    return calls
+
+
+def build_plan(exclude=()):
+    from main import app, db_flush, get_faction_headquarters, get_universe
+
+    universe_index = get_universe()
+    db_flush()
+    systems = app.storage.stream("SELECT System, x, y, hasJumpGate FROM Systems")
+    headquarters = get_faction_headquarters()
+    positions = {}
+    gates = set()
+    tours = {}
+    for system, x, y, has_jump_gate in systems:
+        if system in exclude:
+            continue
+        waypoints = universe_index.waypoints_in(system)
+        if not any(not wp[2] for wp in waypoints):
+            continue
+        positions[system] = (x, y)
+        tours[system] = tour_seconds(waypoints)
+        if has_jump_gate:
+            gates.add(system)
+    return plan_accounts(positions, headquarters, tours, gates)
+
+
+def main():
+    from main import get_universe
+
+    start = time.time()
+    chains = build_plan()
+    elapsed = time.time() - start
+
+    universe_index = get_universe()
+    waypoint_counts = {}
+    uncharted_counts = {}
+    for faction, legs in chains:
+        for system, via in legs:
+            waypoints = universe_index.waypoints_in(system)
+            waypoint_counts[system] = len(waypoints)
+            uncharted_counts[system] = sum(1 for wp in waypoints if not wp[2])
+    systems = len(waypoint_counts)
+    one_per_system = [(None, [(s, "warp")]) for s in waypoint_counts]
+    before = estimate_requests(one_per_system, waypoint_counts, uncharted_counts)
+    after = estimate_requests(chains, waypoint_counts, uncharted_counts)
+
+    print("Systems to chart:", systems)
+    print("Accounts:", systems, "->", len(chains))
+    print("Longest chain:", max((len(legs) for faction, legs in chains), default=0), "systems")
+    print("Jumps:", sum(1 for faction, legs in chains for s, via in legs if via == "jump"))
+    print("Estimated API calls:", before, "->", after)
+    print("Planning time (s):", round(elapsed, 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+import asyncio
+import concurrent.futures
+
+from main import *
+from ship import CHARTING, DONE, DRIFTING, ORBITED, REGISTERED, VERIFYING, WARPING, Ship
+
+db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="DBWriter")
+
+
+async def db_call(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, func, *args)
+
+
+async def plan_call(func, *args):
+    # Route planning is CPU-bound, so it runs off the event loop where it can't hold up every other ship
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+async def sleep_until(arrival):
+    sleep_seconds = (arrival - datetime.datetime.utcnow()) / datetime.timedelta(seconds=1)
+    if sleep_seconds > 0:
+        await asyncio.sleep(sleep_seconds)
+
+
+async def register_async(agent_name, faction, system, priority="NORMAL"):
+    if faction is None:
+        faction = await db_call(closest_faction, system)
+    payload = {
+        "faction": faction,
+        "symbol": agent_name
+    }
+    response = (await app.rh.apost("register", payload, token=None, priority=priority)).json()
+    return await db_call(registered, agent_name, system, response)
+
+
+async def register_ship_async(ship_class, agent_name, faction, system, printID=None, chain=None):
+    # register_ship, with the database work on the database thread and the API call on the event loop
+    planned_name = agent_name
+    faction, pooled = await db_call(pooled_agent, faction, system)
+    if pooled is not None:
+        agent_name, token = pooled
+    else:
+        try:
+            registration = await register_async(agent_name, faction, system)
+        except KeyError:
+            agent_name = "ZCHAR2-" + system
+            registration = await register_async(agent_name, faction, system)
+        token = registration["data"]["token"]
+    return await db_call(registered_ship, ship_class, planned_name, agent_name, token, system, printID, chain)
+
+
+async def orbit_async(agent, token, priority="NORMAL", deadline=None):
+    ship_name = agent + "-1"
+    endpoint = "my/ships/" + ship_name + "/orbit"
+    return (await app.rh.apost(endpoint, token=token, priority=priority, deadline=deadline)).json()
+
+
+async def drift_async(agent, token, priority="NORMAL", deadline=None):
+    ship_name = agent + "-1"
+    endpoint = "my/ships/" + ship_name + "/nav"
+    payload = {"flightMode": "DRIFT"}
+    return (await app.rh.apatch(endpoint, payload, token=token, priority=priority, deadline=deadline)).json()
+
+
+async def warp_async(agent, token, waypoint, priority="NORMAL", deadline=None):
+    ship_name = agent + "-1"
+    endpoint = "my/ships/" + ship_name + "/warp"
+    payload = {"waypointSymbol": waypoint}
+
+    response = (await app.rh.apost(endpoint, payload, token=token, priority=priority, deadline=deadline)).json()
+    code = needs_drift(response)
+    while code:
+        if code == 4236:  # not in orbit
+            await orbit_async(agent, token, priority="HIGH", deadline=deadline)
+        await drift_async(agent, token, priority="HIGH", deadline=deadline)  # not enough fuel to warp any faster
+        response = (await app.rh.apost(endpoint, payload, token=token, priority=priority, deadline=deadline)).json()
+        code = needs_drift(response)
+    arrival = await db_call(arrived, agent, waypoint, response)
+    if arrival is None:  # destination in same system
+        return await nav_async(agent, token, waypoint, priority=priority, deadline=deadline)
+    return arrival
+
+
+async def nav_async(agent, token, waypoint, priority="NORMAL", deadline=None):
+    ship_name = agent + "-1"
+    endpoint = "my/ships/" + ship_name + "/navigate"
+    payload = {"waypointSymbol": waypoint}
+
+    response = (await app.rh.apost(endpoint, payload, token=token, priority=priority, deadline=deadline)).json()
+    return await db_call(arrived, agent, waypoint, response)
+
+
+async def jump_async(agent, token, system, priority="NORMAL", deadline=None):
+    ship_name = agent + "-1"
+    endpoint = "my/ships/" + ship_name + "/jump"
+    payload = {"systemSymbol": system}
+
+    response = (await app.rh.apost(endpoint, payload, token=token, priority=priority, deadline=deadline)).json()
+    return await db_call(jumped, agent, response)
+
+
+async def chart_async(agent, token, priority="NORMAL", deadline=None):
+    ship_name = agent + "-1"
+    endpoint = "my/ships/" + ship_name + "/chart"
+
+    response = await app.rh.apost(endpoint, token=token, priority=priority, deadline=deadline)
+    return await db_call(charted, response)
+
+
+async def get_waypoint_async(token, waypoint, priority="NORMAL", deadline=None):
+    system = waypoint_to_system(waypoint)
+    endpoint = "systems/" + system + "/waypoints/" + waypoint
+    response = (await app.rh.aget(endpoint, token=token, priority=priority, deadline=deadline)).json()
+    await db_call(update_waypoint_traits, response["data"])
+    return response
+
+
+async def list_waypoints_async(token, system, priority="NORMAL", deadline=None):
+    endpoint = "systems/" + system + "/waypoints"
+    waypoints_list = []
+    all_collected = False
+    page = 1
+    while not all_collected:
+        response = (await app.rh.aget(endpoint, token=token, params=waypoints_page(page), priority=priority,
+                                      deadline=deadline)).json()
+        all_collected = add_waypoints(waypoints_list, response)
+        for wp in response["data"]:
+            await db_call(update_waypoint_traits, wp)
+        page += 1
+    return waypoints_list
+
+
+async def get_market_async(token, waypoint, priority="NORMAL", deadline=None):
+    system = waypoint_to_system(waypoint)
+    endpoint = "systems/" + system + "/waypoints/" + waypoint + "/market"
+    response = (await app.rh.aget(endpoint, token=token, priority=priority, deadline=deadline)).json()
+    await db_call(log_market, waypoint, response["data"])
+    return response
+
+
+async def get_shipyard_async(token, waypoint, priority="NORMAL", deadline=None):
+    system = waypoint_to_system(waypoint)
+    endpoint = "systems/" + system + "/waypoints/" + waypoint + "/shipyard"
+    response = (await app.rh.aget(endpoint, token=token, priority=priority, deadline=deadline)).json()
+    await db_call(log_shipyard, waypoint, response["data"])
+    return response
+
+
+async def get_ship_async(agent, token, priority="NORMAL", deadline=None):
+    endpoint = "my/ships/" + agent + "-1"
+    response = (await app.rh.aget(endpoint, token=token, priority=priority, deadline=deadline)).json()
+    return await db_call(located, agent, response)
+
+
+class AsyncShip(Ship):
+    __slots__ = ()
+
+    async def start(self):
+        while self.State != DONE:
+            await self.step_async()
+        log.info("ships", "closing completed task", self.printID)
+
+    async def step_async(self):
+        # Ship.step as a coroutine: waits out arrivals instead of returning them
+        if self.route is None:
+            await plan_call(self.plan_route)
+
+        if self.State == REGISTERED:
+            await orbit_async(self.ID, self.Token, "HIGH", deadline=self.deadline("HIGH"))
+            await db_call(self.transition, ORBITED)
+
+        if self.State == ORBITED:
+            await drift_async(self.ID, self.Token, "HIGH", deadline=self.deadline("HIGH"))
+            await db_call(self.transition, DRIFTING)
+
+        if self.State == DRIFTING:
+            if not self.route and self.next_leg() is not None:
+                await self.leave_system()
+                return
+            target = self.warp_target()
+            response = await warp_async(self.ID, self.Token, target, "HIGH", deadline=self.deadline("HIGH"))
+            self.Arrival = time_str_to_datetime(response["data"]["nav"]["route"]["arrival"])
+            self.Waypoint = target
+            await db_call(self.transition, WARPING)
+
+        if self.State == WARPING:
+            await self.wait_for_arrival()
+            await db_call(self.transition, CHARTING, 0)
+
+        if self.State == CHARTING:
+            await self.wait_for_arrival()
+            if self.route:
+                await self.chart_stop_async()
+            if self.route:
+                n = await nav_async(self.ID, self.Token, self.route_symbol(), "HIGH", deadline=self.deadline("HIGH"))
+                self.Arrival = time_str_to_datetime(n["data"]["nav"]["route"]["arrival"])
+                self.Waypoint = self.route_symbol()
+                await db_call(self.transition, CHARTING, self.Stop + 1)
+                return
+            await db_call(self.transition, VERIFYING)
+
+        if self.State == VERIFYING:
+            if not await self.verify_charted():
+                self.route = None
+                await db_call(self.transition, CHARTING)
+                return
+            if self.next_leg() is not None:
+                await self.leave_system()
+                return
+            await db_call(self.transition, DONE)
+
+    async def wait_for_arrival(self):
+        if self.Arrival is None:
+            return
+        if self.Arrival > datetime.datetime.utcnow():
+            log.info("ships", "continuing task", self.printID, "in", self.Arrival - datetime.datetime.utcnow())
+        await sleep_until(self.Arrival)
+
+    async def chart_stop_async(self):
+        wp_name = self.route_symbol()
+        if not get_universe().charted[self.route[0]]:
+            c = await chart_async(self.ID, self.Token, deadline=self.deadline("NORMAL"))
+            if c:
+                traits = c["data"]["waypoint"]["traits"]
+            else:
+                # someone else charted it first
+                await db_call(set_waypoint_flag, wp_name, "Charted", True)
+                wp = await get_waypoint_async(self.Token, wp_name, "HIGH", deadline=self.deadline("HIGH"))
+                traits = wp["data"]["traits"]
+            await self.log_traits(wp_name, traits)
+        self.route.pop(0)
+
+    async def leave_system(self):
+        await self.wait_for_arrival()
+        system, via = self.next_leg()
+        response = False
+        if via == "jump":
+            response = await jump_async(self.ID, self.Token, system, "HIGH", deadline=self.deadline("HIGH"))
+        await db_call(self.enter_system, system, response)
+
+    async def log_traits(self, wp_name, traits):
+        for t in traits:
+            if t["symbol"] == "MARKETPLACE":
+                await get_market_async(self.Token, wp_name, deadline=self.deadline("NORMAL"))
+            elif t["symbol"] == "SHIPYARD":
+                await get_shipyard_async(self.Token, wp_name, deadline=self.deadline("NORMAL"))
+
+    async def verify_charted(self):
+        return self.check_charted(await list_waypoints_async(self.Token, self.System, deadline=self.deadline("NORMAL")))
+
+    async def update_markets_and_shipyards(self):
+        universe_index = get_universe()
+        await plan_call(self.plan_research)
+        while self.research_route:
+            symbol = universe_index.symbols[self.research_route[0]]
+            log.info("ships", "Market research continuing towards", symbol)
+            n = await nav_async(self.ID, self.Token, symbol, "LOW", deadline=self.deadline("LOW"))
+            self.Arrival = time_str_to_datetime(n["data"]["nav"]["route"]["arrival"])
+            await sleep_until(self.Arrival)
+
+            i = self.research_route.pop(0)
+            if universe_index.shipyard[i]:
+                await get_shipyard_async(self.Token, symbol, "LOW", deadline=self.deadline("LOW"))
+            if universe_index.marketplace[i]:
+                await get_market_async(self.Token, symbol, "LOW", deadline=self.deadline("LOW"))
+        log.info("ships", "ending market research", self.System)
+
+
+async def register_ships(registrations, launched, tasks):
+    # Registers agents one at a time (each registration is a register_ship_async call) and starts each ship as soon
+    # as it's registered
+    for registration in registrations:
+        try:
+            s = await registration()
+        except Exception as e:
+            log.error("ships", "registration failed:", repr(e))
+            continue
+        if launched is not None:
+            launched(s)
+        tasks.add(asyncio.create_task(s.start()))
+
+
+async def run_ships(ships, research_ships=(), registrations=(), launched=None):
+    pending = set()
+    for s in ships:
+        pending.add(asyncio.create_task(s.start()))
+    for s in research_ships:
+        pending.add(asyncio.create_task(s.update_markets_and_shipyards()))
+    if registrations:
+        pending.add(asyncio.create_task(register_ships(registrations, launched, pending)))
+
+    while pending:
+        log.info("fleet", "Living tasks:", len(pending))
+        done, _ = await asyncio.wait(pending, timeout=60)
+        pending -= done
+        for t in done:
+            if t.exception() is not None:
+                log.error("ships", "task failed:", repr(t.exception()))
+
+
+def run(ships, research_ships=(), registrations=(), launched=None):
+    asyncio.run(run_ships(ships, research_ships, registrations, launched))
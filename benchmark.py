@@ -0,0 +1,358 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from log import Log
+from make_requests import DEADLINE_SLACK, POLICIES, PRIORITIES, RequestHandler, print_builder
+from mock_server import ServerLimit
+from rate_limiter import RateLimiter
+
+
+# Drives RequestHandler with many concurrent callers through a fake transport that enforces the rate limit the way
+# the server does, and records how long each request sat in the queue. Everything runs in real time, so the limits
+# are scaled up (--scale) to get meaningful numbers in seconds rather than hours, and deadlines scaled down to match.
+
+WORKLOADS = {
+    # name: (callers, think time in seconds, share of HIGH/NORMAL/LOW requests)
+    "saturated": (64, 0.0, {"HIGH": 0.1, "NORMAL": 0.6, "LOW": 0.3}),
+    "ships": (200, 0.5, {"HIGH": 0.7, "NORMAL": 0.2, "LOW": 0.1}),
+    "light": (4, 0.2, {"HIGH": 0.3, "NORMAL": 0.4, "LOW": 0.3}),
+}
+
+STARTUP_MODULES = ["main", "ship", "reset", "pace_refining", "fleet_status"]
+IMPORT_BUDGET = 0.3  # seconds to import any of them in a fresh interpreter
+
+FLEET_LAYOUTS = ["dict", "slots"]
+TOKEN_LENGTH = 560  # about the length of a real agent token
+
+
+class FakeResponse:
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = json.dumps(body)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeTransport:
+    # Answers after a lognormal latency, and rejects with a 429 anything over the server's limits (ServerLimit)
+    def __init__(self, rate_limit, burst_limit, burst_period=10.0, latency=0.12, jitter=0.4, seed=0):
+        self.server_limit = ServerLimit(rate_limit, burst_limit, burst_period=burst_period)
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.sent = {}
+        self.count = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.headers = {"x-ratelimit-limit-sustained": str(rate_limit), "x-ratelimit-limit-burst": str(burst_limit),
+                        "x-ratelimit-burst-duration": str(burst_period)}
+
+    def delay(self):
+        with self.random_lock:
+            return self.latency * self.random.lognormvariate(0, self.jitter)
+
+    def request(self, method, url, headers=None, params=None, data=None):
+        request_id = headers.get("X-Benchmark-Id")
+        now = time.perf_counter()
+        with self.lock:
+            self.count += 1
+            if request_id is not None and request_id not in self.sent:
+                self.sent[request_id] = now
+        latency = self.delay()
+        time.sleep(latency / 2)
+        wait = self.server_limit.allow()
+        time.sleep(latency / 2)
+        if wait > 0:
+            with self.lock:
+                self.rejected += 1
+            body = {"error": {"message": "You have reached your API limit.", "code": 429,
+                              "data": {"retryAfter": wait}}}
+            return FakeResponse(429, body, dict(self.headers, **{"Retry-After": str(wait)}))
+        return FakeResponse(200, {"data": {}}, self.headers)
+
+    def close(self):
+        pass
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def thread_cpu_seconds(thread):
+    # CPU time used by one thread, where the OS tells us (Linux)
+    try:
+        with open("/proc/self/task/" + str(thread.native_id) + "/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (AttributeError, OSError, ValueError, IndexError):
+        return None
+
+
+def run_workload(name, duration=30.0, scale=10, latency=0.12, seed=0, policy="priority", burst_period=10.0):
+    # rpm is measured after a warm-up of one burst_period, which spends the burst pool saved up before the run, and
+    # then over whole burst periods so the pool refills once in each. A run is at least two burst periods long.
+    callers, think_time, mix = WORKLOADS[name]
+    rate_limit = 2 * scale
+    burst_limit = 10 * scale
+    transport = FakeTransport(rate_limit, burst_limit, burst_period=burst_period, latency=latency, seed=seed)
+    limiter = RateLimiter(rate_limit, burst_limit, burst_period=burst_period)
+    handler = RequestHandler(limiter=limiter, transport=transport, log=Log(stream=open(os.devnull, "w")),
+                             policy=policy, deadline_slack={p: s / scale for p, s in DEADLINE_SLACK.items()})
+    ids = itertools.count()
+    submitted = {}
+    waits = {p: [] for p in PRIORITIES}
+    completed = {p: 0 for p in PRIORITIES}
+    results_lock = threading.Lock()
+    stop = threading.Event()
+    priorities = list(mix.keys())
+    weights = list(mix.values())
+
+    def caller(caller_seed):
+        rng = random.Random(caller_seed)
+        while not stop.is_set():
+            priority = rng.choices(priorities, weights)[0]
+            request_id = str(next(ids))
+            submitted[request_id] = (time.perf_counter(), priority)
+            handler.get("benchmark", headers={"X-Benchmark-Id": request_id}, priority=priority)
+            with results_lock:
+                completed[priority] += 1
+            if think_time:
+                stop.wait(rng.uniform(0, 2 * think_time))
+
+    threads = [threading.Thread(target=caller, args=(seed * 1000 + i,), daemon=True) for i in range(callers)]
+    # the request log is still written, so its cost is in the numbers, but not to the terminal
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    stop.wait(burst_period)
+    measure_start = time.perf_counter()
+    successes_before = handler.successful_request_count
+    stop.wait(max(1, int((duration - burst_period) // burst_period)) * burst_period)
+    stop.set()
+    measure_end = time.perf_counter()
+    successes = handler.successful_request_count - successes_before
+    elapsed = measure_end - start
+    measured = measure_end - measure_start
+    for t in threads:
+        t.join(timeout=60)
+    cpu = time.process_time() - cpu_start
+    dispatcher_cpu = thread_cpu_seconds(handler.dispatcher)
+    dispatched = handler.request_count
+    handler.log.close()
+
+    for request_id, sent in list(transport.sent.items()):
+        queued, priority = submitted[request_id]
+        waits[priority].append(sent - queued)
+
+    cap = (rate_limit + burst_limit / burst_period) * 60
+    result = {
+        "workload": name,
+        "policy": policy,
+        "callers": callers,
+        "duration_s": round(elapsed, 2),
+        "measured_s": round(measured, 2),
+        "rate_limit": rate_limit,
+        "burst_limit": burst_limit,
+        "cap_rpm": cap,
+        "rpm": round(successes / measured * 60, 1),
+        "rpm_of_cap": round(successes / measured * 60 / cap, 4),
+        "requests_sent": transport.count,
+        "rate_limited": transport.rejected,
+        "client_429s": handler.rate_limited_count,
+        "cpu_ms_per_request": round(cpu / max(dispatched, 1) * 1000, 4),
+        "dispatcher_cpu_ms_per_request": None,
+        "queue_wait_ms": {},
+    }
+    if dispatcher_cpu is not None:
+        result["dispatcher_cpu_ms_per_request"] = round(dispatcher_cpu / max(dispatched, 1) * 1000, 4)
+    for priority in PRIORITIES:
+        values = waits[priority]
+        result["queue_wait_ms"][priority] = {
+            "count": completed[priority],
+            "p50": None if not values else round(percentile(values, 50) * 1000, 1),
+            "p95": None if not values else round(percentile(values, 95) * 1000, 1),
+            "p99": None if not values else round(percentile(values, 99) * 1000, 1),
+        }
+    return result
+
+
+def import_seconds(module, data_path):
+    code = "import time; start = time.perf_counter(); import " + module + "; print(time.perf_counter() - start)"
+    env = dict(os.environ, SPACECHARTERS_DATA=data_path)
+    output = subprocess.run([sys.executable, "-c", code], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    return float(output.split()[-1])
+
+
+def check_startup(repeat=3, budget=IMPORT_BUDGET):
+    # Best of repeat imports of each tool, against an empty data directory that importing mustn't create anything in
+    ok = True
+    with tempfile.TemporaryDirectory() as data_path:
+        for module in STARTUP_MODULES:
+            seconds = min(import_seconds(module, data_path) for i in range(repeat))
+            ok = ok and seconds <= budget
+            print(print_builder("import " + module, str(round(seconds * 1000, 1)) + " ms",
+                                "OK" if seconds <= budget else "over " + str(budget * 1000) + " ms", spaces=24))
+        created = os.listdir(data_path)
+    if created:
+        print("Importing opened the database:", ", ".join(sorted(created)))
+    return ok and not created
+
+
+class DictShip:
+    # A Ship laid out the way it used to be, for comparison: a __dict__ per ship, symbols as read from the database,
+    # and the system's waypoint rows copied into waypoints, with route pointing at them
+    def __init__(self, ID, Token, System):
+        self.ID = ID
+        self.Token = Token
+        self.System = System
+        self.Arrival = None
+        self.Completed = None
+        self.printID = None
+        self.Waypoint = None
+        self.Chain = None
+        self.waypoints = []
+        self.route = None
+        self.research_route = None
+        self.State = "REGISTERED"
+        self.Stop = 0
+
+    def plan_route(self):
+        from main import get_universe
+        from route_planner import plan_route
+
+        self.waypoints = get_universe().waypoints_in(self.System)
+        self.route = plan_route([wp for wp in self.waypoints if not wp[2]])
+
+
+def fleet_memory(layout, systems=12000, seed=0):
+    # One ship per system on a generated universe, each with its route planned, in layout "dict" (DictShip) or
+    # "slots" (Ship). Returns the bytes the fleet holds per ship, as counted by tracemalloc and by resident memory.
+    import main
+    from mock_server import generate_universe
+
+    universe = generate_universe(systems, seed)
+    rows = []
+    for symbol, wp in universe["waypoints"].items():
+        rows.append((symbol, wp["systemSymbol"], wp["charted"], "MARKETPLACE" in wp["traits"],
+                     "SHIPYARD" in wp["traits"], wp["type"] == "JUMP_GATE", wp["x"], wp["y"]))
+    main.universe.load(rows)
+    if layout == "slots":
+        from ship import Ship
+    else:
+        Ship = DictShip
+    # names and symbols as they come out of the database: new strings, not the universe's copies
+    accounts = [(("ZCHART-" + system + ".")[:-1], ("%08d" % i).ljust(TOKEN_LENGTH, "x"), (system + ".")[:-1])
+                for i, system in enumerate(universe["systems"])]
+    del universe, rows
+
+    tracemalloc.start()
+    rss_before = resident_bytes()
+    fleet = []
+    for ID, token, system in accounts:
+        s = Ship(ID, token, system)
+        s.plan_route()
+        fleet.append(s)
+    del accounts
+    traced = tracemalloc.get_traced_memory()[0]
+    rss = resident_bytes() - rss_before
+    tracemalloc.stop()
+    return {"layout": layout, "ships": len(fleet), "waypoints": len(main.universe.symbols),
+            "traced_bytes_per_ship": round(traced / len(fleet)), "resident_bytes_per_ship": round(rss / len(fleet))}
+
+
+def resident_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def check_memory(systems=12000):
+    # Each layout in a fresh interpreter, so one doesn't reuse memory the other freed
+    results = []
+    for layout in FLEET_LAYOUTS:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--fleet-layout", layout,
+                                 "--systems", str(systems)], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.splitlines()[-1]))
+    for result in results:
+        print(result["layout"] + ":", result["ships"], "ships,", result["waypoints"], "waypoints,",
+              result["traced_bytes_per_ship"], "bytes per ship allocated,", result["resident_bytes_per_ship"],
+              "resident")
+    before, after = results[0], results[-1]
+    print("Saved per ship:", before["traced_bytes_per_ship"] - after["traced_bytes_per_ship"], "bytes allocated (" +
+          str(round((1 - after["traced_bytes_per_ship"] / before["traced_bytes_per_ship"]) * 100, 1)) + "%),",
+          before["resident_bytes_per_ship"] - after["resident_bytes_per_ship"], "resident")
+    return results
+
+
+def print_result(result):
+    print(result["workload"] + ",", result["policy"] + ":", result["callers"], "callers,", result["duration_s"], "s")
+    print("  Sustained rpm:", result["rpm"], "of", result["cap_rpm"], "(" + str(round(result["rpm_of_cap"] * 100, 1)) +
+          "%) over the last", result["measured_s"], "s")
+    print("  429s:", result["rate_limited"], "of", result["requests_sent"], "requests")
+    print("  CPU per request (ms):", result["cpu_ms_per_request"], " dispatcher:",
+          result["dispatcher_cpu_ms_per_request"])
+    for priority, waits in result["queue_wait_ms"].items():
+        print("  " + priority, "queue wait (ms): p50", waits["p50"], " p95", waits["p95"], " p99", waits["p99"],
+              " (" + str(waits["count"]) + " requests)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RequestHandler benchmark")
+    parser.add_argument("workloads", nargs="*", default=list(WORKLOADS))
+    parser.add_argument("--duration", type=float, default=30.0,
+                        help="seconds per run, the first 10 of them a warm-up that isn't counted in rpm")
+    parser.add_argument("--scale", type=int, default=10, help="multiply the 2/s + 10/10s limits by this")
+    parser.add_argument("--latency", type=float, default=0.12, help="median request latency in seconds")
+    parser.add_argument("--policy", nargs="+", default=POLICIES, choices=POLICIES,
+                        help="dispatch policies to compare on each workload")
+    parser.add_argument("--output", default="benchmark_results.jsonl")
+    parser.add_argument("--startup", action="store_true",
+                        help="check every tool imports within IMPORT_BUDGET without touching the database, and exit")
+    parser.add_argument("--memory", action="store_true",
+                        help="compare bytes per ship for a fleet with one ship per system, and exit")
+    parser.add_argument("--systems", type=int, default=12000, help="universe size for --memory")
+    parser.add_argument("--fleet-layout", choices=FLEET_LAYOUTS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup:
+        sys.exit(0 if check_startup() else 1)
+    if args.fleet_layout:
+        print(json.dumps(fleet_memory(args.fleet_layout, args.systems)))
+        return
+    if args.memory:
+        for result in check_memory(args.systems):
+            result["timestamp"] = datetime.datetime.utcnow().isoformat()
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result) + "\n")
+        return
+
+    for name in args.workloads:
+        for policy in args.policy:
+            # same seed for every policy, so they all see the same callers asking for the same things
+            result = run_workload(name, args.duration, args.scale, args.latency, policy=policy)
+            result["timestamp"] = datetime.datetime.utcnow().isoformat()
+            print_result(result)
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+from main import *
+from ship import CHARTING, DONE, STATES, Ship
+
+
+def fleet_status():
+    # Every agent's saved state, read straight from the database: no API calls
+    db_flush()
+    plan = load_plan()
+    ships = []
+    for agent in db_get("Agents"):
+        chain = None
+        if agent[0] in plan.keys():
+            chain = plan[agent[0]][1]
+        ships.append(Ship(*agent[:5], Waypoint=agent[5], Chain=chain, State=agent_state(agent),
+                          Stop=agent_stop(agent)))
+    return ships
+
+
+def main():
+    ships = fleet_status()
+    now = datetime.datetime.utcnow()
+    print("Agents:", len(ships))
+    counts = ship_states(ships)
+    for state in STATES:
+        count = counts.get((state,), 0)
+        if ships:
+            print(print_builder(state, count, str(round(count / len(ships) * 100, 1)) + "%", spaces=12))
+
+    in_transit = [s.Arrival for s in ships if s.State != DONE and s.Arrival is not None and s.Arrival > now]
+    print("In transit:", len(in_transit))
+    if in_transit:
+        print("Next arrival in:", min(in_transit) - now, " Last arrival in:", max(in_transit) - now)
+    print("Stops charted by ships still charting:", sum(s.Stop for s in ships if s.State == CHARTING))
+
+    chained = [s for s in ships if s.Chain is not None]
+    if chained:
+        legs = sum(len(s.Chain) for s in chained)
+        done = sum(len(s.Chain) if s.State == DONE else s.leg() for s in chained)
+        print("Planned systems finished:", done, "of", legs)
+    print("Waypoints left to chart:", get_universe().uncharted_count())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import collections
+import threading
+
+
+class KeyCache:
+    # Remembers which (waypoint, symbol) pairs are already in a table, most recently used first.
+    # While nothing has been evicted the cache holds every pair, so a miss means the waypoint isn't logged
+    # and no database lookup is needed. Once it has had to evict, misses have to be checked against the database.
+    def __init__(self, max_size: int = 50000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.warmed = False
+        self.complete = True
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def warm(self, rows):
+        with self.lock:
+            if self.warmed:
+                return
+            for waypoint, symbol in rows:
+                self.__add(waypoint, symbol)
+            self.warmed = True
+
+    def get(self, waypoint):
+        # the set of known symbols, or None if the database has to be asked
+        with self.lock:
+            symbols = self.entries.get(waypoint)
+            if symbols is not None:
+                self.entries.move_to_end(waypoint)
+                self.hits += 1
+                return set(symbols)
+            self.misses += 1
+            if self.complete:
+                return set()
+            return None
+
+    def put(self, waypoint, symbols):
+        with self.lock:
+            old = self.entries.pop(waypoint, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[waypoint] = set(symbols)
+            self.size += len(symbols)
+            self.__evict()
+
+    def add(self, waypoint, symbol):
+        with self.lock:
+            self.__add(waypoint, symbol)
+
+    def __add(self, waypoint, symbol):
+        symbols = self.entries.get(waypoint)
+        if symbols is None:
+            symbols = set()
+            self.entries[waypoint] = symbols
+        else:
+            self.entries.move_to_end(waypoint)
+        if symbol not in symbols:
+            symbols.add(symbol)
+            self.size += 1
+            self.__evict()
+
+    def __evict(self):
+        while self.size > self.max_size and len(self.entries) > 1:
+            _, symbols = self.entries.popitem(last=False)
+            self.size -= len(symbols)
+            self.complete = False
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.warmed = False
+            self.complete = True
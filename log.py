@@ -0,0 +1,141 @@
+import atexit
+import collections
+import sys
+import threading
+import time
+
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "OFF": 100}
+
+
+def parse_levels(spec):
+    # "requests=WARNING,ships=DEBUG" -> {"requests": 30, "ships": 10}
+    levels = {}
+    if spec:
+        for part in spec.split(","):
+            category, _, level = part.partition("=")
+            if level.strip().upper() not in LEVELS:
+                raise ValueError("Unknown log level: " + part)
+            levels[category.strip()] = LEVELS[level.strip().upper()]
+    return levels
+
+
+class Log:
+    # Logging that never makes the caller wait: log() only appends a record to a deque, and one background thread
+    # formats and writes everything queued every interval seconds. Each category has its own level.
+    # progress() lines are rate-limited: only the latest one per category is written each progress_every seconds,
+    # with a count of the ones skipped, unless that category is set to DEBUG.
+    def __init__(self, stream=None, levels=None, default_level="INFO", progress_every=1.0, interval=0.1,
+                 max_records=100000):
+        self.stream = stream
+        self.levels = dict(levels or {})
+        self.default_level = LEVELS[default_level]
+        self.progress_every = progress_every
+        self.interval = interval
+        self.max_records = max_records
+        self.records = collections.deque()
+        self.progress_lines = {}
+        self.last_progress = {}
+        self.dropped = 0
+        self.written = 0
+        self.wake = threading.Event()
+        self.write_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+        atexit.register(self.close)
+
+    def level(self, category):
+        return self.levels.get(category, self.default_level)
+
+    def set_level(self, category, level):
+        self.levels[category] = LEVELS[level]
+
+    def enabled(self, category, level="INFO"):
+        return LEVELS[level] >= self.level(category)
+
+    def log(self, category, *args, level="INFO", format=None):
+        # format, if given, is called with args on the writer thread to build the line
+        if LEVELS[level] < self.level(category):
+            return
+        self.__append((category, args, format, False))
+
+    def debug(self, category, *args, format=None):
+        self.log(category, *args, level="DEBUG", format=format)
+
+    def info(self, category, *args, format=None):
+        self.log(category, *args, level="INFO", format=format)
+
+    def warning(self, category, *args, format=None):
+        self.log(category, *args, level="WARNING", format=format)
+
+    def error(self, category, *args, format=None):
+        self.log(category, *args, level="ERROR", format=format)
+
+    def progress(self, category, *args, format=None):
+        level = self.level(category)
+        if LEVELS["INFO"] < level:
+            return
+        self.__append((category, args, format, level > LEVELS["DEBUG"]))
+
+    def __append(self, record):
+        if len(self.records) >= self.max_records:
+            self.dropped += 1
+            return
+        self.records.append(record)
+        if self.thread is None:
+            self.__start()
+
+    def __start(self):
+        with self.start_lock:
+            if self.thread is None and not self.closed:
+                self.thread = threading.Thread(target=self.__run, name="LogWriter", daemon=True)
+                self.thread.start()
+
+    def __run(self):
+        while not self.closed:
+            self.wake.wait(self.interval)
+            self.flush()
+
+    def flush(self, force=False):
+        with self.write_lock:
+            lines = []
+            while self.records:
+                category, args, format, collapse = self.records.popleft()
+                if collapse:
+                    previous = self.progress_lines.get(category)
+                    skipped = 0 if previous is None else previous[2] + 1
+                    self.progress_lines[category] = (args, format, skipped)
+                    continue
+                lines.append(self.__format(args, format))
+
+            now = time.monotonic()
+            for category, (args, format, skipped) in list(self.progress_lines.items()):
+                if force or now - self.last_progress.get(category, -self.progress_every) >= self.progress_every:
+                    line = self.__format(args, format)
+                    if skipped:
+                        line += "  (+" + str(skipped) + ")"
+                    lines.append(line)
+                    del self.progress_lines[category]
+                    self.last_progress[category] = now
+
+            if lines:
+                stream = self.stream if self.stream is not None else sys.stdout
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+                self.written += len(lines)
+
+    @staticmethod
+    def __format(args, format):
+        if format is not None:
+            return format(*args)
+        return " ".join(str(a) for a in args)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wake.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+        self.flush(force=True)
@@ -1,25 +1,99 @@
-import math
+import concurrent.futures
+import functools
+import sys
 import threading
 import time
 
-import pyodbc
 import os
 import datetime
 
-from make_requests import RequestHandler
-
-base_path = os.path.dirname(__file__)
-db_path = os.path.join(base_path, "SpaceCharters.accdb")
-
-driver = 'Driver={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=' + db_path
-conn = pyodbc.connect(driver)
-conn.autocommit = True
-
-cursor = conn.cursor()
-
-rh = RequestHandler()
-
-db_lock = threading.Lock()
+from key_cache import KeyCache
+from log import Log, parse_levels
+from make_requests import API_URL, RequestHandler, print_builder
+from metrics import MetricsRegistry
+from registration import RegistrationPipeline
+from response_cache import ResponseCache
+from storage import AccessStorage, SqliteStorage
+from universe import UniverseIndex
+from write_behind import WriteBehind
+
+
+class Config:
+    # Everything the program reads from the environment
+    def __init__(self, environ=os.environ):
+        self.base_path = environ.get("SPACECHARTERS_DATA", os.path.dirname(__file__))
+        self.db_path = os.path.join(self.base_path, "SpaceCharters.accdb")
+        self.sqlite_path = os.path.join(self.base_path, "SpaceCharters.sqlite3")
+        self.journal_path = os.path.join(self.base_path, "SpaceCharters.journal")
+        self.cache_path = os.path.join(self.base_path, "SpaceCharters.cache")
+        self.db_backend = environ.get("SPACECHARTERS_DB", "access" if sys.platform == "win32" else "sqlite")
+        self.api_url = environ.get("SPACETRADERS_API", API_URL)
+        self.scheduling = environ.get("SPACECHARTERS_SCHEDULING", "priority")
+        self.log_levels = parse_levels(environ.get("SPACECHARTERS_LOG"))  # e.g. SPACECHARTERS_LOG=requests=WARNING
+        self.metrics_port = environ.get("SPACECHARTERS_METRICS_PORT")
+        self.metrics_file = environ.get("SPACECHARTERS_METRICS_FILE")
+
+
+class App:
+    # The database, the write-behind queue and the request handler, each created the first time it's used, so
+    # importing main opens nothing and tools that never touch the database never open it.
+    def __init__(self, config: Config, log: Log, metrics: MetricsRegistry):
+        self.config = config
+        self.log = log
+        self.metrics = metrics
+        self.parts = {}
+        self.lock = threading.RLock()
+
+    def __part(self, name, create):
+        part = self.parts.get(name)
+        if part is None:
+            with self.lock:
+                part = self.parts.get(name)
+                if part is None:
+                    part = self.parts[name] = create()
+        return part
+
+    @property
+    def storage(self):
+        return self.__part("storage", self.__create_storage)
+
+    @property
+    def writer(self) -> WriteBehind:
+        return self.__part("writer", self.__create_writer)
+
+    @property
+    def rh(self) -> RequestHandler:
+        return self.__part("rh", self.__create_request_handler)
+
+    def __create_storage(self):
+        if self.config.db_backend == "access":
+            return AccessStorage(self.config.db_path)
+        return SqliteStorage(self.config.sqlite_path)
+
+    def __create_writer(self):
+        return WriteBehind(self.storage, journal_path=self.config.journal_path, metrics=self.metrics, log=self.log)
+
+    def __create_request_handler(self):
+        return RequestHandler(base_url=self.config.api_url, cache=ResponseCache(self.config.cache_path),
+                              metrics=self.metrics, log=self.log, policy=self.config.scheduling)
+
+
+config = Config()
+log = Log(levels=config.log_levels)
+metrics = MetricsRegistry()
+metrics_server = None
+metrics_writer = None
+started = time.time()
+
+app = App(config, log, metrics)
+
+universe = UniverseIndex()
+universe_lock = threading.Lock()  # so only one thread loads it
+
+market_cache = KeyCache()
+shipyard_cache = KeyCache()
+
+charted_counter = metrics.counter("waypoints_charted_total", "Waypoints charted since the program started")
 
 
 def time_str_to_datetime(time_str: str or datetime.datetime) -> datetime.datetime:
@@ -31,152 +105,199 @@ def time_str_to_datetime(time_str: str or datetime.datetime) -> datetime.datetim
 
 
 def register(agent_name, faction, system, priority="NORMAL"):
+    if faction is None:
+        faction = closest_faction(system)
     payload = {
         "faction": faction,
         "symbol": agent_name
     }
-    response = rh.post("register", payload, token=None, priority=priority).json()
-
-    db_insert("Agents", ["ID", "Token", "System"], [agent_name, response["data"]["token"], system])
-
-    return response
+    response = app.rh.post("register", payload, token=None, priority=priority).json()
+    return registered(agent_name, system, response)
 
 
-def orbit(agent, token, priority="NORMAL"):
+def orbit(agent, token, priority="NORMAL", deadline=None):
     ship_name = agent + "-1"
     endpoint = "my/ships/" + ship_name + "/orbit"
-    return rh.post(endpoint, token=token, priority=priority).json()
+    return app.rh.post(endpoint, token=token, priority=priority, deadline=deadline).json()
 
 
-def drift(agent, token, priority="NORMAL"):
+def drift(agent, token, priority="NORMAL", deadline=None):
     ship_name = agent + "-1"
     endpoint = "my/ships/" + ship_name + "/nav"
     payload = {"flightMode": "DRIFT"}
 
-    response = rh.patch(endpoint, payload, token=token, priority=priority).json()
+    response = app.rh.patch(endpoint, payload, token=token, priority=priority, deadline=deadline).json()
     return response
 
 
-def warp(agent, token, waypoint, priority="NORMAL"):
+def warp(agent, token, waypoint, priority="NORMAL", deadline=None):
     ship_name = agent + "-1"
     endpoint = "my/ships/" + ship_name + "/warp"
     payload = {"waypointSymbol": waypoint}
 
-    response = rh.post(endpoint, payload, token=token, priority=priority).json()
-    try:
-        arrival_time = time_str_to_datetime(response["data"]["nav"]["route"]["arrival"])
-    except KeyError:
-        if response["error"]["code"] == 4236:  # not in orbit
-            orbit(agent, token, priority="HIGH")
-            drift(agent, token, priority="HIGH")
-            return warp(agent, token, waypoint)
-        elif response["error"]["code"] == 4203:  # not enough fuel
-            drift(agent, token, priority="HIGH")
-            return warp(agent, token, waypoint)
-        elif response["error"]["code"] == 4214:  # in transit
-            response = {"data": {"nav": {"route": {"arrival": response["error"]["data"]["arrival"]}}}}
-            waypoint = response["error"]["data"]["destinationSymbol"]
-            arrival_time = time_str_to_datetime(response["data"]["nav"]["route"]["arrival"])
-        elif response["error"]["code"] == 4235:  # destination in same system
-            return nav(agent, token, waypoint, priority=priority)
-        else:
-            print(response["error"])
-            raise KeyError
-
-    db_update("Agents", ["Arrival", "Waypoint"], [arrival_time, waypoint], ["ID"], [agent])
+    response = app.rh.post(endpoint, payload, token=token, priority=priority, deadline=deadline).json()
+    code = needs_drift(response)
+    while code:
+        if code == 4236:  # not in orbit
+            orbit(agent, token, priority="HIGH", deadline=deadline)
+        drift(agent, token, priority="HIGH", deadline=deadline)  # not enough fuel to warp any faster
+        response = app.rh.post(endpoint, payload, token=token, priority=priority, deadline=deadline).json()
+        code = needs_drift(response)
+    arrival = arrived(agent, waypoint, response)
+    if arrival is None:  # destination in same system
+        return nav(agent, token, waypoint, priority=priority, deadline=deadline)
+    return arrival
+
+
+def jump(agent, token, system, priority="NORMAL", deadline=None):
+    ship_name = agent + "-1"
+    endpoint = "my/ships/" + ship_name + "/jump"
+    payload = {"systemSymbol": system}
 
-    return response
+    response = app.rh.post(endpoint, payload, token=token, priority=priority, deadline=deadline).json()
+    return jumped(agent, response)
 
 
-def chart(agent, token, priority="NORMAL"):
+def chart(agent, token, priority="NORMAL", deadline=None):
     ship_name = agent + "-1"
     endpoint = "my/ships/" + ship_name + "/chart"
 
-    response = rh.post(endpoint, token=token, priority=priority)
-    if response.status_code == 201:
-        data = response.json()["data"]
-        waypoint = data["waypoint"]["symbol"]
-        db_update("Waypoints", ["Charted"], [True], ["Waypoint"], [waypoint])
-        return response.json()
-    return False
+    response = app.rh.post(endpoint, token=token, priority=priority, deadline=deadline)
+    return charted(response)
 
 
-def get_waypoint(token, waypoint, priority="NORMAL"):
+def get_waypoint(token, waypoint, priority="NORMAL", deadline=None):
     system = waypoint_to_system(waypoint)
     endpoint = "systems/" + system + "/waypoints/" + waypoint
 
-    response = rh.get(endpoint, token=token, priority=priority)
+    response = app.rh.get(endpoint, token=token, priority=priority, deadline=deadline).json()
+    update_waypoint_traits(response["data"])
+    return response
 
-    wp = response.json()["data"]
-    update_waypoint_traits(wp)
 
-    return response.json()
+def list_waypoints(token, system, priority="NORMAL", deadline=None):
+    waypoints_list = fetch_waypoints(system, token=token, priority=priority, deadline=deadline)
+    for wp in waypoints_list:
+        update_waypoint_traits(wp)
+    return waypoints_list
 
 
-def list_waypoints(token, system, priority="NORMAL"):
+def fetch_waypoints(system, token=None, priority="NORMAL", deadline=None):
     endpoint = "systems/" + system + "/waypoints"
     waypoints_list = []
     all_collected = False
     page = 1
     while not all_collected:
-        params = {
-            "limit": 20,
-            "page": page
-        }
-        response = rh.get(endpoint, token=token, params=params, priority=priority).json()
-        data = response["data"]
-        for wp in data:
-            waypoints_list.append(wp)
-            update_waypoint_traits(wp)
-        if len(waypoints_list) == response["meta"]["total"]:
-            all_collected = True
+        response = app.rh.get(endpoint, token=token, params=waypoints_page(page), priority=priority,
+                              deadline=deadline).json()
+        all_collected = add_waypoints(waypoints_list, response)
         page += 1
     return waypoints_list
 
 
-def nav(agent, token, waypoint, priority="NORMAL"):
+def nav(agent, token, waypoint, priority="NORMAL", deadline=None):
     ship_name = agent + "-1"
     endpoint = "my/ships/" + ship_name + "/navigate"
     payload = {"waypointSymbol": waypoint}
 
-    response = rh.post(endpoint, payload, token=token, priority=priority).json()
+    response = app.rh.post(endpoint, payload, token=token, priority=priority, deadline=deadline).json()
+    return arrived(agent, waypoint, response)
+
+
+# The wrappers' handling of what comes back, shared with the async versions in async_ship.py so the two can't drift
+# apart. Each takes the parsed response (chart's takes the Response, as only its status code says whether it worked).
+
+def registered(agent_name, system, response):
+    db_insert("Agents", ["ID", "Token", "System"], [agent_name, response["data"]["token"], system])
+    return response
+
+
+def needs_drift(response):
+    # The warp errors that orbiting and drifting fix: 4236 not in orbit, 4203 not enough fuel to warp any faster
+    if "error" in response and response["error"]["code"] in [4236, 4203]:
+        return response["error"]["code"]
+    return None
+
+
+def arrived(agent, waypoint, response):
+    # Records when and where a warp or navigate leaves the ship and returns the response,
+    # or None when a warp's destination is in the same system and needs a nav instead
     try:
         arrival_time = time_str_to_datetime(response["data"]["nav"]["route"]["arrival"])
     except KeyError:
         if response["error"]["code"] == 4214:  # in transit
-            response = {"data": {"nav": {"route": {"arrival": response["error"]["data"]["arrival"]}}}}
             waypoint = response["error"]["data"]["destinationSymbol"]
+            response = {"data": {"nav": {"route": {"arrival": response["error"]["data"]["arrival"]}}}}
             arrival_time = time_str_to_datetime(response["data"]["nav"]["route"]["arrival"])
         elif response["error"]["code"] == 4204:  # already at destination
             response = {"data": {"nav": {"route": {"arrival": datetime.datetime.utcnow()}}}}
             arrival_time = datetime.datetime.utcnow()
+        elif response["error"]["code"] == 4235:  # destination in same system
+            return None
         else:
-            print(response["error"])
+            log.warning("api", response["error"])
             raise KeyError
     db_update("Agents", ["Arrival", "Waypoint"], [arrival_time, waypoint], ["ID"], [agent])
     return response
 
 
-def get_market(token, waypoint, priority="NORMAL"):
+def jumped(agent, response):
+    try:
+        waypoint = response["data"]["nav"]["waypointSymbol"]
+    except KeyError:
+        log.warning("api", response["error"])
+        return False
+
+    db_update("Agents", ["Arrival", "Waypoint"], [datetime.datetime.utcnow(), waypoint], ["ID"], [agent])
+    return response
+
+
+def charted(response):
+    if response.status_code == 201:
+        data = response.json()["data"]
+        waypoint = data["waypoint"]["symbol"]
+        set_waypoint_flag(waypoint, "Charted", True)
+        return response.json()
+    return False
+
+
+def waypoints_page(page):
+    return {
+        "limit": 20,
+        "page": page
+    }
+
+
+def add_waypoints(waypoints_list, response):
+    # Adds a page of a system's waypoints; True once they're all in, or a page comes back empty
+    data = response["data"]
+    for wp in data:
+        waypoints_list.append(wp)
+    return len(waypoints_list) >= response["meta"]["total"] or not data
+
+
+def located(agent, response):
+    db_update("Agents", ["Waypoint"], [response["data"]["nav"]["waypointSymbol"]], ["ID"], [agent])
+    return response
+
+
+def get_market(token, waypoint, priority="NORMAL", deadline=None):
     system = waypoint_to_system(waypoint)
     endpoint = "systems/" + system + "/waypoints/" + waypoint + "/market"
-    response = rh.get(endpoint, token=token, priority=priority).json()
-    market = response["data"]
-    existing_market_data = db_get("Markets")
-    market_logged = False
-    for x in existing_market_data:
-        if x[1] == waypoint:
-            market_logged = True
-    if not market_logged:
-        for export in market["exports"]:
-            db_insert("Markets", ["Waypoint", "Symbol"], [waypoint, export["symbol"]])
-            db_update("Markets", ["isExport"], [True], ["Waypoint", "Symbol"], [waypoint, export["symbol"]])
-        for import_ in market["imports"]:
-            db_insert("Markets", ["Waypoint", "Symbol"], [waypoint, import_["symbol"]])
-            db_update("Markets", ["isImport"], [True], ["Waypoint", "Symbol"], [waypoint, import_["symbol"]])
-        for exchange in market["exchange"]:
-            db_insert("Markets", ["Waypoint", "Symbol"], [waypoint, exchange["symbol"]])
-            db_update("Markets", ["isExchange"], [True], ["Waypoint", "Symbol"], [waypoint, exchange["symbol"]])
+    response = app.rh.get(endpoint, token=token, priority=priority, deadline=deadline).json()
+    log_market(waypoint, response["data"])
+    return response
+
+
+def log_market(waypoint, market):
+    known_symbols = known_keys(market_cache, "Markets", "Symbol", waypoint)
+    for flag, key in [("isExport", "exports"), ("isImport", "imports"), ("isExchange", "exchange")]:
+        for good in market[key]:
+            if good["symbol"] not in known_symbols:
+                db_insert("Markets", ["Waypoint", "Symbol"], [waypoint, good["symbol"]])
+                known_symbols.add(good["symbol"])
+                market_cache.add(waypoint, good["symbol"])
+            db_update("Markets", [flag], [True], ["Waypoint", "Symbol"], [waypoint, good["symbol"]])
 
     if "tradeGoods" in market.keys():
         for tg in market["tradeGoods"]:
@@ -184,194 +305,426 @@ def get_market(token, waypoint, priority="NORMAL"):
                       [tg["tradeVolume"], tg["supply"], tg["purchasePrice"], tg["sellPrice"], datetime.datetime.utcnow()],
                       ["Waypoint", "Symbol"], [waypoint, tg["symbol"]])
 
-    return response
 
-
-def get_shipyard(token, waypoint, priority="NORMAL"):
+def get_shipyard(token, waypoint, priority="NORMAL", deadline=None):
     system = waypoint_to_system(waypoint)
     endpoint = "systems/" + system + "/waypoints/" + waypoint + "/shipyard"
-    response = rh.get(endpoint, token=token, priority=priority).json()
-    shipyard = response["data"]
-    existing_shipyard_data = db_get("Shipyards")
-    shipyard_logged = False
-    for x in existing_shipyard_data:
-        if x[1] == waypoint:
-            shipyard_logged = True
+    response = app.rh.get(endpoint, token=token, priority=priority, deadline=deadline).json()
+    log_shipyard(waypoint, response["data"])
+    return response
+
 
+def log_shipyard(waypoint, shipyard):
+    known_types = known_keys(shipyard_cache, "Shipyards", "ShipType", waypoint)
     for ship in shipyard["ships"]:
-        if not shipyard_logged:
+        if ship["type"] not in known_types:
             db_insert("Shipyards", ["Waypoint", "ShipType", "ShipName"], [waypoint, ship["type"], ship["name"]])
+            known_types.add(ship["type"])
+            shipyard_cache.add(waypoint, ship["type"])
         db_update("Shipyards", ["PurchasePrice", "timestamp"], [ship["purchasePrice"], datetime.datetime.utcnow()],
                   ["Waypoint", "ShipType"], [waypoint, ship["type"]])
-    return response
 
 
-def get_ship(agent, token, priority="NORMAL"):
+def known_keys(cache, table_name, column, waypoint):
+    if not cache.warmed:
+        db_flush()
+        cache.warm(app.storage.stream("SELECT Waypoint, " + column + " FROM " + table_name))
+    known = cache.get(waypoint)
+    if known is None:
+        db_flush()
+        known = set()
+        for x in app.storage.query("SELECT " + column + " FROM " + table_name + " WHERE Waypoint = ?", (waypoint,)):
+            known.add(x[0])
+        cache.put(waypoint, known)
+    return known
+
+
+def get_ship(agent, token, priority="NORMAL", deadline=None):
     endpoint = "my/ships/" + agent + "-1"
-    response = rh.get(endpoint, token=token, priority=priority).json()
-    db_update("Agents", ["Waypoint"], [response["data"]["nav"]["waypointSymbol"]], ["ID"], [agent])
-    return response
+    response = app.rh.get(endpoint, token=token, priority=priority, deadline=deadline).json()
+    return located(agent, response)
 
 
 def db_insert(table_name, column_name_list, value_list):
-    with db_lock:
-        cmd = "INSERT INTO " + table_name + "(" + column_name_list[0]
-        for col_name in column_name_list[1:]:
-            cmd += ", " + col_name
-        cmd += ") VALUES ('" + str(value_list[0])
-        for value in value_list[1:]:
-            cmd += "', '" + str(value)
-        cmd += "');"
-        cursor.execute(cmd)
+    app.writer.insert(table_name, column_name_list, value_list)
 
 
 def db_update(table_name, update_column_name_list, update_value_list, where_column_name_list, where_value_list):
-    with db_lock:
-        cmd = "UPDATE " + table_name + " SET " + table_name + "." + update_column_name_list[0] + ' = ?'
-        for i in range(1, len(update_column_name_list)):
-            cmd += ", " + table_name + "." + update_column_name_list[i] + ' = ?'
-        cmd += " WHERE (((" + table_name + "." + where_column_name_list[0] + ')=?)'
-        for i in range(1, len(where_column_name_list)):
-            cmd += " AND ((" + table_name + "." + where_column_name_list[i] + ')=?)'
-        cmd += ");"
-        params = tuple(update_value_list + where_value_list)
-        cursor.execute(cmd, params)
+    app.writer.update(table_name, update_column_name_list, update_value_list, where_column_name_list, where_value_list)
 
 
 def db_get(table_name):
-    with db_lock:
-        cmd = "SELECT * FROM " + table_name
-        cursor.execute(cmd)
-        data = []
-        for x in cursor:
-            data.append(x)
-
-    return data
+    app.writer.flush()
+    return app.storage.get(table_name)
 
 
 def db_get_where(table_name, where_column_names, where_values):
-    with db_lock:
-        cmd = "SELECT * FROM " + table_name + " WHERE (((" + table_name + "." + where_column_names[0] + ")=?)"
-        for i in range(1, len(where_column_names)):
-            cmd += " AND ((" + table_name + "." + where_column_names[i] + ')=?)'
-        cmd += ");"
-        params = tuple(where_values)
-        cursor.execute(cmd, params)
-        data = []
-        for x in cursor:
-            data.append(x)
-    return data
+    app.writer.flush()
+    return app.storage.get_where(table_name, where_column_names, where_values)
+
+
+def db_iterate(table_name):
+    # Streams the table a few hundred rows at a time instead of loading it into a list first
+    app.writer.flush()
+    return app.storage.iterate(table_name)
+
+
+def db_flush():
+    app.writer.flush()
 
 
 def get_factions():
     endpoint = "factions"
     querystring = {"limit": "20"}
 
-    response = rh.get(endpoint, querystring, priority="LOW").json()
+    response = app.rh.get(endpoint, querystring, priority="LOW").json()
     return response
 
 
 def populate_systems():
+    from spatial import SpatialIndex  # numpy takes a third of main's import time, and few runs get this far
+
     endpoint = "systems.json"
-    systems = rh.get(endpoint).json()
+    systems = app.rh.get(endpoint).json()
     factions = get_factions()["data"]
+    positions = {}
+    for s in systems:
+        positions[s["symbol"]] = (s["x"], s["y"])
     for f in factions:
         hq = f["headquarters"]
-        system = waypoint_to_system(hq)
-        x = None
-        y = None
-        for s in systems:
-            if s["symbol"] == system:
-                x = s["x"]
-                y = s["y"]
-        f["x"] = x
-        f["y"] = y
+        f["x"], f["y"] = positions.get(waypoint_to_system(hq), (None, None))
+
+    clear_table("Factions")
+    app.storage.upsert_many("Factions", ["Faction", "Headquarters", "System", "x", "y"], ["Faction"],
+                            [(f["symbol"], f["headquarters"], waypoint_to_system(f["headquarters"]), f["x"], f["y"])
+                             for f in factions])
 
     print("Populating Systems:")
+    with_coords = [f for f in factions if f["x"] is not None]
+    headquarters = SpatialIndex([f["symbol"] for f in with_coords], [(f["x"], f["y"]) for f in with_coords])
+    closest = headquarters.nearest(list(positions.values()))
+    rows = []
+    for s, (distance, faction) in zip(systems, closest):
+        rows.append((s["symbol"], s["x"], s["y"], faction, distance))
+
     clear_table("Systems")
-    for s in systems:
-        x = s["x"]
-        y = s["y"]
+    app.storage.upsert_many("Systems", ["System", "x", "y", "closestFaction", "distanceFromFaction"], ["System"],
+                            rows)
+    print(len(rows), "systems")
+
+
+def get_faction_headquarters():
+    headquarters = {}
+    for faction, x, y in app.storage.query("SELECT Faction, x, y FROM Factions"):
+        if x is not None:
+            headquarters[faction] = (x, y)
+    return headquarters
+
+
+def closest_faction(system):
+    from spatial import SpatialIndex
+
+    row = app.storage.query("SELECT x, y FROM Systems WHERE System = ?", (system,))[0]
+    headquarters = get_faction_headquarters()
+    return SpatialIndex.from_positions(headquarters).nearest([row])[0][1]
+
+
+def load_plan():
+    # {agent: (faction, [(system, via), ...])} in the order the accounts should be launched
+    db_flush()
+    plan = {}
+    for account, agent, leg, system, faction, via in app.storage.stream(
+            "SELECT Account, ID, Leg, System, Faction, Via FROM Plans ORDER BY Account, Leg"):
+        if agent not in plan:
+            plan[agent] = (faction, [])
+        plan[agent][1].append((sys.intern(system), sys.intern(via)))
+    return plan
+
+
+def save_plan(chains):
+    plan = {}
+    rows = []
+    for account, (faction, legs) in enumerate(chains):
+        legs = [(sys.intern(system), via) for system, via in legs]
+        agent = "ZCHART-" + legs[0][0]
+        plan[agent] = (faction, legs)
+        for leg, (system, via) in enumerate(legs):
+            rows.append((account, agent, leg, system, faction, via))
+    clear_table("Plans")
+    app.storage.write_batch([(("insert", "Plans", ("Account", "ID", "Leg", "System", "Faction", "Via"), None), rows)])
+    return plan
+
+
+token_pool_lock = threading.Lock()
+empty_token_pools = set()
+
+
+def fill_token_pool(size, priority="LOW"):
+    # Registers agents for the first `size` planned accounts ahead of time, from the factions the plan starts them at,
+    # so those ships launch without waiting to be registered. Run right after the weekly reset.
+    needed = {}
+    for agent_name, (faction, legs) in list(load_plan().items())[:size]:
+        needed[faction] = needed.get(faction, 0) + 1
+    pool = db_get("Tokens")
+    for row in pool:
+        if not row[3] and row[2] in needed.keys():
+            needed[row[2]] -= 1
+    n = len(pool)
+    for faction, count in needed.items():
+        while count > 0:
+            n += 1
+            agent_name = "ZPOOL-" + str(n).zfill(6)
+            payload = {"faction": faction, "symbol": agent_name}
+            response = app.rh.post("register", payload, token=None, priority=priority).json()
+            if "data" not in response:
+                log.warning("api", response["error"])
+                if response["error"]["code"] != 4111:  # anything but the name being taken
+                    break
+                continue
+            db_insert("Tokens", ["ID", "Token", "Faction"], [agent_name, response["data"]["token"], faction])
+            count -= 1
+    empty_token_pools.clear()
+
+
+def take_pooled_agent(faction, system):
+    # An agent from the token pool for faction, now charting system, or None if the pool has none left
+    with token_pool_lock:
+        if faction in empty_token_pools:
+            return None
+        rows = db_get_where("Tokens", ["Faction", "Used"], [faction, False])
+        if not rows:
+            empty_token_pools.add(faction)
+            return None
+        agent_name, token = rows[0][0], rows[0][1]
+        db_update("Tokens", ["Used"], [True], ["ID"], [agent_name])
+    db_insert("Agents", ["ID", "Token", "System"], [agent_name, token, system])
+    return agent_name, token
+
+
+def register_ship(ship_class, agent_name, faction, system, printID=None, chain=None):
+    # Takes an agent from the token pool, or registers agent_name, and returns its ship ready to launch
+    planned_name = agent_name
+    faction, pooled = pooled_agent(faction, system)
+    if pooled is not None:
+        agent_name, token = pooled
+    else:
+        try:
+            registration = register(agent_name, faction, system)
+        except KeyError:
+            agent_name = "ZCHAR2-" + system
+            registration = register(agent_name, faction, system)
+        token = registration["data"]["token"]
+    return registered_ship(ship_class, planned_name, agent_name, token, system, printID, chain)
 
-        closest = ""
-        distance = 120000
 
-        for f in factions:
-            fx = f["x"]
-            fy = f["y"]
+# register_ship's database work, which register_ship_async in async_ship.py runs on its database thread
 
-            f_distance = math.sqrt((x - fx) ** 2 + (y - fy) ** 2)
-            if f_distance < distance:
-                distance = f_distance
-                closest = f["symbol"]
+def pooled_agent(faction, system):
+    # The faction to register with, and an agent of that faction from the token pool (or None)
+    if faction is None:
+        faction = closest_faction(system)
+    return faction, take_pooled_agent(faction, system)
 
-        db_insert("Systems", ["System"], [s["symbol"]])
-        db_update("Systems", ["x", "y", "closestFaction", "distanceFromFaction"], [x, y, closest, distance], ["System"], [s["symbol"]])
 
+def registered_ship(ship_class, planned_name, agent_name, token, system, printID=None, chain=None):
+    if chain is not None and agent_name != planned_name:
+        db_update("Plans", ["ID"], [agent_name], ["ID"], [planned_name])
+    return ship_class(agent_name, token, system, printID=printID, Chain=chain)
 
-def populate_waypoints():
+
+def populate_waypoints(workers=16, batch_size=200):
+    # Fetches every system's waypoints in parallel, enough to keep the request queue full,
+    # and writes them in large transactions.
     systems = db_get("Systems")
-    querystring = {"limit": "20"}
-    counter = 0
     print("Populating Waypoints:")
     clear_table("Waypoints")
-    for s in systems:
-        s_name = s[0]
-        endpoint = "systems/" + s_name + "/waypoints"
-        wps = rh.get(endpoint, querystring).json()["data"]
-        for wp in wps:
-            db_insert("Waypoints", ["Waypoint", "System"], [wp["symbol"], wp["systemSymbol"]])
-            update_waypoint_traits(wp)
-        print("\r" + str(counter), end="")
-        counter += 1
+
+    columns = ["Waypoint", "System", "Charted", "Marketplace", "Shipyard", "JumpGate", "x", "y"]
+    start = time.time()
+    waypoint_count = 0
+    system_count = 0
+    waypoint_rows = []
+    jump_gate_rows = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_waypoints, s[0], None, "LOW") for s in systems]
+        for future in concurrent.futures.as_completed(futures):
+            for wp in future.result():
+                row = waypoint_row(wp)
+                waypoint_rows.append(row)
+                if row[5]:
+                    jump_gate_rows.append((True, row[1]))
+            system_count += 1
+
+            if len(waypoint_rows) >= batch_size or system_count == len(systems):
+                app.storage.upsert_many("Waypoints", columns, ["Waypoint"], waypoint_rows)
+                if universe.loaded:
+                    for row in waypoint_rows:
+                        universe.add(row)
+                if jump_gate_rows:
+                    app.storage.write_batch([(("update", "Systems", ("hasJumpGate",), ("System",)), jump_gate_rows)])
+                waypoint_count += len(waypoint_rows)
+                waypoint_rows = []
+                jump_gate_rows = []
+
+            elapsed = time.time() - start
+            print("\r" + print_builder(str(system_count) + "/" + str(len(systems)) + " systems",
+                                       str(waypoint_count) + " waypoints",
+                                       str(round(system_count / elapsed * 60, 1)) + " systems/min",
+                                       str(round(app.rh.get_rpm(False), 1)) + " rpm"), end="")
+    print()
+    print("Ingested", waypoint_count, "waypoints from", system_count, "systems in", round(time.time() - start), "s")
+
+
+def waypoint_row(wp: dict):
+    marketplace = False
+    shipyard = False
+    for trait in wp["traits"]:
+        if trait["symbol"] == "MARKETPLACE":
+            marketplace = True
+        elif trait["symbol"] == "SHIPYARD":
+            shipyard = True
+    return wp["symbol"], wp["systemSymbol"], "chart" in wp.keys(), marketplace, shipyard, wp["type"] == "JUMP_GATE", \
+        wp.get("x"), wp.get("y")
 
 
 def update_waypoint_traits(waypoint: dict):
     wp = waypoint
     for trait in wp["traits"]:
         if trait["symbol"] == "UNCHARTED":
-            db_update("Waypoints", ["Charted"], [False], ["Waypoint"], [wp["symbol"]])
+            set_waypoint_flag(wp["symbol"], "Charted", False)
         elif trait["symbol"] == "MARKETPLACE":
-            db_update("Waypoints", ["Marketplace"], [True], ["Waypoint"], [wp["symbol"]])
+            set_waypoint_flag(wp["symbol"], "Marketplace", True)
         elif trait["symbol"] == "SHIPYARD":
-            db_update("Waypoints", ["Shipyard"], [True], ["Waypoint"], [wp["symbol"]])
+            set_waypoint_flag(wp["symbol"], "Shipyard", True)
     if "chart" in wp.keys():
-        db_update("Waypoints", ["Charted"], [True], ["Waypoint"], [wp["symbol"]])
+        set_waypoint_flag(wp["symbol"], "Charted", True)
     if wp["type"] == "JUMP_GATE":
-        db_update("Waypoints", ["JumpGate"], [True], ["Waypoint"], [wp["symbol"]])
+        set_waypoint_flag(wp["symbol"], "JumpGate", True)
         db_update("Systems", ["hasJumpGate"], [True], ["System"], [wp["systemSymbol"]])
 
 
+WAYPOINT_FLAGS = {"Charted": "charted", "Marketplace": "marketplace", "Shipyard": "shipyard", "JumpGate": "jump_gate"}
+
+
+def set_waypoint_flag(waypoint, column, value):
+    if column == "Charted" and value:
+        row = universe.get(waypoint)
+        if row is None or not row[2]:
+            charted_counter.inc()
+            if app.rh.cache is not None:
+                # cached waypoint listings for the system still say it's uncharted
+                app.rh.cache.invalidate("systems/" + waypoint_to_system(waypoint) + "/waypoints")
+    db_update("Waypoints", [column], [value], ["Waypoint"], [waypoint])
+    universe.set_flag(waypoint, WAYPOINT_FLAGS[column], value)
+
+
+def get_universe():
+    if not universe.loaded:
+        with universe_lock:
+            if not universe.loaded:
+                universe.load(db_iterate("Waypoints"))
+    return universe
+
+
 def clear_table(table_name):
-    cmd = "DELETE FROM " + table_name
-    cursor.execute(cmd)
+    app.writer.flush()
+    app.storage.clear(table_name)
 
 
 def waypoint_to_system(waypoint):
     return waypoint[:-7]
 
 
-def main():
+def projected_completion():
+    # When every waypoint will be charted at the rate they've been charted since the program started
+    charted = charted_counter.value()
+    if not charted or not universe.loaded:
+        return None
+    rate = charted / (time.time() - started)
+    return time.time() + universe.uncharted_count() / rate
+
+
+def agent_state(agent):
+    # State and Stop columns, for an Agents table that has them
+    if len(agent) > 6:
+        return agent[6]
+    return None
+
+
+def agent_stop(agent):
+    if len(agent) > 7:
+        return agent[7]
+    return 0
+
+
+def ship_states(ships):
+    states = {}
+    for s in ships:
+        states[(s.State,)] = states.get((s.State,), 0) + 1
+    return states
+
+
+def start_metrics():
+    # SPACECHARTERS_METRICS_PORT serves /metrics and /metrics.json, SPACECHARTERS_METRICS_FILE gets a JSON snapshot
+    # every minute. Neither is on by default.
+    global metrics_server, metrics_writer
+    if config.metrics_port and metrics_server is None:
+        metrics_server = metrics.serve(int(config.metrics_port))
+    if config.metrics_file and metrics_writer is None:
+        metrics_writer = metrics.write_snapshots(config.metrics_file)
+
+
+metrics.gauge("waypoints_uncharted", "Waypoints left to chart",
+              function=lambda: universe.uncharted_count() if universe.loaded else None)
+metrics.gauge("projected_completion_timestamp", "Unix time every waypoint should be charted by",
+              function=projected_completion)
+
+
+def main(wait=False):
+    # Launches every ship. With wait, returns once they've all finished; otherwise as soon as they're running.
     RESEARCH_MARKETS = False
+    PLAN_ACCOUNTS = True  # chain several systems per account (account_planner.py) instead of one account per system
+    ENGINE = "scheduler"  # "scheduler", "async" or "threads"
+
+    start_metrics()
 
-    from ship import Ship
+    if ENGINE == "async":
+        from async_ship import AsyncShip as Ship, register_ship_async as register_agent
+    else:
+        from ship import Ship
+        register_agent = register_ship
     systems_agents_dict = {}
     systems_agents_dict_2 = {}
-    all_waypoints = db_get("Waypoints")
-    for wp in all_waypoints:
-        systems_agents_dict[wp[1]] = None
-        if wp[3] or wp[4]:
-            systems_agents_dict_2[wp[1]] = None
+    universe_index = get_universe()
+    for system in universe_index.all_systems():
+        systems_agents_dict[system] = None
+        if universe_index.has_market_or_shipyard(system):
+            systems_agents_dict_2[system] = None
     existing_agents = db_get("Agents")
+    plan = {}
+    if PLAN_ACCOUNTS:
+        plan = load_plan()
+        if not plan:
+            from account_planner import build_plan
+            plan = save_plan(build_plan(exclude={a[2] for a in existing_agents if not a[4]}))
+    planned_agents = {}
     printID = 1
     for agent in existing_agents:
-        s = Ship(agent[0], agent[1], agent[2], agent[3], agent[4], printID=printID)
+        chain = None
+        if agent[0] in plan.keys():
+            chain = plan[agent[0]][1]
+        s = Ship(*agent[:5], printID=printID, Waypoint=agent[5], Chain=chain, State=agent_state(agent),
+                 Stop=agent_stop(agent))
         printID += 1
+        if chain is not None:
+            planned_agents[s.ID] = s
+            if s.Completed and s.System in systems_agents_dict_2.keys():
+                systems_agents_dict_2[s.System] = s
+            continue
         if s.System in systems_agents_dict.keys():
             systems_agents_dict[s.System] = s
         elif not s.Completed:
-            s.Completed = True
-            db_update("Agents", ["Completed"], [True], ["ID"], [s.ID])
+            s.complete()
         if s.Completed and s.System in systems_agents_dict_2.keys():
             systems_agents_dict_2[s.System] = s
 
@@ -381,76 +734,122 @@ def main():
     j.sort()
 
     cmd = "SELECT System, closestFaction, distanceFromFaction FROM Systems ORDER BY distanceFromFaction DESC;" # noqa
-    cursor.execute(cmd)
-    all_systems = []
-    for x in cursor:
-        all_systems.append(x)
-
-    threads = []
-    threads2 = []
-    print(len(systems_agents_dict))
-
-    for sys in all_systems:
-        if sys[0] in systems_agents_dict.keys():
-            system = sys[0]
-            if systems_agents_dict[system] is None:
-                agent_name = "ZCHART-" + system
-                faction = sys[1]
-                try:
-                    registration = register(agent_name, faction, system)
-                except KeyError:
-                    agent_name = "ZCHAR2-" + system
-                    registration = register(agent_name, faction, system)
-                token = registration["data"]["token"]
-                s = Ship(agent_name, token, system, printID=printID)
+    db_flush()
+    all_systems = app.storage.stream(cmd)
+
+    ships = []
+    research_ships = []
+    registrations = []  # agents still to register, furthest first; each ship launches as soon as it's registered
+    log.info("fleet", "Systems with agents:", len(systems_agents_dict))
+
+    for system_row in all_systems:
+        if system_row[0] in systems_agents_dict.keys():
+            system = system_row[0]
+            if systems_agents_dict[system] is None and not PLAN_ACCOUNTS:
+                registrations.append(functools.partial(register_agent, Ship, "ZCHART-" + system, system_row[1], system,
+                                                       printID))
                 printID += 1
-                systems_agents_dict[system] = s
-            x = threading.Thread(target=systems_agents_dict[system].start, daemon=True)
-            threads.append(x)
+            if systems_agents_dict[system] is not None:
+                ships.append(systems_agents_dict[system])
 
-        if sys[0] in systems_agents_dict_2.keys():
-            system = sys[0]
+        if system_row[0] in systems_agents_dict_2.keys():
+            system = system_row[0]
             if systems_agents_dict_2[system] is not None:
-                x = threading.Thread(target=systems_agents_dict_2[system].update_markets_and_shipyards, daemon=True)
-                threads2.append(x)
+                research_ships.append(systems_agents_dict_2[system])
+
+    for agent_name, (faction, legs) in plan.items():
+        if agent_name in planned_agents.keys():
+            ships.append(planned_agents[agent_name])
+            continue
+        registrations.append(functools.partial(register_agent, Ship, agent_name, faction, legs[0][0], printID, legs))
+        printID += 1
 
-    all_waypoints = db_get("Waypoints")
-    for wp in all_waypoints:
-        sys = wp[1]
-        if sys in systems_agents_dict.keys():
-            ship = systems_agents_dict[sys]
-            ship.add_waypoint(wp)
+    def launched(s):
+        if s.Chain is None:
+            systems_agents_dict[s.System] = s
+        ships.append(s)
+
+    if not RESEARCH_MARKETS:
+        research_ships = []
+
+    metrics.gauge("ships", "Charting ships by state", ["state"], lambda: ship_states(ships))
+
+    if ENGINE == "async":
+        import async_ship
+        async_ship.run(ships, research_ships, registrations, launched)
+        return systems_agents_dict
+
+    if ENGINE == "scheduler":
+        from scheduler import ArrivalScheduler
+        scheduler = ArrivalScheduler(log=log)
+        for s in ships:
+            scheduler.schedule(s.Arrival, s.step)
+        for s in research_ships:
+            scheduler.schedule(None, s.research_step)
+        scheduler.start()
+
+        def launch(s):
+            launched(s)
+            scheduler.schedule(None, s.step)
+        registration = RegistrationPipeline(registrations, launch, log=log).start()
+        if wait:
+            while not registration.wait(60) or not scheduler.wait(60):
+                log.info("fleet", "Sleeping ships:", scheduler.sleeping(), "Active ships:", scheduler.active())
+            scheduler.stop()
+            return
+        return systems_agents_dict
+
+    threads = []
+    for s in ships:
+        threads.append(threading.Thread(target=s.start, daemon=True))
+    for s in research_ships:
+        threads.append(threading.Thread(target=s.update_markets_and_shipyards, daemon=True))
 
     for t in threads:
         t.start()
 
-    if RESEARCH_MARKETS:
-        for t in threads2:
-            t.start()
-
-    threads = threads + threads2
+    def launch(s):
+        launched(s)
+        t = threading.Thread(target=s.start, daemon=True)
+        threads.append(t)
+        t.start()
+    registration = RegistrationPipeline(registrations, launch, log=log).start()
 
-    if __name__ == '__main__':
+    if wait:
         num_alive = 0
         for t in threads:
             if t.is_alive():
                 num_alive += 1
-        with rh.print_lock:
-            print("Living threads:", num_alive)
+        log.info("fleet", "Living threads:", num_alive)
 
-        while num_alive > 0:
+        while num_alive > 0 or not registration.wait(0):
             time.sleep(60)
             num_alive = 0
             for t in threads:
                 if t.is_alive():
                     num_alive += 1
-            with rh.print_lock:
-                print("Living threads:", num_alive)
+            log.info("fleet", "Living threads:", num_alive)
 
     else:
         return systems_agents_dict
 
 
-if __name__ == '__main__':
+def run():
     while True:
-        main()
\ No newline at end of file
+        main(wait=True)
+
+
+COMMANDS = {
+    # python main.py [command]: what each one runs, imported only when it's used
+    "run": ("main", "run"),
+    "reset": ("reset", "main"),
+    "bench": ("pace_refining", "main"),
+}
+
+
+if __name__ == '__main__':
+    # Run through the imported module rather than this __main__ copy of it: ship.py and the rest import main, and
+    # would otherwise get a second Config, App and request handler of their own.
+    import importlib
+    module_name, function_name = COMMANDS[sys.argv[1] if len(sys.argv) > 1 else "run"]
+    getattr(importlib.import_module(module_name), function_name)()
\ No newline at end of file
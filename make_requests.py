@@ -1,21 +1,106 @@
+import asyncio
+import concurrent.futures
 import datetime
+import email.utils
+import heapq
+import itertools
 import json
-import time
+import random
 import threading
+import time
 import requests
 
+from log import Log
+from metrics import MetricsRegistry
+from rate_limiter import RateLimiter
+
+
+class RequestError(Exception):
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+def backoff_delay(tries, base=0.5, cap=60.0):
+    return random.uniform(0, min(cap, base * 2 ** tries))
+
+
+def header_seconds(value):
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        when = None
+    if when is None:
+        try:
+            when = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except (AttributeError, ValueError):
+            return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max((when - now) / datetime.timedelta(seconds=1), 0)
+
+
+def retry_after(response, default=1.0):
+    # How long this request has to wait. x-ratelimit-reset is when the whole burst pool refills, which is usually
+    # much later, so it's only used when the server gives nothing better.
+    headers = response.headers
+    if "Retry-After" in headers:
+        seconds = header_seconds(headers["Retry-After"])
+        if seconds is not None:
+            return seconds
+    try:
+        return float(response.json()["error"]["data"]["retryAfter"])
+    except (ValueError, KeyError, TypeError):
+        pass
+    if "x-ratelimit-reset" in headers:
+        seconds = header_seconds(headers["x-ratelimit-reset"])
+        if seconds is not None:
+            return seconds
+    return default
+
 
 def rate_limit_retry(func, max_tries=10):
     def wrapper(*args, **kwargs):
-        result = func(*args, **kwargs)
-        tries = 1
         handler = args[0]
-        while result.status_code == 429 and tries < max_tries:
+        tries = 0
+        while True:
             tries += 1
-            result = func(*args, **kwargs)
-        handler.successful_request_count += 1
-        handler.pacing_src += 1
-        return result
+            try:
+                result = func(*args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                handler.errors.inc(error=type(e).__name__)
+                if tries >= max_tries:
+                    raise
+                time.sleep(backoff_delay(tries))
+                handler.reserve_slot()
+                continue
+
+            handler.observe_limits(result)
+            handler.responses.inc(code=result.status_code)
+            if result.status_code == 429:
+                with handler.count_lock:
+                    handler.rate_limited_count += 1
+                handler.limiter.penalize()
+                handler.limiter.pause(retry_after(result))
+            elif result.status_code >= 500:
+                if tries < max_tries:
+                    time.sleep(backoff_delay(tries))
+            else:
+                handler.limiter.recover()
+                with handler.count_lock:
+                    handler.successful_request_count += 1
+                    handler.pacing_src += 1
+                return result
+
+            if tries >= max_tries:
+                raise RequestError("Request failed with status " + str(result.status_code) + " after " +
+                                   str(tries) + " tries", result)
+            handler.reserve_slot()
     return wrapper
 
 
@@ -30,104 +115,211 @@ def print_builder(*args, min_spaces=2, spaces=7):
     return out_str
 
 
+PRIORITIES = {"HIGH": 0, "NORMAL": 1, "LOW": 2}
+# Under the "deadline" policy a request without its own deadline is due this many seconds after it's submitted,
+# so a LOW request that has waited a minute goes ahead of a HIGH one that was just submitted.
+DEADLINE_SLACK = {"HIGH": 0.0, "NORMAL": 10.0, "LOW": 60.0}
+POLICIES = ["priority", "deadline"]
+
+API_URL = 'https://api.spacetraders.io/v2/'
+
+
+class SessionTransport:
+    # Keeps connections to the API alive between requests instead of paying a TCP + TLS handshake every call
+    def __init__(self, pool_size: int = 12, timeout=(5, 30)):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, headers: dict = None, params: dict = None, data: str = None):
+        return self.session.request(method, url, headers=headers, params=params, data=data, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
+
+class SimpleTransport:
+    # A fresh connection per request, which is how every request used to be made
+    def __init__(self, timeout=(5, 30)):
+        self.timeout = timeout
+
+    def request(self, method: str, url: str, headers: dict = None, params: dict = None, data: str = None):
+        return requests.request(method, url, headers=headers, params=params, data=data, timeout=self.timeout)
+
+    def close(self):
+        pass
+
+
 class RequestHandler:
-    def __init__(self, rate_limit: int = 2, burst_limit: int = 10):
-        self.rate_limit = rate_limit
-        self.burst_limit = burst_limit
-        self.recent_request_times = []
-        self.recent_burst_times = []
+    def __init__(self, rate_limit: int = 2, burst_limit: int = 10, max_workers: int = None, limiter: RateLimiter = None,
+                 transport=None, base_url: str = API_URL, cache=None, metrics: MetricsRegistry = None, log: Log = None,
+                 policy: str = "priority", deadline_slack: dict = None):
+        # policy "priority" always sends the highest priority request first; "deadline" sends the one with the
+        # earliest deadline first (see DEADLINE_SLACK)
+        if policy not in POLICIES:
+            raise ValueError("Unknown scheduling policy: " + str(policy))
+        self.policy = policy
+        if deadline_slack is None:
+            deadline_slack = DEADLINE_SLACK
+        self.deadline_slack = deadline_slack
+        if limiter is None:
+            limiter = RateLimiter(rate_limit, burst_limit)
+        self.limiter = limiter
+        self.rate_limit = limiter.rate_limit
+        self.burst_limit = limiter.burst_limit
         self.init_time = datetime.datetime.utcnow()
         self.request_count = 0
         self.successful_request_count = 0
+        self.rate_limited_count = 0
         self.pacing_time = datetime.datetime.utcnow()
         self.pacing_rc = 0
         self.pacing_src = 0
-        self.request_queue = {"HIGH": [], "NORMAL": [], "LOW": []}
-        self.queue_lock = threading.Lock()
-        self.request_lock = threading.Lock()
-        self.print_lock = threading.Lock()
-
-    def __fulfill_queue(self):
-        if not self.request_lock.locked():
-            self.queue_lock.acquire()
-            if self.request_queue["HIGH"]:
-                result, func, args = self.request_queue["HIGH"].pop(0)
-            elif self.request_queue["NORMAL"]:
-                result, func, args = self.request_queue["NORMAL"].pop(0)
-            elif self.request_queue["LOW"]:
-                result, func, args = self.request_queue["LOW"].pop(0)
-            else:
-                self.queue_lock.release()
+        if max_workers is None:
+            max_workers = self.rate_limit + self.burst_limit
+        self.max_workers = max_workers
+        if transport is None:
+            transport = SessionTransport(pool_size=max_workers)
+        self.transport = transport
+        self.base_url = base_url
+        self.cache = cache
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.collapsed_count = 0
+        self.pacing_latency = 0.0
+        self.count_lock = threading.Lock()  # the counts above, bumped from every worker thread
+        self.request_queue = []
+        self.queue_counter = itertools.count()
+        self.queue_lock = threading.Condition()
+        self.dispatcher = None
+        self.executor = None
+        if log is None:
+            log = Log()
+        self.log = log
+        if metrics is None:
+            metrics = MetricsRegistry()
+        self.metrics = metrics
+        metrics.gauge("request_queue_depth", "Requests waiting for a rate limit slot", ["priority"], self.queue_depths)
+        self.queue_wait = metrics.histogram("request_queue_wait_seconds", "Time from submit to dispatch", ["priority"])
+        self.latency = metrics.histogram("request_latency_seconds", "Time the API took to answer", ["method"])
+        self.responses = metrics.counter("responses_total", "API responses by status code", ["code"])
+        self.errors = metrics.counter("request_errors_total", "Requests that got no response", ["error"])
+
+    def __start_dispatcher(self):
+        with self.queue_lock:
+            if self.dispatcher is not None:
                 return
-            self.queue_lock.release()
-
-            printout = print_builder(self.queue_len(), self.request_count, str(self.get_rpm())[:5], *args[:4])
-            with self.print_lock:
-                print(printout)
-
-            self.request_lock.acquire()
-            result.append(func(*args, ))
-            self.request_lock.release()
-
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                  thread_name_prefix="RequestWorker")
+            self.dispatcher = threading.Thread(target=self.__dispatch, name="RequestDispatcher", daemon=True)
+            self.dispatcher.start()
+
+    def __dispatch(self):
+        while True:
+            with self.queue_lock:
+                while not self.request_queue:
+                    self.queue_lock.wait()
+            self.reserve_slot()
+            with self.queue_lock:
+                _, _, queued, priority, future, func, args = heapq.heappop(self.request_queue)
+                queue_len = len(self.request_queue)
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.queue_wait.observe(time.perf_counter() - queued, priority=priority)
+
+            self.log.progress("requests", queue_len, self.request_count, *args[:4], format=self.request_line)
+            self.executor.submit(self.__run, future, func, args)
+
+    def request_line(self, queue_len, request_count, *args):
+        return print_builder(queue_len, request_count, str(self.get_rpm())[:5], *args)
+
+    @staticmethod
+    def __run(future, func, args):
+        try:
+            result = func(*args, )
+        except BaseException as e:
+            future.set_exception(e)
         else:
-            time.sleep(1)
+            future.set_result(result)
 
-    def __add_to_queue(self, queue_item, priority="NORMAL"):
-        if priority not in ["HIGH", "NORMAL", "LOW"]:
+    def __queue_key(self, priority, deadline, now):
+        if priority not in PRIORITIES:
             raise ValueError
-        self.queue_lock.acquire()
-        priority_queue = self.request_queue[priority]
-        priority_queue.append(queue_item)
-        self.queue_lock.release()
+        if self.policy == "deadline":
+            if deadline is None:
+                return now + self.deadline_slack[priority]
+            return now + (deadline - datetime.datetime.utcnow()) / datetime.timedelta(seconds=1)
+        return PRIORITIES[priority]
+
+    def __add_to_queue(self, queue_item, priority="NORMAL", deadline=None):
+        future, func, args = queue_item
+        now = time.perf_counter()
+        key = self.__queue_key(priority, deadline, now)
+        with self.queue_lock:
+            heapq.heappush(self.request_queue, (key, next(self.queue_counter), now, priority, future, func, args))
+            self.queue_lock.notify()
+
+    def __promote(self, future, priority="NORMAL", deadline=None):
+        # Someone else wants the queued request behind future too; if they need it sooner, it goes out as if they'd
+        # queued it, keeping its place among requests with the same key
+        key = self.__queue_key(priority, deadline, time.perf_counter())
+        with self.queue_lock:
+            for i, item in enumerate(self.request_queue):
+                if item[4] is future:
+                    if key < item[0]:
+                        self.request_queue[i] = (key, item[1], item[2], priority) + item[4:]
+                        heapq.heapify(self.request_queue)
+                    return
 
     def queue_len(self):
-        self.queue_lock.acquire()
-        total_len = len(self.request_queue["HIGH"])
-        total_len += len(self.request_queue["NORMAL"])
-        total_len += len(self.request_queue["LOW"])
-        self.queue_lock.release()
+        with self.queue_lock:
+            total_len = len(self.request_queue)
         return total_len
 
-    def __queue_request(self, func, args, priority="NORMAL"):
-        result = []
-        queue_item = (result, func, args)
-        self.__add_to_queue(queue_item, priority=priority)
-        while not result:
-            self.__fulfill_queue()
+    def queue_depths(self):
+        depths = {(p,): 0 for p in PRIORITIES}
+        with self.queue_lock:
+            for item in self.request_queue:
+                depths[(item[3],)] += 1
+        return depths
 
-        return result[0]
+    def submit(self, func, args, priority="NORMAL", deadline: datetime.datetime = None):
+        # deadline (UTC) is when the caller needs the response by; only the "deadline" policy looks at it
+        if self.dispatcher is None:
+            self.__start_dispatcher()
+        future = concurrent.futures.Future()
+        queue_item = (future, func, args)
+        self.__add_to_queue(queue_item, priority=priority, deadline=deadline)
+        return future
 
-    def __clear_old_requests(self):
-        now = datetime.datetime.utcnow()
-        rate_delta = datetime.timedelta(seconds=1)
-        burst_delta = datetime.timedelta(seconds=10)
-        if self.recent_request_times:
-            old = self.recent_request_times[0]
-            if (now - old) > rate_delta:
-                self.recent_request_times = []
-            if self.recent_burst_times:
-                old = self.recent_burst_times[0]
-                if (now - old) > burst_delta:
-                    self.recent_burst_times = []
+    def __queue_request(self, func, args, priority="NORMAL", deadline=None):
+        return self.submit(func, args, priority=priority, deadline=deadline).result()
+
+    async def __await_request(self, func, args, priority="NORMAL", deadline=None):
+        return await asyncio.wrap_future(self.submit(func, args, priority=priority, deadline=deadline))
 
     def start_pacing(self):
-        self.pacing_rc = 0
-        self.pacing_src = 0
-        self.pacing_time = datetime.datetime.utcnow()
+        with self.count_lock:
+            self.pacing_rc = 0
+            self.pacing_src = 0
+            self.pacing_latency = 0.0
+            self.pacing_time = datetime.datetime.utcnow()
 
     def get_rpm(self, success_only=True, pacing=False):
-        if pacing:
-            start_time = self.pacing_time
-            if success_only:
-                request_count = self.pacing_src
+        with self.count_lock:
+            if pacing:
+                start_time = self.pacing_time
+                if success_only:
+                    request_count = self.pacing_src
+                else:
+                    request_count = self.pacing_rc
             else:
-                request_count = self.pacing_rc
-        else:
-            start_time = self.init_time
-            if success_only:
-                request_count = self.successful_request_count
-            else:
-                request_count = self.request_count
+                start_time = self.init_time
+                if success_only:
+                    request_count = self.successful_request_count
+                else:
+                    request_count = self.request_count
 
         now = datetime.datetime.utcnow()
         alive_time = now - start_time
@@ -136,52 +328,104 @@ class RequestHandler:
         rpm = request_count / minutes_alive
         return rpm
 
-    def __wait_to_request(self):
-        self.__clear_old_requests()
-        while len(self.recent_request_times) >= self.rate_limit and len(self.recent_burst_times) >= self.burst_limit:
-            time.sleep(self.__get_time_to_request())
-            self.__clear_old_requests()
-
-    def __get_time_to_request(self):
-        if len(self.recent_request_times) < self.rate_limit:
-            return 0
-        if len(self.recent_burst_times) < self.burst_limit:
-            return 0
-
-        now = datetime.datetime.utcnow()
-        rate_delta = datetime.timedelta(seconds=1)
-        burst_delta = datetime.timedelta(seconds=10)
-        rate_next_clear_time = self.recent_request_times[0] + rate_delta
-        burst_next_clear_time = self.recent_burst_times[0] + burst_delta
-        timedelta_to_rate_clear = rate_next_clear_time - now # noqa
-        timedelta_to_burst_clear = burst_next_clear_time - now # noqa
-        seconds_to_rate_clear = timedelta_to_rate_clear / datetime.timedelta(seconds=1)
-        seconds_to_burst_clear = timedelta_to_burst_clear / datetime.timedelta(seconds=1)
-        return min(seconds_to_rate_clear, seconds_to_burst_clear)
-
-    def __record_request_time(self):
-        now = datetime.datetime.utcnow()
-        if len(self.recent_request_times) < self.rate_limit:
-            self.recent_request_times.append(now)
-        else:
-            self.recent_burst_times.append(now)
-
-    def get(self, endpoint: str, params: dict = None, headers: dict = None, token: str = None, priority="NORMAL"):
-        return self.__queue_request(self.__make_request, ("GET", endpoint, params, headers, token), priority=priority)
-
-    def post(self, endpoint: str, params: dict = None, headers: dict = None, token: str = None, priority="NORMAL"):
-        return self.__queue_request(self.__make_request, ("POST", endpoint, params, headers, token), priority=priority)
-
-    def patch(self, endpoint: str, params: dict = None, headers: dict = None, token: str = None, priority="NORMAL"):
-        return self.__queue_request(self.__make_request, ("PATCH", endpoint, params, headers, token), priority=priority)
+    def reserve_slot(self):
+        self.limiter.acquire()
+
+    def observe_limits(self, response):
+        headers = response.headers
+        rate_limit = None
+        burst_limit = None
+        burst_period = None
+        try:
+            if "x-ratelimit-limit-sustained" in headers:
+                rate_limit = int(headers["x-ratelimit-limit-sustained"])
+            if "x-ratelimit-limit-burst" in headers:
+                burst_limit = int(headers["x-ratelimit-limit-burst"])
+            if "x-ratelimit-burst-duration" in headers:
+                burst_period = float(headers["x-ratelimit-burst-duration"])
+        except ValueError:
+            return
+        self.limiter.configure(rate_limit, burst_limit, burst_period)
+
+    def get(self, endpoint: str, params: dict = None, headers: dict = None, token: str = None, priority="NORMAL",
+            deadline: datetime.datetime = None):
+        return self.__submit_get(endpoint, params, headers, token, priority, deadline).result()
+
+    def post(self, endpoint: str, params: dict = None, headers: dict = None, token: str = None, priority="NORMAL",
+             deadline: datetime.datetime = None):
+        return self.__queue_request(self.__make_request, ("POST", endpoint, params, headers, token), priority=priority,
+                                    deadline=deadline)
+
+    def patch(self, endpoint: str, params: dict = None, headers: dict = None, token: str = None, priority="NORMAL",
+              deadline: datetime.datetime = None):
+        return self.__queue_request(self.__make_request, ("PATCH", endpoint, params, headers, token), priority=priority,
+                                    deadline=deadline)
+
+    async def aget(self, endpoint: str, params: dict = None, headers: dict = None, token: str = None, priority="NORMAL",
+                   deadline: datetime.datetime = None):
+        return await asyncio.wrap_future(self.__submit_get(endpoint, params, headers, token, priority, deadline))
+
+    async def apost(self, endpoint: str, params: dict = None, headers: dict = None, token: str = None, priority="NORMAL",
+                    deadline: datetime.datetime = None):
+        return await self.__await_request(self.__make_request, ("POST", endpoint, params, headers, token),
+                                          priority=priority, deadline=deadline)
+
+    async def apatch(self, endpoint: str, params: dict = None, headers: dict = None, token: str = None, priority="NORMAL",
+                     deadline: datetime.datetime = None):
+        return await self.__await_request(self.__make_request, ("PATCH", endpoint, params, headers, token),
+                                          priority=priority, deadline=deadline)
+
+    def __submit_get(self, endpoint, params, headers, token, priority, deadline=None):
+        # Answers from the cache when it can, and shares one request between everyone asking for the same thing
+        args = ("GET", endpoint, params, headers, token)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(endpoint, params, token)
+        if key is None:
+            return self.submit(self.__make_request, args, priority=priority, deadline=deadline)
+
+        response = self.cache.get(key)
+        if response is not None:
+            future = concurrent.futures.Future()
+            future.set_result(response)
+            return future
+
+        with self.in_flight_lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.collapsed_count += 1
+                self.__promote(future, priority, deadline)
+                return future
+            future = self.submit(self.__cached_get, args, priority=priority, deadline=deadline)
+            self.in_flight[key] = future
+        future.add_done_callback(lambda f: self.__forget(key, f))
+        return future
+
+    def __forget(self, key, future):
+        with self.in_flight_lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    def __cached_get(self, request_type, endpoint, params=None, headers=None, token=None):
+        key = self.cache.key(endpoint, params, token)
+        entry = self.cache.entry(key)
+        if entry is not None:
+            headers = dict(headers or {}, **entry.validators())
+        result = self.__make_request(request_type, endpoint, params, headers, token)
+        if result.status_code == 304 and entry is not None:
+            return self.cache.refresh(key, entry)
+        if result.status_code == 200:
+            return self.cache.put(key, result)
+        return result
 
     @rate_limit_retry
     def __make_request(self, request_type: str, endpoint: str, params: dict = None, headers: dict = None, token: str = None):
         if request_type not in ["GET", "POST", "PATCH"]:
             raise ValueError
 
-        self.request_count += 1
-        self.pacing_rc += 1
+        with self.count_lock:
+            self.request_count += 1
+            self.pacing_rc += 1
 
         if params is None:
             params = dict()
@@ -197,20 +441,26 @@ class RequestHandler:
         for header in headers.keys():
             full_headers[header] = headers[header]
 
-        url = 'https://api.spacetraders.io/v2/' + endpoint
-        params_json = json.dumps(params)
-
-        self.__wait_to_request()
+        url = self.base_url + endpoint
 
-        result = None
+        start = time.perf_counter()
         if request_type == "GET":
-            result = requests.request(request_type, url, headers=full_headers, params=params)
-        elif request_type == "PATCH" or request_type == "POST":
-            result = requests.request(request_type, url, headers=full_headers, data=params_json)
-        self.__record_request_time()
+            result = self.transport.request(request_type, url, headers=full_headers, params=params)
+        else:
+            result = self.transport.request(request_type, url, headers=full_headers, data=json.dumps(params))
+        elapsed = time.perf_counter() - start
+        with self.count_lock:
+            self.pacing_latency += elapsed
+        self.latency.observe(elapsed, method=request_type)
 
         return result
 
+    def get_latency(self):
+        with self.count_lock:
+            if self.pacing_rc == 0:
+                return 0
+            return self.pacing_latency / self.pacing_rc
+
 
 def main():
     rh = RequestHandler()
@@ -0,0 +1,276 @@
+import bisect
+import http.server
+import json
+import math
+import os
+import threading
+import time
+
+
+# Seconds. Covers a cache hit through to a request that waited out a long 429.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Metric:
+    # One named metric with a value per combination of label values
+    kind = None
+
+    def __init__(self, name, help_text="", labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    # Either set directly, or read from function at scrape time. function returns a number, or a dict of
+    # label value tuples to numbers for a labelled gauge. A None value leaves the sample out.
+    kind = "gauge"
+
+    def __init__(self, name, help_text="", labels=(), function=None):
+        super().__init__(name, help_text, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(tuple(str(v) for v in key), value) for key, value in values.items() if value is not None]
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text="", labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = HistogramValue(self.buckets)
+            h.counts[i] += 1
+            h.count += 1
+            h.sum += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            return [(key, (list(h.counts), h.count, h.sum)) for key, h in self.values.items()]
+
+    def quantile(self, counts, count, q):
+        # Estimated from the buckets: the upper bound of the bucket the quantile falls in
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.buckets + (math.inf,), counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return math.inf
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class MetricsRegistry:
+    # Every metric the program keeps, readable as Prometheus text (render) or as a dict (snapshot).
+    # Asking for a metric that already exists returns the existing one.
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def __get(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help_text="", labels=()):
+        return self.__get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text="", labels=(), function=None):
+        gauge = self.__get(Gauge, name, help_text, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help_text="", labels=(), buckets=DEFAULT_BUCKETS):
+        return self.__get(Histogram, name, help_text, labels, buckets)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append("# HELP " + metric.name + " " + metric.help_text)
+            lines.append("# TYPE " + metric.name + " " + metric.kind)
+            for key, value in metric.samples():
+                labels = list(zip(metric.labels, key))
+                if metric.kind != "histogram":
+                    lines.append(metric.name + label_string(labels) + " " + number(value))
+                    continue
+                counts, count, total = value
+                seen = 0
+                for bound, n in zip(metric.buckets + (math.inf,), counts):
+                    seen += n
+                    lines.append(metric.name + "_bucket" + label_string(labels + [("le", number(bound))]) + " " +
+                                 str(seen))
+                lines.append(metric.name + "_sum" + label_string(labels) + " " + number(total))
+                lines.append(metric.name + "_count" + label_string(labels) + " " + str(count))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        # Histograms are summarised as count, sum and estimated p50/p95/p99
+        result = {"time": time.time()}
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            samples = {}
+            for key, value in metric.samples():
+                name = ",".join(key)
+                if metric.kind == "histogram":
+                    counts, count, total = value
+                    value = {"count": count, "sum": round(total, 6)}
+                    for q in [0.5, 0.95, 0.99]:
+                        estimate = metric.quantile(counts, count, q)
+                        if estimate == math.inf:
+                            estimate = "+Inf"
+                        value["p" + str(int(q * 100))] = estimate
+                samples[name] = value
+            result[metric.name] = samples
+        return result
+
+    def serve(self, port, host="127.0.0.1"):
+        # /metrics in the Prometheus text format, /metrics.json as a snapshot
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        server.registry = self
+        threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+        return server
+
+    def write_snapshots(self, path, interval=60.0):
+        writer = SnapshotWriter(self, path, interval)
+        writer.start()
+        return writer
+
+
+def label_string(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"' for k, v in labels) + "}"
+
+
+def number(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.server.registry.render().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(self.server.registry.snapshot(), default=str).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SnapshotWriter:
+    # Rewrites path with a JSON snapshot every interval seconds, replacing it in one step so readers never see half
+    def __init__(self, registry, path, interval=60.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, name="MetricsSnapshot", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.registry.snapshot(), f, default=str)
+        os.replace(self.path + ".tmp", self.path)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,40 @@
+import os
+import sys
+
+from storage import AccessStorage, FETCH_SIZE, SqliteStorage, SCHEMA
+
+
+def migrate(access_path, sqlite_path):
+    source = AccessStorage(access_path, create=False)  # read as it is; tables it doesn't have are skipped
+    target = SqliteStorage(sqlite_path)
+    for table_name, columns in SCHEMA.items():
+        with source.readers.cursor() as cursor:
+            try:
+                cursor.execute("SELECT * FROM " + table_name)
+            except Exception as e:
+                print("Skipping", table_name + ":", e)
+                continue
+            source_columns = [d[0] for d in cursor.description]
+            column_names = [c[0] for c in columns if c[0] in source_columns]
+            positions = [source_columns.index(c) for c in column_names]
+            target.clear(table_name)
+            count = 0
+            rows = cursor.fetchmany(FETCH_SIZE)
+            while rows:
+                target.insert_many(table_name, column_names, [[r[i] for i in positions] for r in rows])
+                count += len(rows)
+                rows = cursor.fetchmany(FETCH_SIZE)
+        print("Copied", count, "rows into", table_name)
+    source.close()
+    target.close()
+
+
+if __name__ == '__main__':
+    base_path = os.path.dirname(__file__)
+    access_path = os.path.join(base_path, "SpaceCharters.accdb")
+    sqlite_path = os.path.join(base_path, "SpaceCharters.sqlite3")
+    if len(sys.argv) > 1:
+        access_path = sys.argv[1]
+    if len(sys.argv) > 2:
+        sqlite_path = sys.argv[2]
+    migrate(access_path, sqlite_path)
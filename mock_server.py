@@ -0,0 +1,506 @@
+import argparse
+import datetime
+import http.server
+import json
+import math
+import random
+import re
+import secrets
+import threading
+import time
+import urllib.parse
+
+from route_planner import COMMAND_SHIP_SPEED, DRIFT_MULTIPLIER
+
+
+# A stand-in for the parts of the SpaceTraders v2 API this project uses, over a generated universe.
+# Rate limits, flight times and error codes follow the real API; travel happens time_scale times faster.
+
+CRUISE_MULTIPLIER = 25
+COMMAND_SHIP_FUEL = 1200
+JUMP_GATE_RANGE = 2000
+JUMP_COOLDOWN = 60
+FACTIONS = ["COSMIC", "VOID", "GALACTIC", "QUANTUM", "DOMINION", "ASTRO", "CORSAIRS", "OBSIDIAN", "AEGIS", "UNITED",
+            "SOLITARY", "COBALT", "OMEGA", "ECHO", "LORDS", "CULT", "ANCIENTS", "SHADOW", "ETHEREAL"]
+WAYPOINT_TYPES = ["PLANET", "GAS_GIANT", "MOON", "ORBITAL_STATION", "ASTEROID_FIELD", "NEBULA", "DEBRIS_FIELD"]
+TRADE_GOODS = ["FUEL", "IRON_ORE", "COPPER_ORE", "ALUMINUM_ORE", "SILICON_CRYSTALS", "QUARTZ_SAND", "ICE_WATER",
+               "AMMONIA_ICE", "LIQUID_HYDROGEN", "FOOD", "MACHINERY", "ELECTRONICS", "MEDICINE", "FABRICS"]
+SHIP_TYPES = ["SHIP_PROBE", "SHIP_MINING_DRONE", "SHIP_LIGHT_HAULER", "SHIP_COMMAND_FRIGATE", "SHIP_EXPLORER"]
+
+
+class ApiError(Exception):
+    def __init__(self, status, code, message, data=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.data = data
+
+
+def flight_seconds(distance, multiplier, speed=COMMAND_SHIP_SPEED):
+    return round(max(1, round(distance)) * multiplier / speed + 15)
+
+
+def time_str(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def generate_universe(systems=12000, seed=0, radius=40000):
+    # Systems spread over a disc, 1-12 waypoints each, most of them uncharted. Every faction gets a headquarters.
+    rng = random.Random(seed)
+    symbols = set()
+    universe = {"systems": {}, "waypoints": {}, "factions": {}}
+    while len(symbols) < systems:
+        symbols.add("X1-" + "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789") for _ in range(4)))
+    for system in sorted(symbols):
+        r = math.sqrt(rng.random()) * radius
+        angle = rng.random() * 2 * math.pi
+        waypoints = []
+        for i in range(rng.randint(1, 12)):
+            symbol = system + "-" + str(i).zfill(2) + "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(4))
+            wp_type = "JUMP_GATE" if i == 0 and rng.random() < 0.3 else rng.choice(WAYPOINT_TYPES)
+            traits = []
+            if rng.random() < 0.2:
+                traits.append("MARKETPLACE")
+            if rng.random() < 0.05:
+                traits.append("SHIPYARD")
+            universe["waypoints"][symbol] = {
+                "symbol": symbol, "type": wp_type, "systemSymbol": system,
+                "x": rng.randint(-80, 80), "y": rng.randint(-80, 80),
+                "traits": traits, "charted": rng.random() < 0.02,
+                "exports": rng.sample(TRADE_GOODS, 2), "imports": rng.sample(TRADE_GOODS, 2),
+                "ships": rng.sample(SHIP_TYPES, 2),
+            }
+            waypoints.append(symbol)
+        universe["systems"][system] = {"symbol": system, "x": round(r * math.cos(angle)),
+                                       "y": round(r * math.sin(angle)), "waypoints": waypoints}
+    headquarters = rng.sample(sorted(symbols), len(FACTIONS))
+    for faction, system in zip(FACTIONS, headquarters):
+        hq = universe["systems"][system]["waypoints"][0]
+        universe["waypoints"][hq]["charted"] = True
+        universe["factions"][faction] = {"symbol": faction, "name": faction.title(), "headquarters": hq,
+                                         "isRecruiting": True}
+    return universe
+
+
+class ServerLimit:
+    # The server's side of the limits, written separately from the client's RateLimiter so that a client bug
+    # shows up as 429s instead of being agreed with: rate_limit requests in each fixed one-second window, and past
+    # that a pool of burst_limit requests that refills all at once burst_period after the first one is used.
+    def __init__(self, rate_limit, burst_limit, burst_period=10.0, clock=time.perf_counter):
+        self.rate_limit = rate_limit
+        self.burst_limit = burst_limit
+        self.burst_period = burst_period
+        self.clock = clock
+        self.window = None
+        self.window_count = 0
+        self.burst_count = 0
+        self.burst_reset = None
+        self.lock = threading.Lock()
+
+    def __refill(self, now):
+        window = int(now)
+        if window != self.window:
+            self.window = window
+            self.window_count = 0
+        if self.burst_reset is not None and now >= self.burst_reset:
+            self.burst_count = 0
+            self.burst_reset = None
+
+    def allow(self):
+        # 0 if the request is within the limits, otherwise seconds until one would be
+        with self.lock:
+            now = self.clock()
+            self.__refill(now)
+            if self.window_count < self.rate_limit:
+                self.window_count += 1
+                return 0
+            if self.burst_count < self.burst_limit:
+                if self.burst_reset is None:
+                    self.burst_reset = now + self.burst_period
+                self.burst_count += 1
+                return 0
+            return min(self.window + 1 - now, self.burst_reset - now)
+
+    def remaining(self):
+        with self.lock:
+            self.__refill(self.clock())
+            return self.rate_limit - self.window_count + self.burst_limit - self.burst_count
+
+
+class MockGame:
+    def __init__(self, universe, time_scale=1.0, rate_limit=2, burst_limit=10, burst_period=10.0):
+        self.universe = universe
+        self.time_scale = time_scale
+        self.limit = ServerLimit(rate_limit, burst_limit, burst_period=burst_period)
+        self.agents = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.error_counts = {}
+        self.systems_json = json.dumps([{"symbol": s["symbol"], "x": s["x"], "y": s["y"], "type": "RED_STAR",
+                                         "sectorSymbol": "X1", "waypoints": [], "factions": []}
+                                        for s in universe["systems"].values()])
+
+    def now(self):
+        return datetime.datetime.utcnow()
+
+    def travel(self, seconds):
+        # how long something takes in real time
+        return datetime.timedelta(seconds=seconds / self.time_scale)
+
+    def rate_limit_headers(self):
+        return {"x-ratelimit-type": "IP-based",
+                "x-ratelimit-limit-sustained": str(self.limit.rate_limit),
+                "x-ratelimit-limit-burst": str(self.limit.burst_limit),
+                "x-ratelimit-burst-duration": str(int(self.limit.burst_period)),
+                "x-ratelimit-remaining": str(self.limit.remaining())}
+
+    def handle(self, method, path, query, body, token):
+        # Returns (status, payload, extra headers)
+        wait = self.limit.allow()
+        with self.lock:
+            self.request_count += 1
+            if wait > 0:
+                self.rate_limited_count += 1
+                error = {"error": {"message": "You have reached your API limit.", "code": 429,
+                                   "data": {"type": "IP-based", "retryAfter": wait,
+                                            "limitBurst": self.limit.burst_limit,
+                                            "limitPerSecond": self.limit.rate_limit, "remaining": 0}}}
+                return 429, error, {"Retry-After": str(wait)}
+            try:
+                status, payload = self.route(method, path, query, body, token)
+            except ApiError as e:
+                self.error_counts[e.code] = self.error_counts.get(e.code, 0) + 1
+                error = {"message": str(e), "code": e.code}
+                if e.data is not None:
+                    error["data"] = e.data
+                return e.status, {"error": error}, {}
+        return status, payload, {}
+
+    def route(self, method, path, query, body, token):
+        if path == "" and method == "GET":
+            return 200, {"status": "SpaceTraders mock is up", "stats": {"agents": len(self.agents)}}
+        if path == "systems.json" and method == "GET":
+            return 200, self.systems_json
+        if path == "factions" and method == "GET":
+            return 200, self.page(list(self.universe["factions"].values()), query)
+        if path == "register" and method == "POST":
+            return self.register(body)
+
+        match = re.fullmatch(r"systems/([^/]+)/waypoints(?:/([^/]+)(?:/(market|shipyard))?)?", path)
+        if match and method == "GET":
+            system, waypoint, detail = match.groups()
+            if system not in self.universe["systems"]:
+                raise ApiError(404, 404, "System " + system + " not found.")
+            if waypoint is None:
+                waypoints = [self.waypoint_json(w) for w in self.universe["systems"][system]["waypoints"]]
+                return 200, self.page(waypoints, query)
+            if waypoint not in self.universe["waypoints"]:
+                raise ApiError(404, 404, "Waypoint " + waypoint + " not found.")
+            if detail is None:
+                return 200, {"data": self.waypoint_json(waypoint)}
+            return self.market(token, waypoint) if detail == "market" else self.shipyard(token, waypoint)
+
+        match = re.fullmatch(r"my/ships/([^/]+)(?:/(orbit|nav|navigate|warp|jump|chart))?", path)
+        if match:
+            ship = self.ship(token, match.group(1))
+            action = match.group(2)
+            if action is None and method == "GET":
+                return 200, {"data": self.ship_json(ship)}
+            if action == "orbit" and method == "POST":
+                return self.orbit(ship)
+            if action == "nav" and method == "PATCH":
+                return self.flight_mode(ship, body)
+            if action == "navigate" and method == "POST":
+                return self.navigate(ship, body)
+            if action == "warp" and method == "POST":
+                return self.warp(ship, body)
+            if action == "jump" and method == "POST":
+                return self.jump(ship, body)
+            if action == "chart" and method == "POST":
+                return self.chart(ship)
+        raise ApiError(404, 404, "Route " + method + " /" + path + " not found.")
+
+    @staticmethod
+    def page(items, query):
+        limit = int(query.get("limit", 10))
+        page = int(query.get("page", 1))
+        if limit < 1 or limit > 20:
+            raise ApiError(422, 422, "limit must be between 1 and 20")
+        return {"data": items[(page - 1) * limit:page * limit], "meta": {"total": len(items), "page": page,
+                                                                         "limit": limit}}
+
+    def register(self, body):
+        symbol = body.get("symbol", "")
+        faction = body.get("faction")
+        if not 3 <= len(symbol) <= 14:
+            raise ApiError(422, 422, "symbol must be 3-14 characters")
+        if faction not in self.universe["factions"]:
+            raise ApiError(422, 4205, "Faction " + str(faction) + " not found.")
+        if symbol.upper() in self.agents:
+            raise ApiError(409, 4111, "Agent symbol " + symbol + " has already been claimed.")
+        token = secrets.token_hex(16)
+        hq = self.universe["factions"][faction]["headquarters"]
+        ship = {"symbol": symbol.upper() + "-1", "agent": symbol.upper(), "waypoint": hq, "origin": hq,
+                "status": "DOCKED", "flightMode": "CRUISE", "fuel": COMMAND_SHIP_FUEL, "arrival": self.now(),
+                "departure": self.now(), "cooldown": self.now()}
+        self.agents[symbol.upper()] = {"symbol": symbol.upper(), "token": token, "faction": faction, "ship": ship}
+        self.tokens[token] = symbol.upper()
+        return 201, {"data": {"token": token, "agent": {"symbol": symbol.upper(), "headquarters": hq,
+                                                        "credits": 100000, "startingFaction": faction},
+                              "ship": self.ship_json(ship)}}
+
+    def ship(self, token, symbol):
+        agent = self.tokens.get(token)
+        if agent is None:
+            raise ApiError(401, 4100, "Missing or invalid token.")
+        ship = self.agents[agent]["ship"]
+        if ship["symbol"] != symbol:
+            raise ApiError(404, 4201, "Ship " + symbol + " not found.")
+        self.update(ship)
+        return ship
+
+    def update(self, ship):
+        if ship["status"] == "IN_TRANSIT" and ship["arrival"] <= self.now():
+            ship["status"] = "IN_ORBIT"
+
+    def in_transit(self, ship):
+        if ship["status"] == "IN_TRANSIT":
+            raise ApiError(400, 4214, "Ship is currently in-transit.", {
+                "departureSymbol": ship["origin"], "destinationSymbol": ship["waypoint"],
+                "arrival": time_str(ship["arrival"]), "departureTime": time_str(ship["departure"]),
+                "secondsToArrival": round((ship["arrival"] - self.now()).total_seconds())})
+
+    def not_in_orbit(self, ship):
+        if ship["status"] != "IN_ORBIT":
+            raise ApiError(400, 4236, "Ship is not currently in orbit at " + ship["waypoint"] + ".")
+
+    def orbit(self, ship):
+        self.in_transit(ship)
+        ship["status"] = "IN_ORBIT"
+        return 200, {"data": {"nav": self.nav_json(ship)}}
+
+    def flight_mode(self, ship, body):
+        mode = body.get("flightMode")
+        if mode not in ["DRIFT", "CRUISE", "BURN", "STEALTH"]:
+            raise ApiError(422, 422, "Invalid flight mode.")
+        ship["flightMode"] = mode
+        return 200, {"data": self.nav_json(ship)}
+
+    def depart(self, ship, destination, distance):
+        multiplier = DRIFT_MULTIPLIER if ship["flightMode"] == "DRIFT" else CRUISE_MULTIPLIER
+        if ship["flightMode"] != "DRIFT":
+            if distance > ship["fuel"]:
+                raise ApiError(400, 4203, "Ship has insufficient fuel.", {"fuelRequired": round(distance),
+                                                                          "fuelAvailable": ship["fuel"]})
+            ship["fuel"] -= round(distance)
+        ship["origin"] = ship["waypoint"]
+        ship["waypoint"] = destination
+        ship["status"] = "IN_TRANSIT"
+        ship["departure"] = self.now()
+        ship["arrival"] = self.now() + self.travel(flight_seconds(distance, multiplier))
+        return 200, {"data": {"fuel": {"current": ship["fuel"], "capacity": COMMAND_SHIP_FUEL},
+                              "nav": self.nav_json(ship)}}
+
+    def navigate(self, ship, body):
+        self.in_transit(ship)
+        self.not_in_orbit(ship)
+        destination = self.universe["waypoints"].get(body.get("waypointSymbol"))
+        if destination is None:
+            raise ApiError(404, 404, "Waypoint not found.")
+        here = self.universe["waypoints"][ship["waypoint"]]
+        if destination["symbol"] == here["symbol"]:
+            raise ApiError(400, 4204, "Navigate request failed. Ship is already at the destination.")
+        if destination["systemSymbol"] != here["systemSymbol"]:
+            raise ApiError(400, 4202, "Navigate request failed. Destination is in another system; use warp.")
+        return self.depart(ship, destination["symbol"], math.hypot(destination["x"] - here["x"],
+                                                                   destination["y"] - here["y"]))
+
+    def warp(self, ship, body):
+        self.in_transit(ship)
+        self.not_in_orbit(ship)
+        destination = self.universe["waypoints"].get(body.get("waypointSymbol"))
+        if destination is None:
+            raise ApiError(404, 404, "Waypoint not found.")
+        here = self.universe["waypoints"][ship["waypoint"]]
+        if destination["systemSymbol"] == here["systemSymbol"]:
+            raise ApiError(400, 4235, "Warp request failed. Destination is in the same system; use navigate.")
+        origin = self.universe["systems"][here["systemSymbol"]]
+        target = self.universe["systems"][destination["systemSymbol"]]
+        return self.depart(ship, destination["symbol"], math.hypot(target["x"] - origin["x"],
+                                                                   target["y"] - origin["y"]))
+
+    def jump(self, ship, body):
+        self.in_transit(ship)
+        self.not_in_orbit(ship)
+        here = self.universe["waypoints"][ship["waypoint"]]
+        if here["type"] != "JUMP_GATE":
+            raise ApiError(400, 4208, "Ship is not at a jump gate.")
+        if ship["cooldown"] > self.now():
+            raise ApiError(409, 4000, "Ship action is still on cooldown.", {
+                "cooldown": {"remainingSeconds": round((ship["cooldown"] - self.now()).total_seconds())}})
+        target = self.universe["systems"].get(body.get("systemSymbol"))
+        if target is None:
+            raise ApiError(404, 404, "System not found.")
+        gate = self.universe["waypoints"][target["waypoints"][0]]
+        origin = self.universe["systems"][here["systemSymbol"]]
+        distance = math.hypot(target["x"] - origin["x"], target["y"] - origin["y"])
+        if gate["type"] != "JUMP_GATE" or distance > JUMP_GATE_RANGE:
+            raise ApiError(400, 4209, "No jump gate connection to " + target["symbol"] + ".")
+        ship["origin"] = ship["waypoint"]
+        ship["waypoint"] = gate["symbol"]
+        ship["departure"] = ship["arrival"] = self.now()
+        ship["cooldown"] = self.now() + self.travel(JUMP_COOLDOWN)
+        return 200, {"data": {"cooldown": {"remainingSeconds": JUMP_COOLDOWN}, "nav": self.nav_json(ship)}}
+
+    def chart(self, ship):
+        self.in_transit(ship)
+        waypoint = self.universe["waypoints"][ship["waypoint"]]
+        if waypoint["charted"]:
+            raise ApiError(400, 4230, "Waypoint already charted: " + waypoint["symbol"])
+        waypoint["charted"] = True
+        waypoint["chartedBy"] = self.agents[ship["agent"]]["symbol"]
+        waypoint_json = self.waypoint_json(waypoint["symbol"])
+        return 201, {"data": {"chart": waypoint_json["chart"], "waypoint": waypoint_json}}
+
+    def present(self, token, waypoint):
+        agent = self.tokens.get(token)
+        if agent is None:
+            return False
+        ship = self.agents[agent]["ship"]
+        self.update(ship)
+        return ship["waypoint"] == waypoint and ship["status"] != "IN_TRANSIT"
+
+    def market(self, token, symbol):
+        waypoint = self.universe["waypoints"][symbol]
+        if "MARKETPLACE" not in waypoint["traits"] or not waypoint["charted"]:
+            raise ApiError(400, 4603, "Market not found at " + symbol + ".")
+        market = {"symbol": symbol, "exports": [{"symbol": s} for s in waypoint["exports"]],
+                  "imports": [{"symbol": s} for s in waypoint["imports"]], "exchange": [{"symbol": "FUEL"}]}
+        if self.present(token, symbol):
+            market["tradeGoods"] = [{"symbol": s, "tradeVolume": 100, "supply": "MODERATE", "purchasePrice": 40,
+                                     "sellPrice": 35} for s in waypoint["exports"] + waypoint["imports"] + ["FUEL"]]
+        return 200, {"data": market}
+
+    def shipyard(self, token, symbol):
+        waypoint = self.universe["waypoints"][symbol]
+        if "SHIPYARD" not in waypoint["traits"] or not waypoint["charted"]:
+            raise ApiError(400, 4601, "Shipyard not found at " + symbol + ".")
+        shipyard = {"symbol": symbol, "shipTypes": [{"type": t} for t in waypoint["ships"]]}
+        if self.present(token, symbol):
+            shipyard["ships"] = [{"type": t, "name": t.title(), "purchasePrice": 50000} for t in waypoint["ships"]]
+        return 200, {"data": shipyard}
+
+    def waypoint_json(self, symbol):
+        waypoint = self.universe["waypoints"][symbol]
+        wp = {"symbol": symbol, "type": waypoint["type"], "systemSymbol": waypoint["systemSymbol"],
+              "x": waypoint["x"], "y": waypoint["y"], "orbitals": []}
+        if waypoint["charted"]:
+            wp["traits"] = [{"symbol": t, "name": t.title(), "description": ""} for t in waypoint["traits"]]
+            wp["chart"] = {"waypointSymbol": symbol, "submittedBy": waypoint.get("chartedBy", "COSMIC")}
+        else:
+            wp["traits"] = [{"symbol": "UNCHARTED", "name": "Uncharted", "description": ""}]
+        return wp
+
+    def nav_json(self, ship):
+        waypoint = self.universe["waypoints"][ship["waypoint"]]
+        origin = self.universe["waypoints"][ship["origin"]]
+        return {"systemSymbol": waypoint["systemSymbol"], "waypointSymbol": ship["waypoint"],
+                "route": {"departure": {"symbol": origin["symbol"], "systemSymbol": origin["systemSymbol"]},
+                          "destination": {"symbol": waypoint["symbol"], "systemSymbol": waypoint["systemSymbol"]},
+                          "departureTime": time_str(ship["departure"]), "arrival": time_str(ship["arrival"])},
+                "status": ship["status"], "flightMode": ship["flightMode"]}
+
+    def ship_json(self, ship):
+        return {"symbol": ship["symbol"], "nav": self.nav_json(ship),
+                "fuel": {"current": ship["fuel"], "capacity": COMMAND_SHIP_FUEL}}
+
+    def stats(self):
+        charted = sum(1 for wp in self.universe["waypoints"].values() if wp["charted"])
+        return {"requests": self.request_count, "rate_limited": self.rate_limited_count, "errors": self.error_counts,
+                "agents": len(self.agents), "charted": charted, "waypoints": len(self.universe["waypoints"])}
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    game = None
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.respond("GET")
+
+    def do_POST(self):
+        self.respond("POST")
+
+    def do_PATCH(self):
+        self.respond("PATCH")
+
+    def respond(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        if path.startswith("/v2"):
+            path = path[3:]
+        path = path.strip("/")
+        query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = {}
+        if length:
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}") or {}
+            except ValueError:
+                body = {}
+        token = None
+        authorization = self.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            token = authorization[7:]
+
+        status, payload, headers = self.game.handle(method, path, query, body, token)
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+        data = payload.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in dict(self.game.rate_limit_headers(), **headers).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(game, host="127.0.0.1", port=8000):
+    handler = type("Handler", (MockHandler,), {"game": game})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local SpaceTraders stand-in for offline testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--systems", type=int, default=12000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--time-scale", type=float, default=100.0, help="how many times faster ships travel")
+    parser.add_argument("--rate", type=int, default=2, help="sustained requests per second")
+    parser.add_argument("--burst", type=int, default=10, help="extra requests per burst window")
+    args = parser.parse_args()
+
+    universe = generate_universe(args.systems, args.seed)
+    game = MockGame(universe, args.time_scale, args.rate, args.burst)
+    server = serve(game, args.host, args.port)
+    print("Mock SpaceTraders API with", len(universe["systems"]), "systems and", len(universe["waypoints"]),
+          "waypoints on http://" + args.host + ":" + str(args.port) + "/v2/")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        while True:
+            threading.Event().wait(60)
+            print(game.stats())
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,34 @@
-from main import rh
+from main import config
+from make_requests import RequestHandler, SimpleTransport
 
 
-def main():
-    rh.start_pacing()
+def pace(handler, label):
+    print(label)
+    handler.start_pacing()
     for i in range(1, 181):
-        rh.get("")
+        handler.get("")
         print("\ri = " + str(i), end="")
     print()
-    rapm = rh.get_rpm(False, True)
-    rspm = rh.get_rpm(True, True)
+    rapm = handler.get_rpm(False, True)
+    rspm = handler.get_rpm(True, True)
 
     print("Attempted pace (/min, /sec):", rapm, rapm / 60)
     print("Succeeded pace: (/min, /sec)", rspm, rspm / 60)
-    print("Success Percentage:", rh.pacing_src / rh.pacing_rc * 100)
-    if rh.pacing_rc != rh.pacing_src:
-        print("Failed Attempts:", rh.pacing_rc - rh.pacing_src)
-    print("******************************************")
+    print("Success Percentage:", handler.pacing_src / handler.pacing_rc * 100)
+    if handler.pacing_rc != handler.pacing_src:
+        print("Failed Attempts:", handler.pacing_rc - handler.pacing_src)
+    print("Average latency (ms):", handler.get_latency() * 1000)
 
 
-if __name__ == '__main__':
+def main():
+    # Handlers of its own, without the response cache, so pacing never opens the database
+    rh = RequestHandler(base_url=config.api_url)
+    unpooled_rh = RequestHandler(limiter=rh.limiter, transport=SimpleTransport(), base_url=config.api_url)
     while True:
-        main()
\ No newline at end of file
+        pace(rh, "Pooled connections:")
+        pace(unpooled_rh, "New connection per request:")
+        print("******************************************")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import collections
+import threading
+import time
+
+
+class RateLimiter:
+    # Sliding window log of the SpaceTraders limits: rate_limit requests per rate_period,
+    # with up to burst_limit more per burst_period once the static window is full.
+    # 2/s + 10/10s gives the theoretical 180 requests per minute.
+    def __init__(self, rate_limit: int = 2, burst_limit: int = 10, rate_period: float = 1.0,
+                 burst_period: float = 10.0, margin: float = 0.01, max_margin: float = 0.25,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.rate_limit = rate_limit
+        self.burst_limit = burst_limit
+        self.rate_period = rate_period
+        self.burst_period = burst_period
+        self.margin = margin
+        self.base_margin = margin
+        self.max_margin = max_margin
+        self.paused_until = None
+        self.clock = clock
+        self.sleep = sleep
+        self.rate_times = collections.deque()
+        self.burst_times = collections.deque()
+        self.lock = threading.Lock()
+
+    def __clear_old(self, now):
+        while self.rate_times and now - self.rate_times[0] >= self.rate_period + self.margin:
+            self.rate_times.popleft()
+        while self.burst_times and now - self.burst_times[0] >= self.burst_period + self.margin:
+            self.burst_times.popleft()
+
+    def __time_to_slot(self, now):
+        if len(self.rate_times) < self.rate_limit or len(self.burst_times) < self.burst_limit:
+            return 0
+        rate_clear = self.rate_times[0] + self.rate_period + self.margin - now
+        burst_clear = self.burst_times[0] + self.burst_period + self.margin - now
+        return max(min(rate_clear, burst_clear), 0)
+
+    def time_to_slot(self):
+        with self.lock:
+            now = self.clock()
+            self.__clear_old(now)
+            return self.__time_to_slot(now)
+
+    def try_acquire(self):
+        with self.lock:
+            now = self.clock()
+            if self.paused_until is not None:
+                if now < self.paused_until:
+                    return self.paused_until - now
+                self.paused_until = None
+            self.__clear_old(now)
+            if len(self.rate_times) < self.rate_limit:
+                self.rate_times.append(now)
+            elif len(self.burst_times) < self.burst_limit:
+                self.burst_times.append(now)
+            else:
+                return max(self.__time_to_slot(now), 0.001)
+            return 0
+
+    def acquire(self):
+        wait = self.try_acquire()
+        while wait > 0:
+            self.sleep(wait)
+            wait = self.try_acquire()
+
+    def available(self):
+        with self.lock:
+            self.__clear_old(self.clock())
+            return self.rate_limit - len(self.rate_times) + self.burst_limit - len(self.burst_times)
+
+    def pause(self, seconds: float):
+        with self.lock:
+            until = self.clock() + seconds
+            if self.paused_until is None or until > self.paused_until:
+                self.paused_until = until
+
+    def configure(self, rate_limit: int = None, burst_limit: int = None, burst_period: float = None):
+        with self.lock:
+            if rate_limit is not None:
+                self.rate_limit = rate_limit
+            if burst_limit is not None:
+                self.burst_limit = burst_limit
+            if burst_period is not None:
+                self.burst_period = burst_period
+
+    def penalize(self):
+        # a 429 we caused ourselves means the server sees our requests closer together than we do
+        with self.lock:
+            self.margin = min(max(self.margin * 2, 0.01), self.max_margin)
+
+    def recover(self, factor: float = 0.99):
+        with self.lock:
+            self.margin = max(self.margin * factor, self.base_margin)
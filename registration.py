@@ -0,0 +1,121 @@
+import math
+import threading
+import time
+
+from log import Log
+
+
+class RegistrationPipeline:
+    # Registers agents on background threads, in order, and hands each new ship to launch() as soon as it exists,
+    # so the first ships are warping while the rest are still being registered.
+    # registrations are functions that register one agent and return its ship.
+    def __init__(self, registrations, launch, workers: int = 1, log: Log = None):
+        self.registrations = iter(registrations)
+        self.launch = launch
+        self.workers = workers
+        if log is None:
+            log = Log()
+        self.log = log
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.running = 0
+        self.registered = 0
+        self.failed = 0
+
+    def start(self):
+        with self.lock:
+            self.running = self.workers
+        for i in range(self.workers):
+            threading.Thread(target=self.__run, name="Registration", daemon=True).start()
+        return self
+
+    def __run(self):
+        while True:
+            with self.lock:
+                registration = next(self.registrations, None)
+            if registration is None:
+                break
+            try:
+                ship = registration()
+            except Exception as e:
+                self.log.error("ships", "registration failed:", repr(e))
+                with self.lock:
+                    self.failed += 1
+                continue
+            with self.lock:
+                self.registered += 1
+            self.launch(ship)
+        with self.lock:
+            self.running -= 1
+            if self.running == 0:
+                self.finished.set()
+
+    def wait(self, timeout: float = None):
+        return self.finished.wait(timeout)
+
+
+def makespan(missions, rate=3.0, launch_calls=3, pooled=0, pipelined=True):
+    # Seconds until the last ship finishes. missions are how long each ship takes from launch, in registration order.
+    # Every request takes 1/rate of the rate limit; the first `pooled` agents are already registered.
+    # Without pipelining every agent is registered before the first ship launches. With it, each ship's launch
+    # (at HIGH) goes out before the next registration.
+    t = 0.0
+    finish = 0.0
+    if not pipelined:
+        t = max(len(missions) - pooled, 0) / rate
+    for i, mission in enumerate(missions):
+        if pipelined and i >= pooled:
+            t += 1 / rate
+        t += launch_calls / rate
+        finish = max(finish, t + mission)
+    return finish
+
+
+def main():
+    # Makespan of registering and launching every account on a generated universe, before and after pipelining
+    from account_planner import WEEK_SECONDS, chain_seconds, plan_accounts, tour_seconds, warp_seconds
+    from mock_server import generate_universe
+    from spatial import SpatialIndex
+
+    start = time.time()
+    universe = generate_universe()
+    positions = {s: (data["x"], data["y"]) for s, data in universe["systems"].items()}
+    tours = {}
+    for system, data in universe["systems"].items():
+        rows = []
+        for symbol in data["waypoints"]:
+            wp = universe["waypoints"][symbol]
+            rows.append((symbol, system, wp["charted"], False, False, False, wp["x"], wp["y"]))
+        tours[system] = tour_seconds(rows)
+    headquarters = {f: positions[data["headquarters"][:-7]] for f, data in universe["factions"].items()}
+    gates = {s for s, data in universe["systems"].items()
+             if universe["waypoints"][data["waypoints"][0]]["type"] == "JUMP_GATE"}
+
+    hq_index = SpatialIndex.from_positions(headquarters)
+    closest = dict(zip(positions, hq_index.nearest(list(positions.values()))))
+    one_per_system = sorted(positions, key=lambda s: closest[s][0], reverse=True)
+    single = [warp_seconds(closest[s][0]) + tours[s] for s in one_per_system]
+    chains = plan_accounts(positions, headquarters, tours, gates)
+    chained = [chain_seconds(chain, positions, headquarters, tours) for chain in chains]
+    print("Generated", len(positions), "systems and planned", len(chains), "accounts in",
+          round(time.time() - start, 1), "s")
+
+    def hours(seconds):
+        return str(round(seconds / 3600, 2)) + " h"
+
+    for label, missions in [("One account per system", single), ("Planned accounts", chained)]:
+        before = makespan(missions, pipelined=False)
+        after = makespan(missions)
+        pooled = makespan(missions, pooled=min(len(missions), 500))
+        print(label + ":", len(missions), "registrations")
+        print("  Register everything, then launch:", hours(before))
+        print("  Pipelined:", hours(after), "(" + str(round((before - after) / before * 100, 1)) + "% shorter)")
+        print("  Pipelined with 500 pre-registered:", hours(pooled))
+        first = [0.0] + [-math.inf] * (len(missions) - 1)
+        print("  First ship launched after:", round(makespan(first, pipelined=False)), "s ->",
+              round(makespan(first), 1), "s ->", round(makespan(first, pooled=1), 1), "s from the pool")
+        print("  Longest mission:", hours(max(missions)), " Fits in the week:", after <= WEEK_SECONDS)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,11 @@
 from main import *
 
+TOKEN_POOL_SIZE = 200  # agents registered straight after the reset, so the first ships launch without waiting
 
-if __name__ == '__main__':
-    weekly_reset = False
-    if weekly_reset:
-        x = input("Are you sure you want to reset agents? (Y/n): ")
-        if x != "Y":
-            weekly_reset = False
+
+def reset(weekly_reset=False):
+    # Refetches every system and waypoint. A weekly reset also clears every agent and plan, builds next week's plan
+    # and fills the token pool.
     if weekly_reset:
         i = 10
         while i > 0:
@@ -14,9 +13,30 @@ if __name__ == '__main__':
             i -= 1
             time.sleep(1)
         clear_table("Agents")
+        clear_table("Plans")
+        clear_table("Tokens")
 
+    app.rh.cache.clear()
     populate_systems()
     populate_waypoints()
+    if weekly_reset:
+        from account_planner import build_plan
+        save_plan(build_plan())
+        fill_token_pool(TOKEN_POOL_SIZE)
     print('\n')
-    print(rh.get_rpm(False))
-    print(rh.get_rpm())
+    print(app.rh.get_rpm(False))
+    print(app.rh.get_rpm())
+    print(app.rh.cache.stats(), "collapsed:", app.rh.collapsed_count)
+
+
+def main():
+    weekly_reset = False
+    if weekly_reset:
+        x = input("Are you sure you want to reset agents? (Y/n): ")
+        if x != "Y":
+            weekly_reset = False
+    reset(weekly_reset)
+
+
+if __name__ == '__main__':
+    main()
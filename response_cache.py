@@ -0,0 +1,177 @@
+import collections
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+
+# (endpoint pattern, seconds to keep a response, whether the response depends on who's asking)
+# Markets and shipyards only show prices to an agent with a ship there, so those are cached per token.
+DEFAULT_TTLS = [
+    (r"^systems\.json$", 24 * 60 * 60, False),
+    (r"^factions$", 24 * 60 * 60, False),
+    (r"^systems/[^/]+/waypoints/[^/]+/(market|shipyard)$", 5 * 60, True),
+    (r"^systems/[^/]+/waypoints/[^/]+$", 60 * 60, False),
+    (r"^systems/[^/]+/waypoints$", 60 * 60, False),
+]
+
+
+class CachedResponse:
+    # The parts of a requests.Response the rest of the code uses
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(response.status_code, dict(response.headers), response.text)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class CacheEntry:
+    def __init__(self, expires, response):
+        self.expires = expires
+        self.response = response
+
+    def validators(self):
+        # headers for a conditional request, if the server gave us anything to validate against
+        headers = {}
+        for header, conditional in [("ETag", "If-None-Match"), ("Last-Modified", "If-Modified-Since")]:
+            for name, value in self.response.headers.items():
+                if name.lower() == header.lower():
+                    headers[conditional] = value
+        return headers
+
+
+class ResponseCache:
+    # GET responses kept for a per-endpoint TTL: the most recently used in memory, all of them on disk in SQLite
+    # (if a path is given) so they survive a restart. Expired entries are kept around for conditional requests.
+    def __init__(self, path=None, ttls=None, max_entries=5000, clock=time.time):
+        if ttls is None:
+            ttls = DEFAULT_TTLS
+        self.ttls = [(re.compile(pattern), ttl, private) for pattern, ttl, private in ttls]
+        self.max_entries = max_entries
+        self.clock = clock
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        if path is not None:
+            self.connection().execute("CREATE TABLE IF NOT EXISTS Responses (Key TEXT PRIMARY KEY, Expires REAL, "
+                                      "Status INTEGER, Headers TEXT, Body TEXT)")
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def rule(self, endpoint):
+        for pattern, ttl, private in self.ttls:
+            if pattern.match(endpoint):
+                return ttl, private
+        return None
+
+    def key(self, endpoint, params=None, token=None):
+        # None if responses from this endpoint aren't cached
+        rule = self.rule(endpoint)
+        if rule is None:
+            return None
+        key = endpoint
+        if params:
+            key += "?" + urllib.parse.urlencode(sorted((str(k), str(v)) for k, v in params.items()))
+        if rule[1] and token is not None:
+            key += "#" + hashlib.sha256(token.encode()).hexdigest()[:16]
+        return key
+
+    def ttl(self, key):
+        return self.rule(key.split("?")[0].split("#")[0])[0]
+
+    def get(self, key):
+        # A response that's still fresh, or None
+        entry = self.entry(key)
+        if entry is None or entry.expires <= self.clock():
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return entry.response
+
+    def entry(self, key):
+        # The cached entry, fresh or not
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.path is None:
+            return None
+        row = self.connection().execute("SELECT Expires, Status, Headers, Body FROM Responses WHERE Key = ?",
+                                        (key,)).fetchone()
+        if row is None:
+            return None
+        entry = CacheEntry(row[0], CachedResponse(row[1], json.loads(row[2]), row[3]))
+        with self.lock:
+            self.disk_hits += 1
+            self.__remember(key, entry)
+        return entry
+
+    def put(self, key, response):
+        response = CachedResponse.from_response(response)
+        entry = CacheEntry(self.clock() + self.ttl(key), response)
+        with self.lock:
+            self.__remember(key, entry)
+        if self.path is not None:
+            self.connection().execute("INSERT OR REPLACE INTO Responses (Key, Expires, Status, Headers, Body) "
+                                      "VALUES (?, ?, ?, ?, ?)", (key, entry.expires, response.status_code,
+                                                                 json.dumps(response.headers), response.text))
+        return response
+
+    def refresh(self, key, entry):
+        # The server said our copy is still good (304), so keep it for another TTL
+        entry.expires = self.clock() + self.ttl(key)
+        with self.lock:
+            self.revalidated += 1
+            self.__remember(key, entry)
+        if self.path is not None:
+            self.connection().execute("UPDATE Responses SET Expires = ? WHERE Key = ?", (entry.expires, key))
+        return entry.response
+
+    def __remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, prefix):
+        # Drops every entry whose key starts with prefix, e.g. a system's waypoints once one of them is charted
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+        if self.path is not None:
+            self.connection().execute("DELETE FROM Responses WHERE substr(Key, 1, ?) = ?", (len(prefix), prefix))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.path is not None:
+            self.connection().execute("DELETE FROM Responses")
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "revalidated": self.revalidated, "entries": len(self.entries)}
@@ -0,0 +1,206 @@
+import heapq
+import math
+import time
+
+
+DRIFT_MULTIPLIER = 250
+COMMAND_SHIP_SPEED = 30
+
+
+def drift_seconds(distance, speed=COMMAND_SHIP_SPEED):
+    # SpaceTraders flight time: round(max(1, distance)) * multiplier / speed + 15
+    return round(max(1, round(distance)) * DRIFT_MULTIPLIER / speed + 15)
+
+
+def distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+def path_length(points, order, origin=None):
+    total = 0.0
+    if origin is not None and order:
+        total += distance(origin, points[order[0]])
+    for i in range(1, len(order)):
+        total += distance(points[order[i - 1]], points[order[i]])
+    return total
+
+
+def path_drift_seconds(points, order, origin=None):
+    total = 0
+    if origin is not None and order:
+        total += drift_seconds(distance(origin, points[order[0]]))
+    for i in range(1, len(order)):
+        total += drift_seconds(distance(points[order[i - 1]], points[order[i]]))
+    return total
+
+
+def nearest_neighbour(points, start):
+    unvisited = set(range(len(points)))
+    unvisited.discard(start)
+    order = [start]
+    current = points[start]
+    while unvisited:
+        nearest = min(unvisited, key=lambda i: distance(current, points[i]))
+        unvisited.remove(nearest)
+        order.append(nearest)
+        current = points[nearest]
+    return order
+
+
+def nearest_neighbour_from(points, origin):
+    nearest = min(range(len(points)), key=lambda i: distance(origin, points[i]))
+    return nearest_neighbour(points, nearest)
+
+
+def edge(a, b):
+    # missing ends of an open path cost nothing
+    if a is None or b is None:
+        return 0
+    return distance(a, b)
+
+
+def two_opt(points, order, origin=None):
+    # Open path: there's no edge back to the start, and without an origin the start itself can move.
+    n = len(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n - 1):
+            a = points[order[i - 1]] if i > 0 else origin
+            for j in range(i + 1, n):
+                b = points[order[i]]
+                c = points[order[j]]
+                d = points[order[j + 1]] if j + 1 < n else None
+                if edge(a, c) + edge(b, d) < edge(a, b) + edge(c, d) - 1e-9:
+                    order[i:j + 1] = reversed(order[i:j + 1])
+                    improved = True
+    return order
+
+
+def neighbour_lists(points, k):
+    # Each point's k nearest others, closest first
+    return [heapq.nsmallest(k, (j for j in range(len(points)) if j != i), key=lambda j: distance(p, points[j]))
+            for i, p in enumerate(points)]
+
+
+def or_opt(points, order, origin=None, max_segment=3, neighbours=8, max_passes=20):
+    # Move runs of up to max_segment points (either way round) to wherever they fit best. A run only gets tried next
+    # to the nearest few points to either of its ends, since that's where any good spot is, and each pass sweeps the
+    # path once without starting over after every move, so a pass costs O(n) moves instead of O(n^2).
+    n = len(order)
+    near = neighbour_lists(points, neighbours)
+    position = [0] * n
+    for k, v in enumerate(order):
+        position[v] = k
+    for _ in range(max_passes):
+        improved = False
+        for size in range(1, min(max_segment, n - 1) + 1):
+            for i in range(n - size + 1):
+                prev = points[order[i - 1]] if i > 0 else origin
+                nxt = points[order[i + size]] if i + size < n else None
+                first = points[order[i]]
+                last = points[order[i + size - 1]]
+                gain = edge(prev, first) + edge(last, nxt) - edge(prev, nxt)
+                if gain <= 1e-9:
+                    continue
+                # gaps g between order[g - 1] and order[g], next to a neighbour of either end, or the ends of the path
+                gaps = {0, n}
+                for c in near[order[i]] + near[order[i + size - 1]]:
+                    gaps.add(position[c])
+                    gaps.add(position[c] + 1)
+                best = None
+                for g in gaps:
+                    if i <= g <= i + size:
+                        continue
+                    p = points[order[g - 1]] if g > 0 else origin
+                    q = points[order[g]] if g < n else None
+                    removed = edge(p, q)
+                    forward = edge(p, first) + edge(last, q) - removed
+                    backward = edge(p, last) + edge(first, q) - removed
+                    cost = min(forward, backward)
+                    if cost < gain - 1e-9 and (best is None or cost < best[0]):
+                        best = (cost, g, backward < forward)
+                if best is None:
+                    continue
+                _, g, reverse = best
+                segment = order[i:i + size]
+                if reverse:
+                    segment.reverse()
+                j = g if g < i else g - size
+                rest = order[:i] + order[i + size:]
+                order[:] = rest[:j] + segment + rest[j:]
+                for k, v in enumerate(order):
+                    position[v] = k
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def plan_tour(points, origin=None, max_starts=12):
+    # Order points into a short open path. With an origin the path starts from there (the ship's current position),
+    # otherwise the best starting point is picked too (where to warp in).
+    if len(points) <= 1:
+        return list(range(len(points)))
+    if origin is not None:
+        order = nearest_neighbour_from(points, origin)
+    else:
+        starts = range(len(points))
+        if len(points) > max_starts:
+            # the best start of an open path is almost always on the edge of the system
+            cx = sum(p[0] for p in points) / len(points)
+            cy = sum(p[1] for p in points) / len(points)
+            starts = sorted(starts, key=lambda i: -distance((cx, cy), points[i]))[:max_starts]
+        order = min((nearest_neighbour(points, s) for s in starts), key=lambda o: path_length(points, o))
+    order = two_opt(points, order, origin)
+    order = or_opt(points, order, origin)
+    return two_opt(points, order, origin)
+
+
+def plan_route(waypoints, origin=None):
+    # waypoints are universe rows (..., x, y). Rows without coordinates keep their original order.
+    if any(wp[6] is None for wp in waypoints):
+        return list(waypoints)
+    points = [(wp[6], wp[7]) for wp in waypoints]
+    if origin is not None and origin[6] is not None:
+        order = plan_tour(points, (origin[6], origin[7]))
+    else:
+        order = plan_tour(points)
+    return [waypoints[i] for i in order]
+
+
+def main():
+    from main import get_universe
+
+    universe = get_universe()
+    systems = 0
+    saved = 0
+    before_total = 0
+    planning_time = 0.0
+    slowest = 0.0
+    for system in universe.all_systems():
+        waypoints = [wp for wp in universe.waypoints_in(system) if not wp[2] and wp[6] is not None]
+        if len(waypoints) < 2:
+            continue
+        points = [(wp[6], wp[7]) for wp in waypoints]
+        start = time.perf_counter()
+        order = plan_tour(points)
+        elapsed = time.perf_counter() - start
+        before = path_drift_seconds(points, list(range(len(points))))
+        after = path_drift_seconds(points, order)
+        systems += 1
+        before_total += before
+        saved += before - after
+        planning_time += elapsed
+        slowest = max(slowest, elapsed)
+
+    print("Systems planned:", systems)
+    print("Drift time in table order (hours):", round(before_total / 3600, 1))
+    print("Drift time saved (hours):", round(saved / 3600, 1))
+    if systems:
+        print("Average planning time (ms):", round(planning_time / systems * 1000, 3))
+        print("Slowest system (ms):", round(slowest * 1000, 3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import concurrent.futures
+import datetime
+import heapq
+import itertools
+import threading
+
+from log import Log
+
+
+class ArrivalScheduler:
+    # Sleeping ships are just (wake time, task) entries on a heap, so a ship in transit costs no thread.
+    # A task is called on a worker thread when it comes due and returns the datetime it next wants to
+    # be woken at, or None once it's finished.
+    def __init__(self, max_workers: int = 32, log: Log = None):
+        self.max_workers = max_workers
+        if log is None:
+            log = Log()
+        self.log = log
+        self.timers = []
+        self.counter = itertools.count()
+        self.lock = threading.Condition()
+        self.running = 0
+        self.failed = 0
+        self.executor = None
+        self.timer_thread = None
+        self.stopped = False
+
+    def start(self):
+        with self.lock:
+            if self.timer_thread is not None:
+                return
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                  thread_name_prefix="ShipWorker")
+            self.timer_thread = threading.Thread(target=self.__run_timers, name="ArrivalScheduler", daemon=True)
+            self.timer_thread.start()
+
+    def schedule(self, when: datetime.datetime, task):
+        if when is None:
+            when = datetime.datetime.utcnow()
+        with self.lock:
+            heapq.heappush(self.timers, (when, next(self.counter), task))
+            self.lock.notify_all()
+
+    def __run_timers(self):
+        while True:
+            with self.lock:
+                while True:
+                    if self.stopped:
+                        return
+                    if self.timers:
+                        wait = (self.timers[0][0] - datetime.datetime.utcnow()) / datetime.timedelta(seconds=1)
+                        if wait <= 0:
+                            break
+                        self.lock.wait(wait)
+                    else:
+                        self.lock.wait()
+                _, _, task = heapq.heappop(self.timers)
+                self.running += 1
+            self.executor.submit(self.__run_task, task)
+
+    def __run_task(self, task):
+        try:
+            when = task()
+        except Exception as e:
+            self.log.error("ships", "scheduled task failed:", repr(e))
+            when = None
+            with self.lock:
+                self.failed += 1
+        with self.lock:
+            self.running -= 1
+            if when is not None:
+                heapq.heappush(self.timers, (when, next(self.counter), task))
+            self.lock.notify_all()
+
+    def sleeping(self):
+        with self.lock:
+            return len(self.timers)
+
+    def active(self):
+        with self.lock:
+            return self.running
+
+    def wait(self, timeout: float = None):
+        with self.lock:
+            return self.lock.wait_for(lambda: not self.timers and not self.running, timeout)
+
+    def stop(self):
+        # Lets the timer thread and workers finish so a finished scheduler doesn't keep its threads around
+        with self.lock:
+            self.stopped = True
+            self.lock.notify_all()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
@@ -1,156 +1,306 @@
+import array
+import sys
+
 from main import *
+from make_requests import DEADLINE_SLACK
+from route_planner import plan_route
+
+
+# Where a ship is in charting its systems. Saved to the Agents table on every change, so a restarted ship carries on
+# from exactly where it was without asking the API.
+REGISTERED = "REGISTERED"  # registered, still docked at its faction headquarters
+ORBITED = "ORBITED"  # in orbit
+DRIFTING = "DRIFTING"  # in drift mode and ready to warp to the next system
+WARPING = "WARPING"  # warping into System, arriving at Waypoint at Arrival
+CHARTING = "CHARTING"  # charting System: Stop stops in, at or heading to Waypoint (arriving at Arrival)
+VERIFYING = "VERIFYING"  # every stop charted, checking nothing in System is still uncharted
+DONE = "DONE"
+STATES = [REGISTERED, ORBITED, DRIFTING, WARPING, CHARTING, VERIFYING, DONE]
 
 
 class Ship:
-    def __init__(self, ID, Token, System, Arrival=None, Completed=None, printID = None):
+    # One per account, so there can be tens of thousands: no __dict__, symbols interned so every ship in a system
+    # shares the universe's copy, and routes kept as positions in the UniverseIndex rather than copies of its rows.
+    __slots__ = ("ID", "Token", "System", "Arrival", "Completed", "printID", "Waypoint", "Chain", "route",
+                 "research_route", "State", "Stop")
+
+    def __init__(self, ID, Token, System, Arrival=None, Completed=None, printID = None, Waypoint=None, Chain=None,
+                 State=None, Stop=None):
         self.ID = ID
         self.Token = Token
-        self.System = System
+        self.System = sys.intern(System)
         self.Arrival = Arrival
         self.Completed = Completed
         self.printID = printID
-        self.waypoints = []
+        self.Waypoint = None if Waypoint is None else sys.intern(Waypoint)
+        self.Chain = Chain
+        self.route = None  # array of UniverseIndex positions, the next stop first
+        self.research_route = None
+        if State is None:
+            State = self.infer_state()
+        self.State = sys.intern(State)
+        self.Stop = Stop or 0
 
-    def add_waypoint(self, waypoint):
-        if waypoint not in self.waypoints:
-            self.waypoints.append(waypoint)
+    def infer_state(self):
+        # For agents saved before states were: the closest state their Arrival and Completed allow
+        if self.Completed:
+            return DONE
+        if self.Arrival is not None:
+            return CHARTING
+        if self.leg() > 0:
+            return DRIFTING
+        return REGISTERED
 
-    def start(self):
-        if self.Completed is not None and self.Completed:
-            print("Closing completed thread", self.printID)
-            return
-        if self.waypoints:
-            all_waypoints = self.waypoints
-        else:
-            all_waypoints = db_get("Waypoints")
-            for wp in all_waypoints:
-                if wp[1] == self.System:
-                    self.waypoints.append(wp)
-        relevant_waypoints = []
-        for wp in all_waypoints:
-            if wp[1] == self.System and not wp[2]:
-                relevant_waypoints.append(wp)
-
-        all_waypoints = None  # garbage collection go brrr
-
-        if not relevant_waypoints:
-            orbit(self.ID, self.Token)
-            drift(self.ID, self.Token, "HIGH")
-            response = warp(self.ID, self.Token, self.waypoints[0][0], "HIGH")
-            arrival = time_str_to_datetime(response["data"]["nav"]["route"]["arrival"])
-            self.Arrival = arrival
-            db_update("Agents", ["Arrival"], [arrival], ["ID"], [self.ID])
-            db_update("Agents", ["Completed"], [True], ["ID"], [self.ID])
-            self.Completed = True
-            print("closing completed thread", self.printID)
-            return
-
-        if self.Arrival is None:
-            orbit(self.ID, self.Token)
-            drift(self.ID, self.Token, "HIGH")
-            response = warp(self.ID, self.Token, relevant_waypoints[0][0], "HIGH")
-            arrival = time_str_to_datetime(response["data"]["nav"]["route"]["arrival"])
-            self.Arrival = arrival
-            db_update("Agents", ["Arrival"], [arrival], ["ID"], [self.ID])
+    def transition(self, state, stop=None):
+        self.State = state
+        if stop is not None:
+            self.Stop = stop
+        self.Completed = state == DONE
+        db_update("Agents", ["State", "Stop", "System", "Waypoint", "Arrival", "Completed"],
+                  [self.State, self.Stop, self.System, self.Waypoint, self.Arrival, self.Completed], ["ID"], [self.ID])
 
+    def deadline(self, priority):
+        # When a request at priority has to go out by under the "deadline" policy: its usual slack (DEADLINE_SLACK),
+        # counted from when the ship got where it is rather than from when it asks, so a ship that's already been
+        # kept waiting since it arrived goes ahead of one that's only just got there.
         now = datetime.datetime.utcnow()
-        sleep_time = self.Arrival - now
+        since = now if self.Arrival is None or self.Arrival > now else self.Arrival
+        return since + datetime.timedelta(seconds=DEADLINE_SLACK[priority])
 
-        sleep_seconds = sleep_time / datetime.timedelta(seconds=1)
-        if sleep_seconds > 0:
+    def start(self):
+        wake = self.step()
+        while wake is not None:
+            sleep_time = wake - datetime.datetime.utcnow()
             if sleep_time > datetime.timedelta(days=7, hours=0, minutes=0, seconds=0):
-                print("closing incomplete thread", self.printID, sleep_time)
+                log.info("ships", "closing incomplete thread", self.printID, sleep_time)
                 return
-            print("continuing thread", self.printID, "in", sleep_time)
-            time.sleep(sleep_seconds)
+            sleep_seconds = sleep_time / datetime.timedelta(seconds=1)
+            if sleep_seconds > 0:
+                log.info("ships", "continuing thread", self.printID, "in", sleep_time)
+                time.sleep(sleep_seconds)
+            wake = self.step()
+
+    def step(self):
+        # Moves the ship through as many states as it can right now and returns when it next needs waking,
+        # or None when done.
+        if self.State == DONE:
+            log.info("ships", "Closing completed thread", self.printID)
+            return None
+        if self.route is None:
+            self.plan_route()
+
+        if self.State == REGISTERED:
+            orbit(self.ID, self.Token, "HIGH", deadline=self.deadline("HIGH"))
+            self.transition(ORBITED)
+
+        if self.State == ORBITED:
+            drift(self.ID, self.Token, "HIGH", deadline=self.deadline("HIGH"))
+            self.transition(DRIFTING)
+
+        if self.State == DRIFTING:
+            if not self.route and self.next_leg() is not None:
+                return self.leave_system()
+            target = self.warp_target()
+            response = warp(self.ID, self.Token, target, "HIGH", deadline=self.deadline("HIGH"))
+            self.Arrival = time_str_to_datetime(response["data"]["nav"]["route"]["arrival"])
+            self.Waypoint = target
+            self.transition(WARPING)
 
-        c = chart(self.ID, self.Token)
-        if c:
-            wp_name = c["data"]["waypoint"]["symbol"]
-            traits = c["data"]["waypoint"]["traits"]
+        if self.State == WARPING:
+            if self.Arrival > datetime.datetime.utcnow():
+                return self.Arrival
+            self.transition(CHARTING, 0)
+
+        if self.State == CHARTING:
+            if self.Arrival is not None and self.Arrival > datetime.datetime.utcnow():
+                return self.Arrival
+            if self.route:
+                self.chart_stop()
+            if self.route:
+                n = nav(self.ID, self.Token, self.route_symbol(), "HIGH", deadline=self.deadline("HIGH"))
+                self.Arrival = time_str_to_datetime(n["data"]["nav"]["route"]["arrival"])
+                self.Waypoint = self.route_symbol()
+                self.transition(CHARTING, self.Stop + 1)
+                return self.Arrival
+            self.transition(VERIFYING)
+
+        if self.State == VERIFYING:
+            if not self.verify_charted():
+                self.route = None
+                self.transition(CHARTING)
+                return datetime.datetime.utcnow()
+            if self.next_leg() is not None:
+                return self.leave_system()
+            self.complete()
+        return None
+
+    def chart_stop(self):
+        # Charts the stop the ship is at, which its state says is route[0], and logs any market or shipyard there.
+        wp_name = self.route_symbol()
+        if get_universe().charted[self.route[0]]:
+            traits = []
         else:
-            wp_name = get_ship(self.ID, self.Token, "HIGH")["data"]["nav"]["waypointSymbol"]
-            db_update("Waypoints", ["Charted"], [True], ["Waypoint"], [wp_name])
-            wp_data = get_waypoint(self.Token, wp_name, "HIGH")
-            traits = wp_data["data"]["traits"]
+            c = chart(self.ID, self.Token, deadline=self.deadline("NORMAL"))
+            if c:
+                traits = c["data"]["waypoint"]["traits"]
+            else:
+                # someone else charted it first
+                set_waypoint_flag(wp_name, "Charted", True)
+                traits = get_waypoint(self.Token, wp_name, "HIGH", deadline=self.deadline("HIGH"))["data"]["traits"]
 
         for t in traits:
             if t["symbol"] == "MARKETPLACE":
-                get_market(self.Token, wp_name)
+                get_market(self.Token, wp_name, deadline=self.deadline("NORMAL"))
             elif t["symbol"] == "SHIPYARD":
-                get_shipyard(self.Token, wp_name)
+                get_shipyard(self.Token, wp_name, deadline=self.deadline("NORMAL"))
+        self.route.pop(0)
 
-        if relevant_waypoints[0][0] == wp_name:
-            relevant_waypoints.pop(0)
+    def plan_route(self):
+        # Charting stops for the current system. Stops that are already charted by the time the ship gets there are
+        # only passed through: the waypoint the ship is at or heading to, and the jump gate it leaves through.
+        universe_index = get_universe()
+        uncharted = []
+        for i in universe_index.indices_in(self.System):
+            if not universe_index.charted[i]:
+                uncharted.append(i)
+        self.route = array.array("i")
+        if not uncharted:
+            return
 
-        for wp in relevant_waypoints:
-            wp_name = wp[0]
-            n = nav(self.ID, self.Token, wp_name, "HIGH")
-            self.Arrival = time_str_to_datetime(n["data"]["nav"]["route"]["arrival"])
+        origin = None
+        if self.Arrival is not None and self.Waypoint is not None:
+            origin = universe_index.index(self.Waypoint)
+        if origin is not None and universe_index.systems[origin] != self.System:
+            origin = None
 
-            now = datetime.datetime.utcnow()
-            sleep_time = self.Arrival - now
+        gate = None
+        if self.next_leg() is not None and self.next_leg()[1] == "jump":
+            gate = self.jump_gate()
+        end = []
+        if gate is not None:
+            if gate in uncharted and gate != origin:
+                uncharted.remove(gate)
+            end = [gate]
 
-            sleep_seconds = sleep_time / datetime.timedelta(seconds=1)
-            if sleep_seconds > 0:
-                time.sleep(sleep_seconds)
+        start = []
+        if origin is not None:
+            if origin in uncharted:
+                uncharted.remove(origin)
+            start = [origin]
+            tour = plan_route([universe_index.row(i) for i in uncharted], universe_index.row(origin))
+        else:
+            tour = plan_route([universe_index.row(i) for i in uncharted])
+        self.route.extend(start + [universe_index.index(wp[0]) for wp in tour] + end)
 
-            c = chart(self.ID, self.Token)
-            if c:
-                traits = c["data"]["waypoint"]["traits"]
-            else:
-                db_update("Waypoints", ["Charted"], [True], ["Waypoint"], [wp_name])
-                wp_data = get_waypoint(self.Token, wp_name, "HIGH")
-                traits = wp_data["data"]["traits"]
+    def route_symbol(self):
+        # the next stop on the route
+        return get_universe().symbols[self.route[0]]
+
+    def warp_target(self):
+        # The first stop, or any waypoint in the system when there's nothing left to chart
+        if self.route:
+            return self.route_symbol()
+        return get_universe().symbols[get_universe().indices_in(self.System)[0]]
+
+    def leg(self):
+        # which system of the account's chain the ship is on
+        if self.Chain is None:
+            return 0
+        for i, (system, via) in enumerate(self.Chain):
+            if system == self.System:
+                return i
+        return 0
 
-            for t in traits:
-                if t["symbol"] == "MARKETPLACE":
-                    get_market(self.Token, wp_name)
-                elif t["symbol"] == "SHIPYARD":
-                    get_shipyard(self.Token, wp_name)
+    def next_leg(self):
+        if self.Chain is None or self.leg() + 1 >= len(self.Chain):
+            return None
+        return self.Chain[self.leg() + 1]
 
-        self.verify_charted()
+    def jump_gate(self):
+        universe_index = get_universe()
+        for i in universe_index.indices_in(self.System):
+            if universe_index.jump_gate[i]:
+                return i
+        return None
 
-        db_update("Agents", ["Completed"], [True], ["ID"], [self.ID])
-        self.Completed = True
-        print("closing completed thread", self.printID)
+    def leave_system(self):
+        # Moves on to the next system in the chain: through the jump gate if the plan says so and the ship is at it,
+        # otherwise the next step warps there.
+        system, via = self.next_leg()
+        response = False
+        if via == "jump":
+            response = jump(self.ID, self.Token, system, "HIGH", deadline=self.deadline("HIGH"))
+        self.enter_system(system, response)
+        return datetime.datetime.utcnow()
+
+    def enter_system(self, system, jump_response=False):
+        # A jump leaves the ship at the new system's gate, ready to chart; otherwise it warps there next
+        self.System = system
+        self.route = None
+        self.Arrival = None
+        if jump_response:
+            self.Arrival = datetime.datetime.utcnow()
+            self.Waypoint = sys.intern(jump_response["data"]["nav"]["waypointSymbol"])
+            self.transition(CHARTING, 0)
+        else:
+            self.transition(DRIFTING, 0)
+
+    def complete(self):
+        self.transition(DONE)
+        log.info("ships", "closing completed thread", self.printID)
 
     def verify_charted(self):
+        return self.check_charted(list_waypoints(self.Token, self.System, deadline=self.deadline("NORMAL")))
+
+    def check_charted(self, waypoints):
         verified = True
-        for wp_obj in list_waypoints(self.Token, self.System):
+        for wp_obj in waypoints:
             for trait in wp_obj["traits"]:
                 if trait["symbol"] == "UNCHARTED":
                     verified = False
         if not verified:
-            print("chart verification failed", self.System)
-            self.waypoints = []
-            self.Completed = False
-            self.start()
+            log.warning("ships", "chart verification failed", self.System)
         else:
-            print("charting verified")
+            log.info("ships", "charting verified")
+        return verified
 
     def update_markets_and_shipyards(self):
+        wake = self.research_step()
+        while wake is not None:
+            sleep_seconds = (wake - datetime.datetime.utcnow()) / datetime.timedelta(seconds=1)
+            if sleep_seconds > 0:
+                time.sleep(sleep_seconds)
+            wake = self.research_step()
 
-        markets = db_get_where("Waypoints", ["System", "Marketplace"], [self.System, True])
-        shipyards = db_get_where("Waypoints", ["System", "Marketplace", "Shipyard"], [self.System, False, True])
-        to_update = markets + shipyards
-
-        for wp in to_update:
-            with rh.print_lock:
-                print("Market research continuing towards", wp[0])
-            n = nav(self.ID, self.Token, wp[0], "LOW")
-            self.Arrival = time_str_to_datetime(n["data"]["nav"]["route"]["arrival"])
+    def plan_research(self):
+        # Every marketplace in the system, then every shipyard that isn't also one
+        universe_index = get_universe()
+        markets = []
+        shipyards = []
+        for i in universe_index.indices_in(self.System):
+            if universe_index.marketplace[i]:
+                markets.append(i)
+            elif universe_index.shipyard[i]:
+                shipyards.append(i)
+        self.research_route = array.array("i", markets + shipyards)
 
-            now = datetime.datetime.utcnow()
-            sleep_time = self.Arrival - now
+    def research_step(self):
+        universe_index = get_universe()
+        if self.research_route is None:
+            self.plan_research()
+        elif self.research_route:
+            i = self.research_route.pop(0)
+            if universe_index.shipyard[i]:
+                get_shipyard(self.Token, universe_index.symbols[i], "LOW", deadline=self.deadline("LOW"))
+            if universe_index.marketplace[i]:
+                get_market(self.Token, universe_index.symbols[i], "LOW", deadline=self.deadline("LOW"))
 
-            sleep_seconds = sleep_time / datetime.timedelta(seconds=1)
-            if sleep_seconds > 0:
-                time.sleep(sleep_seconds)
+        if not self.research_route:
+            log.info("ships", "ending market research", self.System)
+            return None
 
-            if wp[4]:
-                get_shipyard(self.Token, wp[0], "LOW")
-            if wp[3]:
-                get_market(self.Token, wp[0], "LOW")
-        with rh.print_lock:
-            print("ending market research", self.System)
\ No newline at end of file
+        symbol = universe_index.symbols[self.research_route[0]]
+        log.info("ships", "Market research continuing towards", symbol)
+        n = nav(self.ID, self.Token, symbol, "LOW", deadline=self.deadline("LOW"))
+        self.Arrival = time_str_to_datetime(n["data"]["nav"]["route"]["arrival"])
+        return self.Arrival
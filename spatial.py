@@ -0,0 +1,163 @@
+import math
+import time
+
+import numpy
+
+
+GRID_CELL = 1000
+CHUNK = 4096
+
+
+class SpatialIndex:
+    # Named points (systems, faction headquarters) held in NumPy coordinate arrays and bucketed into a square grid,
+    # so nearest, k-nearest and radius queries only look at the cells around the query.
+    # Points can be removed as they get used up, e.g. systems that have already been given to an account.
+    def __init__(self, names, coordinates, cell=GRID_CELL):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.xy = numpy.asarray(coordinates, dtype=float).reshape(-1, 2)
+        self.alive = numpy.ones(len(self.names), dtype=bool)
+        self.count = len(self.names)
+        self.cell = cell
+
+        keys = numpy.floor(self.xy / cell).astype(int)
+        cells = {}
+        for i, key in enumerate(map(tuple, keys.tolist())):
+            cells.setdefault(key, []).append(i)
+        self.cells = {key: numpy.array(indexes) for key, indexes in cells.items()}
+        self.extent = int(numpy.abs(keys).max()) if len(keys) else 0
+
+    @classmethod
+    def from_positions(cls, positions, cell=GRID_CELL):
+        return cls(positions.keys(), list(positions.values()), cell)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, name):
+        i = self.index.get(name)
+        return i is not None and bool(self.alive[i])
+
+    def position(self, name):
+        x, y = self.xy[self.index[name]]
+        return x, y
+
+    def remove(self, name):
+        i = self.index.get(name)
+        if i is not None and self.alive[i]:
+            self.alive[i] = False
+            self.count -= 1
+
+    def nearest(self, points):
+        # The closest remaining point to each of points, as (distance, name). Vectorized over all of them at once.
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        live = numpy.flatnonzero(self.alive)
+        if not len(live):
+            return [(math.inf, None)] * len(points)
+        xy = self.xy[live]
+        result = []
+        for start in range(0, len(points), CHUNK):
+            chunk = points[start:start + CHUNK]
+            distances = numpy.hypot(chunk[:, 0, None] - xy[None, :, 0], chunk[:, 1, None] - xy[None, :, 1])
+            closest = distances.argmin(axis=1)
+            for d, i in zip(distances[numpy.arange(len(chunk)), closest].tolist(), live[closest].tolist()):
+                result.append((d, self.names[i]))
+        return result
+
+    def k_nearest(self, point, k, max_distance=math.inf):
+        # The k closest remaining points within max_distance as (distance, name), closest first.
+        cx, cy = math.floor(point[0] / self.cell), math.floor(point[1] / self.cell)
+        max_ring = self.extent + max(abs(cx), abs(cy)) + 1
+        found = numpy.empty(0, dtype=int)
+        ring = 0
+        while ring <= max_ring:
+            if (ring - 1) * self.cell > max_distance:
+                break
+            if 8 * ring > self.count:
+                # cheaper to look at everything that's left than to keep walking empty cells
+                found = numpy.flatnonzero(self.alive)
+                break
+            candidates = [self.cells[key] for key in self.ring(cx, cy, ring) if key in self.cells]
+            if candidates:
+                candidates = numpy.concatenate(candidates)
+                found = numpy.concatenate((found, candidates[self.alive[candidates]]))
+            ring += 1
+            if len(found) >= k:
+                distances = self.distances(point, found)
+                if numpy.partition(distances, k - 1)[k - 1] <= (ring - 1) * self.cell:
+                    break
+        return self.closest(point, found, k, max_distance)
+
+    def within(self, point, radius):
+        # Every remaining point within radius as (distance, name), closest first.
+        x0, y0 = math.floor((point[0] - radius) / self.cell), math.floor((point[1] - radius) / self.cell)
+        x1, y1 = math.floor((point[0] + radius) / self.cell), math.floor((point[1] + radius) / self.cell)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            found = numpy.flatnonzero(self.alive)
+        else:
+            candidates = [self.cells[(x, y)] for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+                          if (x, y) in self.cells]
+            if not candidates:
+                return []
+            found = numpy.concatenate(candidates)
+            found = found[self.alive[found]]
+        return self.closest(point, found, len(found), radius)
+
+    def distances(self, point, indexes):
+        xy = self.xy[indexes]
+        return numpy.hypot(xy[:, 0] - point[0], xy[:, 1] - point[1])
+
+    def closest(self, point, indexes, k, max_distance):
+        if not len(indexes) or k <= 0:
+            return []
+        distances = self.distances(point, indexes)
+        keep = distances <= max_distance
+        indexes = indexes[keep]
+        distances = distances[keep]
+        if len(indexes) > k:
+            part = numpy.argpartition(distances, k - 1)[:k]
+            indexes = indexes[part]
+            distances = distances[part]
+        order = numpy.argsort(distances, kind="stable")
+        return [(d, self.names[i]) for d, i in zip(distances[order].tolist(), indexes[order].tolist())]
+
+    @staticmethod
+    def ring(cx, cy, ring):
+        if ring == 0:
+            yield cx, cy
+            return
+        for dx in range(-ring, ring + 1):
+            yield cx + dx, cy - ring
+            yield cx + dx, cy + ring
+        for dy in range(-ring + 1, ring):
+            yield cx - ring, cy + dy
+            yield cx + ring, cy + dy
+
+
+def main():
+    # Timings at universe scale on random systems.
+    rng = numpy.random.default_rng(0)
+    coordinates = rng.uniform(-40000, 40000, (12000, 2))
+    names = ["X1-" + str(i) for i in range(len(coordinates))]
+    start = time.perf_counter()
+    systems = SpatialIndex(names, coordinates)
+    print("Index 12000 systems (ms):", round((time.perf_counter() - start) * 1000, 1))
+
+    headquarters = SpatialIndex(names[:20], coordinates[:20])
+    start = time.perf_counter()
+    headquarters.nearest(coordinates)
+    print("Nearest headquarters for every system (ms):", round((time.perf_counter() - start) * 1000, 1))
+
+    start = time.perf_counter()
+    for point in coordinates[:1000]:
+        systems.k_nearest(point, 8)
+    print("8 nearest systems (ms per query):", round((time.perf_counter() - start), 3))
+
+    start = time.perf_counter()
+    for point in coordinates[:1000]:
+        systems.within(point, 2000)
+    print("Systems within 2000 (ms per query):", round((time.perf_counter() - start), 3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+import contextlib
+import functools
+import sqlite3
+import threading
+
+
+SCHEMA = {
+    "Systems": [
+        ("System", "TEXT PRIMARY KEY"),
+        ("x", "INTEGER"),
+        ("y", "INTEGER"),
+        ("closestFaction", "TEXT"),
+        ("distanceFromFaction", "REAL"),
+        ("hasJumpGate", "BOOLEAN NOT NULL DEFAULT 0"),
+    ],
+    "Waypoints": [
+        ("Waypoint", "TEXT PRIMARY KEY"),
+        ("System", "TEXT"),
+        ("Charted", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("Marketplace", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("Shipyard", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("JumpGate", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("x", "INTEGER"),
+        ("y", "INTEGER"),
+    ],
+    "Agents": [
+        ("ID", "TEXT PRIMARY KEY"),
+        ("Token", "TEXT"),
+        ("System", "TEXT"),
+        ("Arrival", "TIMESTAMP"),
+        ("Completed", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("Waypoint", "TEXT"),
+        ("State", "TEXT"),
+        ("Stop", "INTEGER NOT NULL DEFAULT 0"),
+    ],
+    "Markets": [
+        ("ID", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+        ("Waypoint", "TEXT"),
+        ("Symbol", "TEXT"),
+        ("isExport", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("isImport", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("isExchange", "BOOLEAN NOT NULL DEFAULT 0"),
+        ("TradeVolume", "INTEGER"),
+        ("Supply", "TEXT"),
+        ("PurchasePrice", "INTEGER"),
+        ("SellPrice", "INTEGER"),
+        ("timestamp", "TIMESTAMP"),
+    ],
+    "Factions": [
+        ("Faction", "TEXT PRIMARY KEY"),
+        ("Headquarters", "TEXT"),
+        ("System", "TEXT"),
+        ("x", "INTEGER"),
+        ("y", "INTEGER"),
+    ],
+    "Tokens": [
+        ("ID", "TEXT PRIMARY KEY"),
+        ("Token", "TEXT"),
+        ("Faction", "TEXT"),
+        ("Used", "BOOLEAN NOT NULL DEFAULT 0"),
+    ],
+    "Plans": [
+        ("Account", "INTEGER"),
+        ("ID", "TEXT"),
+        ("Leg", "INTEGER"),
+        ("System", "TEXT"),
+        ("Faction", "TEXT"),
+        ("Via", "TEXT"),
+    ],
+    "Shipyards": [
+        ("ID", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+        ("Waypoint", "TEXT"),
+        ("ShipType", "TEXT"),
+        ("ShipName", "TEXT"),
+        ("PurchasePrice", "INTEGER"),
+        ("timestamp", "TIMESTAMP"),
+    ],
+}
+
+FETCH_SIZE = 500  # rows fetched at a time when streaming a query
+READ_CONNECTIONS = 4  # connections kept for reads; writes have one of their own
+STATEMENT_CACHE_SIZE = 256  # prepared statements SQLite keeps per connection
+
+# (name, table, columns, unique). Markets and Shipyards are keyed on their ID, so only these unique indexes stop the
+# same good or ship type being added twice, e.g. by replaying a journaled insert that had already been written.
+INDEXES = [
+    ("idx_waypoints_system", "Waypoints", ("System",), False),
+    ("idx_systems_distance", "Systems", ("distanceFromFaction",), False),
+    ("uq_markets_waypoint_symbol", "Markets", ("Waypoint", "Symbol"), True),
+    ("uq_shipyards_waypoint_type", "Shipyards", ("Waypoint", "ShipType"), True),
+    ("idx_plans_account_leg", "Plans", ("Account", "Leg"), False),
+]
+REPLACED_INDEXES = [("idx_markets_waypoint_symbol", "Markets"), ("idx_shipyards_waypoint_type", "Shipyards")]
+UNIQUE_KEYS = {table_name: columns for _, table_name, columns, unique in INDEXES if unique}
+
+# SCHEMA's types as Access knows them. Access DDL over ODBC has no DEFAULT, so columns added to an existing table
+# start out empty (yes/no columns start out False).
+ACCESS_TYPES = {"TEXT": "TEXT(255)", "INTEGER": "LONG", "REAL": "DOUBLE", "BOOLEAN": "YESNO", "TIMESTAMP": "DATETIME"}
+ACCESS_LONG_TEXT = {"Token"}  # agent tokens are longer than the 255 characters a TEXT column holds
+
+
+def access_type(column_name, col_type, new_table=True):
+    # A column can only be made the primary key or a counter when its table is created
+    if "AUTOINCREMENT" in col_type:
+        return "COUNTER PRIMARY KEY" if new_table else "LONG"
+    access = "LONGTEXT" if column_name in ACCESS_LONG_TEXT else ACCESS_TYPES[col_type.split()[0]]
+    if new_table and "PRIMARY KEY" in col_type:
+        access += " PRIMARY KEY"
+    return access
+
+
+class ConnectionPool:
+    # At most size connections, each lent to one thread at a time together with its own cursor, and kept open
+    # between uses so the driver's prepared statements are reused. connect() opens one when none are idle.
+    def __init__(self, connect, size=READ_CONNECTIONS):
+        self.connect = connect
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.available = threading.BoundedSemaphore(size)
+        self.opened = 0
+
+    @contextlib.contextmanager
+    def cursor(self):
+        with self.available:
+            with self.lock:
+                pair = self.idle.pop() if self.idle else None
+            if pair is None:
+                conn = self.connect()
+                pair = (conn, conn.cursor())
+                with self.lock:
+                    self.opened += 1
+            try:
+                yield pair[1]
+            finally:
+                with self.lock:
+                    self.idle.append(pair)
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn, cursor in idle:
+            conn.close()
+
+
+@functools.lru_cache(maxsize=None)
+def insert_statement(table_name, columns):
+    return "INSERT INTO " + table_name + " (" + ", ".join(columns) + ") VALUES (" + ", ".join("?" * len(columns)) + ")"
+
+
+@functools.lru_cache(maxsize=None)
+def insert_or_ignore_statement(table_name, columns):
+    # SQLite quietly skips a row that's already there by a unique key other than its ID
+    cmd = insert_statement(table_name, columns)
+    if table_name in UNIQUE_KEYS:
+        cmd = "INSERT OR IGNORE" + cmd[len("INSERT"):]
+    return cmd
+
+
+def delete_duplicates_statement(table_name, columns):
+    # Keeps the first row for each key, so a unique index can be created over them
+    return "DELETE FROM " + table_name + " WHERE ID NOT IN (SELECT MIN(ID) FROM " + table_name + " GROUP BY " + \
+        ", ".join(columns) + ")"
+
+
+@functools.lru_cache(maxsize=None)
+def update_statement(table_name, columns, where_columns):
+    return "UPDATE " + table_name + " SET " + ", ".join(c + " = ?" for c in columns) + \
+        " WHERE " + " AND ".join(c + " = ?" for c in where_columns)
+
+
+@functools.lru_cache(maxsize=None)
+def select_statement(table_name, where_columns=()):
+    cmd = "SELECT * FROM " + table_name
+    if where_columns:
+        cmd += " WHERE " + " AND ".join(c + " = ?" for c in where_columns)
+    return cmd
+
+
+class Storage:
+    # Reads go through a pool of reader connections and can be streamed; writes go through one writer connection.
+    # Column lists are turned into SQL once per table and set of columns and reused from then on.
+    readers = None
+    row_errors = ()  # what the database raises for a bad row, as opposed to the database itself failing
+
+    def insert(self, table_name, column_name_list, value_list):
+        raise NotImplementedError
+
+    def update(self, table_name, update_column_name_list, update_value_list, where_column_name_list, where_value_list):
+        raise NotImplementedError
+
+    def get(self, table_name):
+        return self.query(select_statement(table_name))
+
+    def get_where(self, table_name, where_column_names, where_values):
+        return self.query(select_statement(table_name, tuple(where_column_names)), tuple(where_values))
+
+    def iterate(self, table_name, size=FETCH_SIZE):
+        return self.stream(select_statement(table_name), size=size)
+
+    def query(self, cmd, params=()):
+        with self.readers.cursor() as cursor:
+            cursor.execute(cmd, params)
+            return cursor.fetchall()
+
+    def stream(self, cmd, params=(), size=FETCH_SIZE):
+        # Yields rows size at a time instead of building the whole list. Holds a reader connection until it's
+        # finished or closed, so don't keep one half-read.
+        with self.readers.cursor() as cursor:
+            cursor.execute(cmd, params)
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield from rows
+
+    def write_batch(self, batch):
+        # batch is a list of ((kind, table_name, columns, where_columns), rows) with kind "insert" or "update"
+        for (kind, table_name, columns, where_columns), rows in batch:
+            for row in rows:
+                if kind == "insert":
+                    self.insert(table_name, list(columns), list(row))
+                else:
+                    self.update(table_name, list(columns), list(row[:len(columns)]),
+                                list(where_columns), list(row[len(columns):]))
+
+    def upsert_many(self, table_name, column_name_list, key_column_names, value_lists):
+        raise NotImplementedError
+
+    def clear(self, table_name):
+        raise NotImplementedError
+
+    def close(self):
+        if self.readers is not None:
+            self.readers.close()
+
+
+class AccessStorage(Storage):
+    # The original Microsoft Access database. Only works on Windows with the Access ODBC driver installed.
+    # create=False opens it as it is, without adding SCHEMA's tables and columns, e.g. to copy it somewhere else.
+    def __init__(self, db_path, readers: int = READ_CONNECTIONS, create: bool = True):
+        import pyodbc
+
+        driver = 'Driver={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=' + db_path
+
+        def connect():
+            conn = pyodbc.connect(driver)
+            conn.autocommit = True
+            return conn
+
+        self.conn = connect()
+        self.cursor = self.conn.cursor()
+        self.lock = threading.Lock()  # the writer connection
+        self.readers = ConnectionPool(connect, readers)
+        self.row_errors = (pyodbc.IntegrityError, pyodbc.DataError, pyodbc.ProgrammingError)
+        if create:
+            self.create_schema()
+
+    def create_schema(self):
+        # Adds whatever SCHEMA has that the database doesn't yet, e.g. to an .accdb made before those tables and
+        # columns existed. Access names are case-insensitive and can't be created twice, so look before adding.
+        with self.lock:
+            tables = {row.table_name.lower() for row in self.cursor.tables(tableType="TABLE")}
+            for table_name, columns in SCHEMA.items():
+                if table_name.lower() not in tables:
+                    cols = ", ".join("[" + name + "] " + access_type(name, col_type) for name, col_type in columns)
+                    self.cursor.execute("CREATE TABLE [" + table_name + "] (" + cols + ")")
+                    continue
+                existing = {row.column_name.lower() for row in self.cursor.columns(table=table_name)}
+                for name, col_type in columns:
+                    if name.lower() not in existing:
+                        self.cursor.execute("ALTER TABLE [" + table_name + "] ADD COLUMN [" + name + "] " +
+                                            access_type(name, col_type, new_table=False))
+            indexes = {}
+            for table_name in {table_name for _, table_name, _, _ in INDEXES}:
+                indexes[table_name] = {row.index_name.lower() for row in self.cursor.statistics(table_name)
+                                       if row.index_name is not None}
+            for index_name, table_name in REPLACED_INDEXES:
+                if index_name.lower() in indexes[table_name]:
+                    self.cursor.execute("DROP INDEX " + index_name + " ON [" + table_name + "]")
+            for index_name, table_name, columns, unique in INDEXES:
+                if index_name.lower() not in indexes[table_name]:
+                    if unique:
+                        self.cursor.execute(delete_duplicates_statement(table_name, columns))
+                    self.cursor.execute("CREATE " + ("UNIQUE " if unique else "") + "INDEX " + index_name + " ON [" +
+                                        table_name + "] (" + ", ".join("[" + c + "]" for c in columns) + ")")
+
+    def insert(self, table_name, column_name_list, value_list):
+        with self.lock:
+            self.cursor.execute(insert_statement(table_name, tuple(column_name_list)), tuple(value_list))
+
+    def update(self, table_name, update_column_name_list, update_value_list, where_column_name_list, where_value_list):
+        cmd = update_statement(table_name, tuple(update_column_name_list), tuple(where_column_name_list))
+        with self.lock:
+            self.cursor.execute(cmd, tuple(update_value_list + where_value_list))
+
+    def write_batch(self, batch):
+        with self.lock:
+            self.conn.autocommit = False
+            try:
+                for (kind, table_name, columns, where_columns), rows in batch:
+                    if kind == "insert":
+                        self.cursor.executemany(insert_statement(table_name, columns), rows)
+                    else:
+                        self.cursor.executemany(update_statement(table_name, columns, where_columns), rows)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                self.conn.autocommit = True
+
+    def upsert_many(self, table_name, column_name_list, key_column_names, value_lists):
+        # Access has no upsert, so update each row and insert the ones that weren't there
+        update_columns = tuple(c for c in column_name_list if c not in key_column_names)
+        key_index = [column_name_list.index(c) for c in key_column_names]
+        update_index = [column_name_list.index(c) for c in update_columns]
+        insert_cmd = insert_statement(table_name, tuple(column_name_list))
+        update_cmd = None
+        if update_columns:
+            update_cmd = update_statement(table_name, update_columns, tuple(key_column_names))
+        with self.lock:
+            self.conn.autocommit = False
+            try:
+                for row in value_lists:
+                    updated = 0
+                    if update_cmd is not None:
+                        self.cursor.execute(update_cmd, [row[i] for i in update_index] + [row[i] for i in key_index])
+                        updated = self.cursor.rowcount
+                    if updated <= 0:
+                        self.cursor.execute(insert_cmd, row)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                self.conn.autocommit = True
+
+    def clear(self, table_name):
+        with self.lock:
+            self.cursor.execute("DELETE FROM " + table_name)
+
+    def close(self):
+        super().close()
+        self.conn.close()
+
+
+class SqliteStorage(Storage):
+    # SQLite in WAL mode, so reads never wait on the writer. One connection writes, behind a lock, and a pool of
+    # read-only connections serves every thread's reads.
+    row_errors = (sqlite3.IntegrityError, sqlite3.DataError, sqlite3.ProgrammingError, sqlite3.InterfaceError)
+
+    def __init__(self, db_path, readers: int = READ_CONNECTIONS):
+        self.db_path = db_path
+        self.lock = threading.Lock()  # the writer connection
+        self.conn = self.connect()
+        self.create_schema()
+        self.readers = ConnectionPool(functools.partial(self.connect, read_only=True), readers)
+
+    def connect(self, read_only=False):
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def create_schema(self):
+        with self.lock:
+            for table_name, columns in SCHEMA.items():
+                cols = ", ".join(name + " " + col_type for name, col_type in columns)
+                self.conn.execute("CREATE TABLE IF NOT EXISTS " + table_name + " (" + cols + ")")
+                existing = [row[1] for row in self.conn.execute("PRAGMA table_info(" + table_name + ")")]
+                for name, col_type in columns:
+                    if name not in existing:
+                        self.conn.execute("ALTER TABLE " + table_name + " ADD COLUMN " + name + " " + col_type)
+            for index_name, _ in REPLACED_INDEXES:
+                self.conn.execute("DROP INDEX IF EXISTS " + index_name)
+            for index_name, table_name, columns, unique in INDEXES:
+                exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                                           (index_name,)).fetchone()
+                if exists:
+                    continue
+                if unique:
+                    self.conn.execute(delete_duplicates_statement(table_name, columns))
+                self.conn.execute("CREATE " + ("UNIQUE " if unique else "") + "INDEX " + index_name + " ON " +
+                                  table_name + " (" + ", ".join(columns) + ")")
+
+    def insert(self, table_name, column_name_list, value_list):
+        with self.lock:
+            self.conn.execute(insert_or_ignore_statement(table_name, tuple(column_name_list)), tuple(value_list))
+
+    def insert_many(self, table_name, column_name_list, value_lists):
+        self.write_batch([(("insert", table_name, tuple(column_name_list), None), value_lists)])
+
+    def upsert_many(self, table_name, column_name_list, key_column_names, value_lists):
+        update_columns = [c for c in column_name_list if c not in key_column_names]
+        cmd = insert_statement(table_name, tuple(column_name_list)) + " ON CONFLICT (" + \
+            ", ".join(key_column_names) + ")"
+        if update_columns:
+            cmd += " DO UPDATE SET " + ", ".join(c + " = excluded." + c for c in update_columns)
+        else:
+            cmd += " DO NOTHING"
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(cmd, value_lists)
+
+    def update(self, table_name, update_column_name_list, update_value_list, where_column_name_list, where_value_list):
+        cmd = update_statement(table_name, tuple(update_column_name_list), tuple(where_column_name_list))
+        with self.lock:
+            self.conn.execute(cmd, tuple(update_value_list + where_value_list))
+
+    def write_batch(self, batch):
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            for (kind, table_name, columns, where_columns), rows in batch:
+                if kind == "insert":
+                    self.conn.executemany(insert_or_ignore_statement(table_name, columns), rows)
+                else:
+                    self.conn.executemany(update_statement(table_name, columns, where_columns), rows)
+
+    def clear(self, table_name):
+        with self.lock:
+            self.conn.execute("DELETE FROM " + table_name)
+
+    def close(self):
+        super().close()
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,39 @@
+from benchmark import ServerLimit, run_workload
+
+
+class Clock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_server_limit_window_then_burst():
+    clock = Clock()
+    limit = ServerLimit(2, 3, burst_period=10.0, clock=clock)
+    assert [limit.allow() for _ in range(5)] == [0] * 5
+    # both buckets spent: the next slot is the next one-second window
+    assert limit.allow() == 1.0
+    clock.now = 101.5
+    assert [limit.allow() for _ in range(2)] == [0, 0]
+    assert limit.allow() == 0.5
+
+
+def test_server_limit_burst_refills_after_burst_period():
+    clock = Clock()
+    limit = ServerLimit(1, 2, burst_period=10.0, clock=clock)
+    assert [limit.allow() for _ in range(3)] == [0, 0, 0]
+    for second in range(1, 10):
+        clock.now = 100.0 + second
+        assert limit.allow() == 0
+        assert limit.allow() > 0
+    clock.now = 110.0
+    assert [limit.allow() for _ in range(3)] == [0, 0, 0]
+
+
+def test_sustained_rpm_stays_under_cap():
+    # a short run with a short burst period, so the warm-up and two refills of the burst pool fit in a few seconds
+    result = run_workload("saturated", duration=3.0, scale=5, latency=0.02, burst_period=1.0)
+    assert result["measured_s"] >= 2.0
+    assert 0.5 < result["rpm_of_cap"] <= 1.0
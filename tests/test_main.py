@@ -0,0 +1,21 @@
+from main import add_waypoints, needs_drift
+
+
+def test_add_waypoints_stops_at_total():
+    waypoints_list = []
+    assert not add_waypoints(waypoints_list, {"data": [{"symbol": "A"}], "meta": {"total": 2}})
+    assert add_waypoints(waypoints_list, {"data": [{"symbol": "B"}], "meta": {"total": 2}})
+    assert [wp["symbol"] for wp in waypoints_list] == ["A", "B"]
+
+
+def test_add_waypoints_stops_on_empty_page():
+    # a total that never gets reached (waypoints removed between pages) mustn't page forever
+    waypoints_list = [{"symbol": "A"}]
+    assert add_waypoints(waypoints_list, {"data": [], "meta": {"total": 5}})
+
+
+def test_needs_drift():
+    assert needs_drift({"error": {"code": 4236}}) == 4236
+    assert needs_drift({"error": {"code": 4203}}) == 4203
+    assert needs_drift({"error": {"code": 4214}}) is None
+    assert needs_drift({"data": {}}) is None
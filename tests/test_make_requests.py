@@ -0,0 +1,126 @@
+import datetime
+import json
+import threading
+import time
+
+from make_requests import RequestHandler, retry_after
+from rate_limiter import RateLimiter
+from response_cache import ResponseCache
+
+
+class Response:
+    def __init__(self, headers, body=None):
+        self.headers = headers
+        self.text = json.dumps(body or {})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class GatedLimiter(RateLimiter):
+    # lets one request through per open()
+    def __init__(self):
+        super().__init__(2, 10)
+        self.gate = threading.Semaphore(0)
+
+    def acquire(self):
+        self.gate.acquire()
+
+    def open(self, n=1):
+        for _ in range(n):
+            self.gate.release()
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.sent = []
+
+    def request(self, method, url, headers=None, params=None, data=None):
+        self.sent.append(url.rsplit("/v2/", 1)[-1])
+        response = Response({}, {"data": {}})
+        response.status_code = 200
+        return response
+
+    def close(self):
+        pass
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def call(func, *args, **kwargs):
+    thread = threading.Thread(target=func, args=args, kwargs=kwargs, daemon=True)
+    thread.start()
+    return thread
+
+
+def reset_in(seconds):
+    when = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+    return when.isoformat().replace("+00:00", "Z")
+
+
+def test_retry_after_prefers_body_over_reset():
+    body = {"error": {"code": 429, "data": {"retryAfter": 0.5}}}
+    response = Response({"x-ratelimit-reset": reset_in(8)}, body)
+    assert retry_after(response) == 0.5
+
+
+def test_retry_after_header_first():
+    body = {"error": {"code": 429, "data": {"retryAfter": 0.5}}}
+    response = Response({"Retry-After": "2", "x-ratelimit-reset": reset_in(8)}, body)
+    assert retry_after(response) == 2
+
+
+def test_retry_after_falls_back_to_reset():
+    assert 6 < retry_after(Response({"x-ratelimit-reset": reset_in(8)})) <= 8
+    assert retry_after(Response({}), default=1.5) == 1.5
+
+
+def test_collapsed_get_takes_the_most_urgent_priority():
+    limiter = GatedLimiter()
+    transport = RecordingTransport()
+    rh = RequestHandler(limiter=limiter, transport=transport, cache=ResponseCache())
+    threads = [call(rh.get, "systems/X1-A/waypoints/X1-A-1", priority="LOW"),
+               call(rh.post, "my/ships/S-1/orbit", priority="NORMAL")]
+    wait_for(lambda: rh.queue_len() == 2)
+    # a ship needs the same waypoint urgently, so the shared LOW request has to go ahead of the NORMAL one
+    threads.append(call(rh.get, "systems/X1-A/waypoints/X1-A-1", priority="HIGH"))
+    wait_for(lambda: rh.collapsed_count == 1)
+    limiter.open(2)
+    for thread in threads:
+        thread.join(5)
+    assert transport.sent == ["systems/X1-A/waypoints/X1-A-1", "my/ships/S-1/orbit"]
+
+
+def test_tight_deadline_goes_ahead_at_the_same_priority():
+    limiter = GatedLimiter()
+    transport = RecordingTransport()
+    rh = RequestHandler(limiter=limiter, transport=transport, policy="deadline")
+    now = datetime.datetime.utcnow()
+    threads = [call(rh.post, "my/ships/LOOSE-1/navigate", priority="HIGH",
+                    deadline=now + datetime.timedelta(seconds=30)),
+               call(rh.post, "my/ships/NONE-1/navigate", priority="HIGH")]
+    wait_for(lambda: rh.queue_len() == 2)
+    # this ship arrived a while ago, so its request is already overdue
+    threads.append(call(rh.post, "my/ships/TIGHT-1/navigate", priority="HIGH",
+                        deadline=now - datetime.timedelta(seconds=5)))
+    wait_for(lambda: rh.queue_len() == 3)
+    limiter.open(3)
+    for thread in threads:
+        thread.join(5)
+    assert transport.sent == ["my/ships/TIGHT-1/navigate", "my/ships/NONE-1/navigate", "my/ships/LOOSE-1/navigate"]
+
+
+def test_counts_add_up_across_workers():
+    transport = RecordingTransport()
+    rh = RequestHandler(limiter=RateLimiter(10000, 0), transport=transport, max_workers=16)
+    threads = [call(lambda: [rh.post("my/ships/S-1/orbit") for _ in range(50)]) for _ in range(16)]
+    for thread in threads:
+        thread.join(10)
+    assert len(transport.sent) == 800
+    assert rh.request_count == rh.successful_request_count == rh.pacing_rc == rh.pacing_src == 800
+    assert rh.rate_limited_count == 0
@@ -0,0 +1,56 @@
+import json
+import os
+import threading
+import time
+
+from log import Log
+from make_requests import RequestHandler
+from mock_server import MockGame, generate_universe
+
+
+class Response:
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = body if isinstance(body, str) else json.dumps(body)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class GameTransport:
+    # calls the mock game directly, with its rate limit headers, instead of over HTTP
+    def __init__(self, game):
+        self.game = game
+
+    def request(self, method, url, headers=None, params=None, data=None):
+        path = url.rsplit("/v2/", 1)[-1]
+        status, payload, extra = self.game.handle(method, path, params or {}, None, None)
+        return Response(status, payload, dict(self.game.rate_limit_headers(), **extra))
+
+    def close(self):
+        pass
+
+
+def test_client_stays_within_server_limits():
+    # the server's limit is a fixed one-second window plus a burst pool that refills all at once, not the
+    # client's own bucket, so this catches the client sending faster than the server allows
+    game = MockGame(generate_universe(systems=50), rate_limit=20, burst_limit=40, burst_period=2.0)
+    handler = RequestHandler(20, 40, transport=GameTransport(game), log=Log(stream=open(os.devnull, "w")))
+    stop = threading.Event()
+
+    def caller():
+        while not stop.is_set():
+            handler.get("")
+
+    threads = [threading.Thread(target=caller, daemon=True) for _ in range(16)]
+    for t in threads:
+        t.start()
+    time.sleep(3.5)  # past one refill of the burst pool
+    stop.set()
+    for t in threads:
+        t.join(timeout=10)
+    handler.log.close()
+    assert game.request_count > 100
+    assert game.rate_limited_count == 0
+    assert handler.rate_limited_count == 0
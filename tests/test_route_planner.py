@@ -0,0 +1,35 @@
+import random
+import time
+
+from route_planner import nearest_neighbour, or_opt, path_length, plan_tour, two_opt
+
+
+def random_points(n, seed):
+    rng = random.Random(seed)
+    return [(rng.randint(-800, 800), rng.randint(-800, 800)) for _ in range(n)]
+
+
+def test_plan_tour_visits_every_point():
+    points = random_points(60, 1)
+    assert sorted(plan_tour(points)) == list(range(60))
+    assert sorted(plan_tour(points, origin=(0, 0))) == list(range(60))
+
+
+def test_or_opt_never_lengthens_the_path():
+    for seed in range(5):
+        points = random_points(80, seed)
+        order = two_opt(points, nearest_neighbour(points, 0))
+        before = path_length(points, order)
+        assert path_length(points, or_opt(points, list(order))) <= before + 1e-6
+
+
+def test_plan_tour_time_at_120_waypoints():
+    # the biggest systems have over 100 waypoints, and every ship plans its tour on entering one
+    points = random_points(120, 2)
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        plan_tour(points)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert best < 0.25
@@ -0,0 +1,17 @@
+import datetime
+
+from make_requests import DEADLINE_SLACK
+from ship import Ship
+
+
+def test_deadline_counts_from_arrival():
+    arrival = datetime.datetime.utcnow() - datetime.timedelta(seconds=30)
+    ship = Ship("A", "token", "X1-A", Arrival=arrival)
+    assert ship.deadline("NORMAL") == arrival + datetime.timedelta(seconds=DEADLINE_SLACK["NORMAL"])
+
+
+def test_deadline_before_arriving_counts_from_now():
+    before = datetime.datetime.utcnow()
+    ship = Ship("A", "token", "X1-A", Arrival=before + datetime.timedelta(minutes=5))
+    assert before <= ship.deadline("HIGH") <= datetime.datetime.utcnow()
+    assert before <= Ship("B", "token", "X1-A").deadline("HIGH") <= datetime.datetime.utcnow()
@@ -0,0 +1,36 @@
+import sqlite3
+
+from storage import SCHEMA, SqliteStorage, access_type
+
+
+def test_access_types():
+    assert access_type("Waypoint", "TEXT PRIMARY KEY") == "TEXT(255) PRIMARY KEY"
+    assert access_type("Token", "TEXT") == "LONGTEXT"
+    assert access_type("Stop", "INTEGER NOT NULL DEFAULT 0") == "LONG"
+    assert access_type("Charted", "BOOLEAN NOT NULL DEFAULT 0") == "YESNO"
+    assert access_type("Arrival", "TIMESTAMP") == "DATETIME"
+    assert access_type("distanceFromFaction", "REAL") == "DOUBLE"
+    assert access_type("ID", "INTEGER PRIMARY KEY AUTOINCREMENT") == "COUNTER PRIMARY KEY"
+    assert access_type("ID", "INTEGER PRIMARY KEY AUTOINCREMENT", new_table=False) == "LONG"
+    for columns in SCHEMA.values():
+        for name, col_type in columns:
+            access_type(name, col_type)
+
+
+def test_sqlite_adds_missing_tables_and_columns(tmp_path):
+    # a database from before agents had states and waypoints had coordinates
+    path = str(tmp_path / "old.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE Agents (ID TEXT PRIMARY KEY, Token TEXT, System TEXT, Arrival TIMESTAMP, "
+                 "Completed BOOLEAN NOT NULL DEFAULT 0, Waypoint TEXT)")
+    conn.execute("CREATE TABLE Waypoints (Waypoint TEXT PRIMARY KEY, System TEXT)")
+    conn.execute("INSERT INTO Agents (ID, System) VALUES ('A', 'X1-A')")
+    conn.commit()
+    conn.close()
+
+    storage = SqliteStorage(path)
+    for table_name, columns in SCHEMA.items():
+        existing = [row[1] for row in storage.query("PRAGMA table_info(" + table_name + ")")]
+        assert set(existing) == {name for name, _ in columns}
+    assert storage.get_where("Agents", ["ID"], ["A"])[0][7] == 0  # Stop
+    storage.close()
@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+from storage import SqliteStorage
+from write_behind import WriteBehind
+
+
+class FlakyStorage(SqliteStorage):
+    # fails its next `failures` batches as if the database had gone away
+    failures = 0
+
+    def write_batch(self, batch):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        super().write_batch(batch)
+
+
+class CrashAfterCommitStorage(SqliteStorage):
+    # writes its next batch, then fails as if the process died before the .flushing file was removed
+    crash = False
+
+    def write_batch(self, batch):
+        super().write_batch(batch)
+        if self.crash:
+            self.crash = False
+            raise sqlite3.OperationalError("disk I/O error")
+
+
+def agent_ids(storage):
+    return sorted(row[0] for row in storage.get("Agents"))
+
+
+def test_bad_row_only_drops_that_row(tmp_path):
+    storage = SqliteStorage(str(tmp_path / "db.sqlite3"))
+    writer = WriteBehind(storage, max_delay=0.05, journal_path=str(tmp_path / "journal"))
+    writer.insert("Agents", ["ID", "System"], ["A", "X1"])
+    writer.flush()
+
+    # the duplicate fails the batch it's in, but the rest of that batch still lands
+    writer.insert("Agents", ["ID", "System"], ["B", "X1"])
+    writer.insert("Agents", ["ID", "System"], ["A", "X1"])
+    writer.insert("Agents", ["ID", "System"], ["C", "X1"])
+    writer.update("Agents", ["System"], ["X2"], ["ID"], ["B"])
+    writer.flush()
+    assert agent_ids(storage) == ["A", "B", "C"]
+    assert storage.get_where("Agents", ["ID"], ["B"])[0][2] == "X2"
+    assert writer.dropped.value() == 1
+
+    # and the background thread carries on with later batches
+    writer.insert("Agents", ["ID", "System"], ["D", "X1"])
+    deadline = time.monotonic() + 5
+    while agent_ids(storage) != ["A", "B", "C", "D"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert agent_ids(storage) == ["A", "B", "C", "D"]
+    assert writer.thread.is_alive()
+    writer.close()
+    assert not os.path.exists(str(tmp_path / "journal.flushing"))
+
+
+def test_failed_flush_keeps_its_writes(tmp_path):
+    storage = FlakyStorage(str(tmp_path / "db.sqlite3"))
+    journal = str(tmp_path / "journal")
+    writer = WriteBehind(storage, max_delay=60, journal_path=journal)
+    storage.failures = 1
+    writer.insert("Agents", ["ID", "System"], ["A", "X1"])
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    assert agent_ids(storage) == []
+
+    # a second flush mustn't replace the first one's .flushing file while its writes are still unwritten
+    writer.insert("Agents", ["ID", "System"], ["B", "X1"])
+    storage.failures = 1
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    with open(journal + ".flushing") as f:
+        assert len(f.readlines()) == 2
+
+    writer.flush()
+    assert agent_ids(storage) == ["A", "B"]
+    assert not os.path.exists(journal + ".flushing")
+    writer.close()
+
+
+def test_failed_flush_is_replayed_after_a_crash(tmp_path):
+    storage = FlakyStorage(str(tmp_path / "db.sqlite3"))
+    journal = str(tmp_path / "journal")
+    writer = WriteBehind(storage, max_delay=60, journal_path=journal)
+    writer.insert("Agents", ["ID", "System"], ["A", "X1"])
+    writer.flush()
+    storage.failures = 1
+    writer.insert("Agents", ["ID", "System"], ["B", "X1"])
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    writer.insert("Agents", ["ID", "System"], ["C", "X1"])
+    writer.closed = True  # crashes here, so never flushes again
+
+    # start again from the journal, with A's insert replayed a second time for good measure
+    with open(journal + ".flushing", "a") as f:
+        f.write('["insert", "Agents", ["ID", "System"], ["A", "X1"]]\n')
+    restarted = WriteBehind(SqliteStorage(str(tmp_path / "db.sqlite3")), max_delay=60, journal_path=journal)
+    assert agent_ids(restarted.storage) == ["A", "B", "C"]
+    restarted.close()
+
+
+def test_replay_after_commit_keeps_one_market_row(tmp_path):
+    storage = CrashAfterCommitStorage(str(tmp_path / "db.sqlite3"))
+    journal = str(tmp_path / "journal")
+    writer = WriteBehind(storage, max_delay=60, journal_path=journal)
+    storage.crash = True
+    writer.insert("Markets", ["Waypoint", "Symbol"], ["X1-A1", "FUEL"])
+    writer.update("Markets", ["SellPrice"], [70], ["Waypoint", "Symbol"], ["X1-A1", "FUEL"])
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    writer.closed = True  # crashes here, with the written batch still in .flushing
+    assert os.path.exists(journal + ".flushing")
+
+    restarted = WriteBehind(SqliteStorage(str(tmp_path / "db.sqlite3")), max_delay=60, journal_path=journal)
+    rows = restarted.storage.get_where("Markets", ["Waypoint", "Symbol"], ["X1-A1", "FUEL"])
+    assert len(rows) == 1
+    assert not os.path.exists(journal + ".flushing")
+
+    # the normal flush skips it too
+    restarted.insert("Markets", ["Waypoint", "Symbol"], ["X1-A1", "FUEL"])
+    restarted.flush()
+    assert len(restarted.storage.get_where("Markets", ["Waypoint", "Symbol"], ["X1-A1", "FUEL"])) == 1
+    assert restarted.dropped.value() == 0
+    restarted.close()
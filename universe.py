@@ -0,0 +1,110 @@
+import array
+import sys
+import threading
+
+
+EMPTY = array.array("i")
+
+
+class UniverseIndex:
+    # Every waypoint in the universe, loaded once and kept up to date as waypoints get charted.
+    # Waypoints are stored column-wise and looked up by position, so a system's waypoints are just an array of ints.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.__clear()
+
+    def __clear(self):
+        self.symbols = []
+        self.systems = []
+        self.charted = bytearray()
+        self.marketplace = bytearray()
+        self.shipyard = bytearray()
+        self.jump_gate = bytearray()
+        self.x = array.array("i")
+        self.y = array.array("i")
+        self.located = bytearray()
+        self.by_symbol = {}
+        self.by_system = {}
+        self.loaded = False
+
+    def load(self, rows):
+        with self.lock:
+            self.__clear()
+            for row in rows:
+                self.__add(row)
+            self.loaded = True
+
+    def add(self, row):
+        with self.lock:
+            self.__add(row)
+
+    def __add(self, row):
+        symbol = row[0]
+        i = self.by_symbol.get(symbol)
+        if i is None:
+            i = len(self.symbols)
+            system = sys.intern(row[1])
+            self.symbols.append(sys.intern(symbol))
+            self.systems.append(system)
+            self.charted.append(0)
+            self.marketplace.append(0)
+            self.shipyard.append(0)
+            self.jump_gate.append(0)
+            self.x.append(0)
+            self.y.append(0)
+            self.located.append(0)
+            self.by_symbol[symbol] = i
+            if system not in self.by_system:
+                self.by_system[system] = array.array("i")
+            self.by_system[system].append(i)
+        self.charted[i] = bool(row[2])
+        self.marketplace[i] = bool(row[3])
+        self.shipyard[i] = bool(row[4])
+        if len(row) > 5:
+            self.jump_gate[i] = bool(row[5])
+        if len(row) > 7 and row[6] is not None and row[7] is not None:
+            self.x[i] = row[6]
+            self.y[i] = row[7]
+            self.located[i] = 1
+
+    def row(self, i):
+        x = None
+        y = None
+        if self.located[i]:
+            x = self.x[i]
+            y = self.y[i]
+        return self.symbols[i], self.systems[i], bool(self.charted[i]), bool(self.marketplace[i]), \
+            bool(self.shipyard[i]), bool(self.jump_gate[i]), x, y
+
+    def get(self, symbol):
+        i = self.by_symbol.get(symbol)
+        if i is None:
+            return None
+        return self.row(i)
+
+    def index(self, symbol):
+        return self.by_symbol.get(symbol)
+
+    def indices_in(self, system):
+        # Positions of the system's waypoints, for holding on to instead of rows. Shared, so don't change it.
+        return self.by_system.get(system, EMPTY)
+
+    def waypoints_in(self, system):
+        return [self.row(i) for i in self.by_system.get(system, ())]
+
+    def all_systems(self):
+        return self.by_system.keys()
+
+    def has_market_or_shipyard(self, system):
+        for i in self.by_system.get(system, ()):
+            if self.marketplace[i] or self.shipyard[i]:
+                return True
+        return False
+
+    def uncharted_count(self):
+        return len(self.charted) - sum(self.charted)
+
+    def set_flag(self, symbol, flag, value=True):
+        i = self.by_symbol.get(symbol)
+        if i is not None:
+            getattr(self, flag)[i] = bool(value)
@@ -0,0 +1,268 @@
+import atexit
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+
+from log import Log
+from metrics import MetricsRegistry
+
+
+# Columns that identify a single row. Updates that target one of these rows get merged into whatever is
+# already pending for it; anything else is queued as its own statement.
+ROW_KEYS = {
+    "Systems": ("System",),
+    "Waypoints": ("Waypoint",),
+    "Agents": ("ID",),
+    "Markets": ("Waypoint", "Symbol"),
+    "Shipyards": ("Waypoint", "ShipType"),
+    "Factions": ("Faction",),
+    "Plans": ("ID", "Leg"),
+    "Tokens": ("ID",),
+}
+
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"datetime": value.isoformat()}
+    raise TypeError
+
+
+def decode_value(value):
+    if "datetime" in value:
+        return datetime.datetime.fromisoformat(value["datetime"])
+    return value
+
+
+class PendingWrite:
+    def __init__(self, kind, table_name, values, where=None):
+        self.kind = kind
+        self.table_name = table_name
+        self.values = values
+        self.where = where
+
+    def statement(self):
+        if self.kind == "insert":
+            return ("insert", self.table_name, tuple(self.values.keys()), None)
+        return ("update", self.table_name, tuple(self.values.keys()), tuple(self.where.keys()))
+
+    def params(self):
+        if self.kind == "insert":
+            return tuple(self.values.values())
+        return tuple(self.values.values()) + tuple(self.where.values())
+
+
+def batches(pending):
+    # Groups consecutive writes with the same statement, for storage.write_batch
+    batch = []
+    for write in pending:
+        statement = write.statement()
+        if batch and batch[-1][0] == statement:
+            batch[-1][1].append(write.params())
+        else:
+            batch.append((statement, [write.params()]))
+    return batch
+
+
+class WriteBehind:
+    # Queues writes in memory and flushes them to storage from a background thread in batches, once max_batch
+    # writes are pending or max_delay seconds have passed. With a journal_path every write is appended to a
+    # journal first, and anything left in it after a crash is replayed on the next start.
+    # A bad row only costs that row: the batch it's in is retried one write at a time and the row is logged and
+    # dropped. If the database itself fails, the batch goes back in the queue, journal and all, for the next flush.
+    def __init__(self, storage, max_batch: int = 500, max_delay: float = 1.0, journal_path: str = None,
+                 fsync: bool = False, metrics: MetricsRegistry = None, log: Log = None):
+        self.storage = storage
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.journal_path = journal_path
+        self.fsync = fsync
+        self.pending = []
+        self.rows = {}
+        self.lock = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.journal = None
+        self.closed = False
+        self.flushed_count = 0
+        self.coalesced_count = 0
+        if metrics is None:
+            metrics = MetricsRegistry()
+        metrics.gauge("db_pending_writes", "Writes queued for the next flush", function=lambda: len(self.pending))
+        self.write_latency = metrics.histogram("db_write_seconds", "Time to write one flushed batch to the database")
+        self.written = metrics.counter("db_writes_total", "Writes flushed to the database")
+        self.dropped = metrics.counter("db_dropped_writes_total", "Writes the database rejected")
+        if log is None:
+            log = Log()
+        self.log = log
+        if journal_path is not None:
+            self.replay_journal()
+            self.journal = open(journal_path, "a")
+        self.thread = threading.Thread(target=self.__run, name="WriteBehind", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def insert(self, table_name, column_name_list, value_list):
+        values = dict(zip(column_name_list, value_list))
+        write = PendingWrite("insert", table_name, values)
+        with self.lock:
+            self.__journal(["insert", table_name, column_name_list, value_list])
+            self.pending.append(write)
+            key = self.__row_key(table_name, values)
+            if key is not None:
+                self.rows[key] = write
+            self.__notify()
+
+    def update(self, table_name, update_column_name_list, update_value_list, where_column_name_list,
+               where_value_list):
+        values = dict(zip(update_column_name_list, update_value_list))
+        where = dict(zip(where_column_name_list, where_value_list))
+        with self.lock:
+            self.__journal(["update", table_name, update_column_name_list, update_value_list,
+                            where_column_name_list, where_value_list])
+            key = None
+            if tuple(where_column_name_list) == ROW_KEYS.get(table_name):
+                key = (table_name, tuple(where_value_list))
+            if key is not None and key in self.rows:
+                self.rows[key].values.update(values)
+                self.coalesced_count += 1
+                return
+            write = PendingWrite("update", table_name, values, where)
+            self.pending.append(write)
+            if key is not None:
+                self.rows[key] = write
+            else:
+                # this may touch rows we're merging into, so later writes to them can't jump ahead of it
+                for k in list(self.rows.keys()):
+                    if k[0] == table_name:
+                        del self.rows[k]
+            self.__notify()
+
+    def __row_key(self, table_name, values):
+        key_columns = ROW_KEYS.get(table_name)
+        if key_columns is None:
+            return None
+        for c in key_columns:
+            if c not in values:
+                return None
+        return table_name, tuple(values[c] for c in key_columns)
+
+    def __notify(self):
+        if len(self.pending) >= self.max_batch:
+            self.lock.notify()
+
+    def __journal(self, entry):
+        if self.journal is None:
+            return
+        self.journal.write(json.dumps(entry, default=encode_value) + "\n")
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+
+    def replay_journal(self):
+        # a crash mid-flush leaves the batch being written in the .flushing file, which is older than the journal
+        entries = []
+        for path in [self.journal_path + ".flushing", self.journal_path]:
+            if os.path.exists(path):
+                with open(path) as f:
+                    for line in f:
+                        if line.strip():
+                            entries.append(json.loads(line, object_hook=decode_value))
+        for entry in entries:
+            try:
+                if entry[0] == "insert":
+                    self.storage.insert(*entry[1:])
+                else:
+                    self.storage.update(*entry[1:])
+            except self.storage.row_errors as e:
+                # e.g. an insert that was written just before the crash, but not yet cleared from the journal
+                self.log.warning("db", "skipped journaled", entry[0], "on", entry[1], repr(e))
+        if entries:
+            self.log.info("db", "Replayed", len(entries), "journaled writes")
+        open(self.journal_path, "w").close()
+        if os.path.exists(self.journal_path + ".flushing"):
+            os.remove(self.journal_path + ".flushing")
+
+    def __run(self):
+        while not self.closed:
+            with self.lock:
+                if len(self.pending) < self.max_batch:
+                    self.lock.wait(self.max_delay)
+            try:
+                self.flush()
+            except Exception as e:
+                self.log.error("db", "flush failed, retrying:", repr(e))
+                time.sleep(self.max_delay)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = []
+                self.rows = {}
+                if pending and self.journal is not None:
+                    self.journal.close()
+                    self.__rotate_journal()
+                    self.journal = open(self.journal_path, "a")
+            if not pending:
+                return
+
+            start = time.perf_counter()
+            written = self.__write(pending)
+            self.write_latency.observe(time.perf_counter() - start)
+            self.flushed_count += written
+            self.written.inc(written)
+            self.dropped.inc(len(pending) - written)
+
+            if self.journal is not None:
+                os.remove(self.journal_path + ".flushing")
+
+    def __rotate_journal(self):
+        # Moves the journal aside while its writes are flushed. If the last flush failed, its writes are still in the
+        # .flushing file (and back in the queue), so these go after them instead of replacing them.
+        flushing = self.journal_path + ".flushing"
+        if os.path.exists(flushing):
+            with open(self.journal_path) as journal, open(flushing, "a") as f:
+                shutil.copyfileobj(journal, f)
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, flushing)
+
+    def __write(self, pending):
+        # Returns how many writes made it. Anything the database raises other than a row error puts every write
+        # not yet made back at the front of the queue and is raised.
+        i = 0
+        written = 0
+        try:
+            try:
+                self.storage.write_batch(batches(pending))
+                return len(pending)
+            except self.storage.row_errors as e:
+                self.log.warning("db", "batch of", len(pending), "writes failed, retrying one at a time:", repr(e))
+            for i, write in enumerate(pending):
+                try:
+                    self.storage.write_batch(batches([write]))
+                    written += 1
+                except self.storage.row_errors as e:
+                    self.log.error("db", "dropped", write.kind, "on", write.table_name, write.params(), repr(e))
+            return written
+        except Exception:
+            with self.lock:
+                self.pending = pending[i:] + self.pending
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.lock:
+            self.lock.notify()
+        try:
+            self.flush()
+        finally:
+            # anything that couldn't be written is still journaled for the next start
+            with self.lock:
+                if self.journal is not None:
+                    self.journal.close()
+                    self.journal = None